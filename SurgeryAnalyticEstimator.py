@@ -0,0 +1,259 @@
+# A class to give near-instant queueing-theory estimates for the Neurosurgery RTT pathway
+
+import numpy as np
+import pandas as pd
+
+from global_params import g
+from SurgeryDemandProfile import build_demand_profile
+
+
+class Analytic_Pathway_Estimator:
+    """
+    Approximates the outputs of `Neurosurgery_Pathway` without running a simulation.
+
+    Each stage of the pathway is treated as a single server with Poisson arrivals and
+    deterministic service (an M/D/1 queue), with the clinic feeding the theatre queue in tandem.
+
+    - While a stage has a backlog, a fluid approximation is used: the stage works through its
+    queue at full capacity, so the backlog grows (or drains) linearly.
+    - Once a stage's queue has drained, the steady-state M/D/1 waiting time is added to account
+    for the queueing caused by random arrivals.
+
+    The parameters are the same as for `Neurosurgery_Pathway` so the two can be driven from
+    the same inputs.
+
+    Parameters
+    ------
+
+    referrals_per_week: int, default is `g.referrals_per_week`
+        Average number of new referrals received to this pathway per week.
+
+    demand_profile: list or dict, default is None
+        Referral rate that changes over time, instead of referrals_per_week (see
+        SurgeryDemandProfile.py). The fluid approximation follows the profile's cumulative
+        referrals; the M/D/1 waits use its average rate over sim_duration.
+
+    surg_clinic_per_week: int, default is `g.surg_clinic_per_week`
+        Number of surgical clinics per week.
+
+    surg_clinic_capacity: int, default is `g.surg_clinic_appts`
+        Capacity (number of people it is possible to see) of a surgical clinic.
+
+    theatre_list_per_week: int, default is `g.theatre_list_per_week`
+        Number of theatre lists per week.
+
+    theatre_list_capacity: int, default is `g.theatre_list_capacity`
+        Capacity (number of people it is possible to operate on) of a single theatre list.
+
+    trauma_list_per_week: int, default is `g.trauma_list_per_week`
+        Number of trauma lists per week.
+
+    weekly_extra_patients: int, default is `g.weekly_extra_patients`
+        Number of extra patients for each trauma list, who take places from the theatre lists
+        (as in `Neurosurgery_Pathway`).
+
+    fill_non_admitted_queue: int, default is `g.fill_non_admitted_queue`.
+        Initial non-admitted queue size.
+
+    fill_admitted_queue: int, default is `g.fill_admitted_queue`
+        Initial admitted queue size.
+
+    sim_duration: int, default is `g.sim_duration`
+        Number of weeks during which new referrals are tracked.
+
+    time_step: float, default is 0.05
+        Resolution (in weeks) of the time grid used to evaluate the fluid approximation.
+    """
+
+    # The simulation gives up on draining the queues after this many weeks past sim_duration,
+    # so the estimate does not look further ahead than that either
+    max_drain_weeks = 52 * 10
+
+    def __init__(self,
+                 referrals_per_week = g.referrals_per_week,
+                 demand_profile = None,
+                 surg_clinic_per_week = g.surg_clinic_per_week,
+                 surg_clinic_capacity = g.surg_clinic_appts,
+                 theatre_list_per_week = g.theatre_list_per_week,
+                 theatre_list_capacity = g.theatre_list_capacity,
+                 trauma_list_per_week = g.trauma_list_per_week,
+                 weekly_extra_patients = g.weekly_extra_patients,
+                 fill_non_admitted_queue = g.fill_non_admitted_queue,
+                 fill_admitted_queue = g.fill_admitted_queue,
+                 sim_duration = g.sim_duration,
+                 time_step = 0.05
+                 ):
+
+        self.referrals_per_week = referrals_per_week
+        self.demand_profile = build_demand_profile(demand_profile)
+        # average referrals per week over the simulated period
+        if self.demand_profile is None:
+            self.mean_referrals_per_week = referrals_per_week
+        else:
+            self.mean_referrals_per_week = self.demand_profile.expected_referrals(0, sim_duration) / sim_duration
+        self.surg_clinic_total_slots = surg_clinic_per_week * surg_clinic_capacity
+        # the extra trauma patients take theatre places (a tiny capacity is kept if they take
+        # them all, so the estimate still has a finite horizon)
+        self.theatre_total_slots = max(theatre_list_per_week * theatre_list_capacity
+                                       - weekly_extra_patients * trauma_list_per_week, 1e-6)
+
+        # NOTE: the default pathway of Neurosurgery_Pathway sends every patient on to the
+        # theatre queue after clinic. The estimate mirrors this so that the two can be
+        # compared like-for-like.
+        self.trauma_list_per_week = trauma_list_per_week
+        self.weekly_extra_patients = weekly_extra_patients
+
+        self.fill_non_admitted_queue = fill_non_admitted_queue
+        self.fill_admitted_queue = fill_admitted_queue
+        self.sim_duration = sim_duration
+        self.time_step = time_step
+
+        self.calculate_flows()
+
+    def md1_wait(self, arrival_rate, capacity):
+        """
+        Method to calculate the steady-state mean wait in an M/D/1 queue
+
+        Service time is 1 / capacity weeks, so the Pollaczek-Khinchine formula gives
+        Wq = rho / (2 * capacity * (1 - rho)).
+
+        Returns
+        ---
+        A float (weeks), or 0 if the stage is overloaded (the fluid backlog dominates instead)
+        """
+        rho = arrival_rate / capacity
+        if rho >= 1:
+            return 0.0
+        return rho / (2 * capacity * (1 - rho))
+
+    def cumulative_referrals(self, times):
+        """
+        Method to return the expected number of new referrals between time 0 and the given times
+
+        Returns
+        ---
+        A numpy array
+        """
+        times = np.asarray(times, dtype=float)
+        if self.demand_profile is None:
+            return self.referrals_per_week * times
+        return self.demand_profile.cumulative(times)
+
+    def calculate_flows(self):
+        """
+        Method to calculate the cumulative arrivals and departures at each stage over time
+
+        With cumulative arrivals A(t) (including any backlog present at time 0) and a capacity
+        of c per week, the cumulative number of departures from a first-come-first-served fluid
+        queue is D(t) = c * t + min(0, min over s <= t of (A(s) - c * s))
+        """
+        # Look far enough ahead to drain every tracked patient through both stages, up to the
+        # same limit used by the simulation
+        tracked_patients = (self.fill_non_admitted_queue + self.fill_admitted_queue
+                            + self.cumulative_referrals(self.sim_duration))
+        slowest_stage = min(self.surg_clinic_total_slots, self.theatre_total_slots)
+        horizon = self.sim_duration + min(tracked_patients / slowest_stage + 1,
+                                          self.max_drain_weeks)
+
+        self.weeks = np.arange(0, horizon + self.time_step, self.time_step)
+
+        # Clinic: prefilled non-admitted patients plus new referrals
+        self.clinic_arrivals = self.fill_non_admitted_queue + self.cumulative_referrals(self.weeks)
+        self.clinic_departures = (self.surg_clinic_total_slots * self.weeks
+                                  + np.minimum(0, np.minimum.accumulate(
+                                      self.clinic_arrivals - self.surg_clinic_total_slots * self.weeks)))
+
+        # Theatres: prefilled admitted patients plus everyone leaving clinic
+        self.theatre_arrivals = self.fill_admitted_queue + self.clinic_departures
+        self.theatre_departures = (self.theatre_total_slots * self.weeks
+                                   + np.minimum(0, np.minimum.accumulate(
+                                       self.theatre_arrivals - self.theatre_total_slots * self.weeks)))
+
+        # Random (Poisson) arrivals cause some queueing even when there is no backlog
+        clinic_throughput = min(self.mean_referrals_per_week, self.surg_clinic_total_slots)
+        self.clinic_md1_wait = self.md1_wait(self.mean_referrals_per_week, self.surg_clinic_total_slots)
+        self.theatre_md1_wait = self.md1_wait(clinic_throughput, self.theatre_total_slots)
+
+    def wait_times(self, referral_weeks):
+        """
+        Method to estimate the overall wait (referral to start of surgery) for new referrals
+
+        Parameters
+        ------
+        referral_weeks: array-like
+            Times (in weeks) at which patients joined the pathway
+
+        Returns
+        ---
+        A numpy array of estimated waits in weeks
+        """
+        referral_weeks = np.asarray(referral_weeks, dtype=float)
+
+        # Position of each patient in the clinic queue, and the time it is reached
+        clinic_position = self.fill_non_admitted_queue + self.cumulative_referrals(referral_weeks)
+        leave_clinic = np.interp(clinic_position, self.clinic_departures, self.weeks)
+
+        # Position of each patient in the theatre queue, and the time it is reached
+        theatre_position = self.fill_admitted_queue + np.interp(leave_clinic, self.weeks,
+                                                                self.clinic_departures)
+        leave_theatre_queue = np.interp(theatre_position, self.theatre_departures, self.weeks)
+
+        return (leave_theatre_queue - referral_weeks
+                + self.clinic_md1_wait + self.theatre_md1_wait)
+
+    def queue_trajectory(self):
+        """
+        Method to return the estimated queue sizes over the simulated period
+
+        Returns
+        ---
+        A dataframe with one row per week and columns 'clinic_queue' and 'theatres_queue'
+        """
+        weeks = np.arange(0, self.sim_duration + 1)
+        clinic_queue = (np.interp(weeks, self.weeks, self.clinic_arrivals)
+                        - np.interp(weeks, self.weeks, self.clinic_departures))
+        theatre_queue = (np.interp(weeks, self.weeks, self.theatre_arrivals)
+                         - np.interp(weeks, self.weeks, self.theatre_departures))
+
+        return pd.DataFrame({'week': weeks,
+                             'clinic_queue': clinic_queue,
+                             'theatres_queue': theatre_queue}).set_index('week')
+
+    def estimate_kpis(self):
+        """
+        Method to estimate the headline figures reported by `Trial_Results_Calculator`
+
+        Returns
+        ---
+        A dictionary with
+        - clinic_queue_end, theatre_queue_end, total_queue_end: patients waiting at sim_duration
+        - mean_wait_start: mean wait for patients referred in the first week
+        - mean_wait_end: mean wait for patients referred in the final week
+        - total_52_plus, total_65_plus: number of final-week referrals waiting 52+ / 65+ weeks
+        - drain_week: week at which the last tracked patient reaches theatre
+        """
+        end = self.sim_duration
+        queue_end = self.queue_trajectory().loc[end]
+
+        first_week = np.arange(0, 1, self.time_step)
+        final_week = np.arange(end - 1, end, self.time_step) + self.time_step
+        waits_first_week = self.wait_times(first_week)
+        waits_final_week = self.wait_times(final_week)
+
+        # the last tracked patient is whoever is referred just before sim_duration
+        drain_week = end + self.wait_times([end])[0]
+
+        final_week_referrals = float(self.cumulative_referrals(end) - self.cumulative_referrals(end - 1))
+
+        return {
+            'clinic_queue_end': float(queue_end['clinic_queue']),
+            'theatre_queue_end': float(queue_end['theatres_queue']),
+            'total_queue_end': float(queue_end.sum()),
+            'mean_wait_start': float(waits_first_week.mean()),
+            'mean_wait_end': float(waits_final_week.mean()),
+            'total_52_plus': int(round(final_week_referrals
+                                       * (waits_final_week >= 52).mean())),
+            'total_65_plus': int(round(final_week_referrals
+                                       * (waits_final_week >= 65).mean())),
+            'drain_week': float(drain_week),
+        }
@@ -0,0 +1,190 @@
+# A class for the capacity of each stage of the Neurosurgery RTT pathway, week by week
+#
+# The number of clinics and theatre lists isn't the same every week: some rotas alternate
+# (e.g. an extra list every other week), bank holidays lose a day's sessions, and extra trauma
+# patients take slots from the elective theatre lists. Rather than modelling these by blocking
+# the stages with extra simpy processes, the capacity of every stage in every week is worked
+# out in advance as a table, which the processes that see each stage's patients look up.
+#
+# A capacity calendar can be given to the model as a dictionary (or in a scenario file). For
+# example
+#   {
+#     "session_patterns": {"theatre": [5, 5, 5, 4]},
+#     "bank_holidays": [0, 17, 21, 34, 51, 51]
+#   }
+# gives theatre 5 lists a week for three weeks and 4 in the fourth, over and over, and loses a
+# day's sessions of every stage in weeks 0, 17, 21 and 34, and two days' in week 51.
+
+import numpy as np
+
+# Working days in a week (a bank holiday loses one of them)
+WORKING_DAYS_PER_WEEK = 5
+
+# The settings a capacity calendar can have
+CALENDAR_SETTINGS = ['session_patterns', 'bank_holidays']
+
+
+def build_capacity_calendar(capacity_calendar, pathway_graph, extra_patients_per_week = 0,
+                            number_of_weeks = 1):
+    """
+    Function to turn the capacity_calendar parameter of a model into a Capacity_Calendar
+
+    Parameters
+    ------
+
+    capacity_calendar: dict or None
+        The calendar's settings (see Capacity_Calendar). If None, every week has the capacity
+        given by the pathway graph (less the extra patients).
+
+    Returns
+    ---
+    A Capacity_Calendar
+    """
+    capacity_calendar = capacity_calendar or {}
+    unknown = set(capacity_calendar) - set(CALENDAR_SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown capacity calendar settings: {sorted(unknown)}")
+    return Capacity_Calendar(pathway_graph, number_of_weeks,
+                             extra_patients_per_week=extra_patients_per_week, **capacity_calendar)
+
+
+class Capacity_Calendar:
+    """
+    The number of sessions and of places for patients at each stage of a pathway in each week.
+
+    Each stage holds the number of sessions in its session pattern (by default, the
+    sessions_per_week of the pathway graph every week), less a day's worth of sessions
+    (1 / WORKING_DAYS_PER_WEEK) for every bank holiday in the week. Each session has the
+    stage's capacity of places. Extra trauma patients take places from the clock stop stages
+    (e.g. theatre) every week.
+
+    The tables have a row per week and a column per stage:
+    - sessions: the sessions held
+    - stolen_slots: the places taken by extra patients
+    - slots: the places left for the pathway's patients
+    - places_per_session: slots divided between the stage's usual sessions_per_week sessions
+      (used in 'session' service mode, where sessions are always held at the usual times, but
+      have fewer places when sessions are lost)
+    - service_times: the time to see each patient (1 / slots) in 'continuous' service mode,
+      or infinity if the stage has no places that week
+
+    The tables are extended if a week beyond number_of_weeks is looked up.
+
+    Parameters
+    ------
+
+    pathway_graph: Pathway_Graph
+        The stages of the pathway.
+
+    number_of_weeks: int
+        Number of weeks to work out the capacity for at first.
+
+    session_patterns: dict, default is None
+        Sessions held each week by stage name, as a list that is repeated (e.g. [5, 5, 5, 4]).
+        Stages not given hold their sessions_per_week every week.
+
+    bank_holidays: list of int, default is None
+        The weeks with a bank holiday (weeks are numbered from 0). A week can be given more
+        than once if it has more than one.
+
+    extra_patients_per_week: float, default is 0
+        Places taken each week from each clock stop stage by extra (trauma) patients.
+    """
+    def __init__(self, pathway_graph, number_of_weeks, session_patterns = None,
+                 bank_holidays = None, extra_patients_per_week = 0):
+        self.pathway_graph = pathway_graph
+        self.session_patterns = dict(session_patterns or {})
+        self.bank_holidays = list(bank_holidays or [])
+        self.extra_patients_per_week = extra_patients_per_week
+        self.validate()
+
+        graph = pathway_graph
+        self.patterns = [np.asarray(self.session_patterns.get(stage_name, [sessions_per_week]),
+                                    dtype=float)
+                         for stage_name, sessions_per_week
+                         in zip(graph.stage_names, graph.sessions_per_week)]
+        self.capacities = np.asarray(graph.capacities, dtype=float)
+        self.usual_sessions = np.asarray(graph.sessions_per_week, dtype=float)
+        self.extra_patients = np.where(graph.clock_stops, float(extra_patients_per_week), 0.0)
+
+        self.build_tables(number_of_weeks)
+
+    def validate(self):
+        """
+        Method to check the calendar's settings
+
+        Raises a ValueError describing the first problem found
+        """
+        for stage_name, pattern in self.session_patterns.items():
+            if stage_name not in self.pathway_graph.stage_index:
+                raise ValueError(f"The capacity calendar has a session pattern for unknown stage '{stage_name}'")
+            if len(pattern) == 0 or min(pattern) < 0:
+                raise ValueError(f"The session pattern of stage '{stage_name}' must be a list of "
+                                 "numbers of sessions that aren't negative")
+        if any(week < 0 for week in self.bank_holidays):
+            raise ValueError("Bank holiday weeks can't be negative")
+        if self.extra_patients_per_week < 0:
+            raise ValueError("The number of extra patients can't be negative")
+
+    def build_tables(self, number_of_weeks):
+        """
+        Method to work out the capacity of every stage in weeks 0 to number_of_weeks - 1
+
+        The lookup tables are kept as lists of lists of floats, which are quicker to read single
+        values from than numpy arrays.
+        """
+        self.number_of_weeks = number_of_weeks
+        weeks = np.arange(number_of_weeks)
+
+        sessions = np.column_stack([pattern[weeks % len(pattern)] for pattern in self.patterns])
+        holidays = np.bincount([week for week in self.bank_holidays if week < number_of_weeks],
+                               minlength=number_of_weeks)
+        sessions *= np.maximum(1 - holidays / WORKING_DAYS_PER_WEEK, 0)[:, np.newaxis]
+
+        places = sessions * self.capacities
+        stolen_slots = np.minimum(self.extra_patients, places)
+
+        self.sessions = sessions
+        self.stolen_slots = stolen_slots
+        self.slots = places - stolen_slots
+
+        # (written so that a week with the usual sessions and no extra patients gives exactly
+        # the capacity and service time of the pathway graph)
+        self.places_per_session = (self.capacities * (sessions / self.usual_sessions)
+                                   - stolen_slots / self.usual_sessions).tolist()
+        with np.errstate(divide='ignore'):
+            self.service_times = np.where(self.slots > 0, 1 / self.slots, np.inf).tolist()
+
+    def extend(self, week):
+        """
+        Method to make sure the tables cover a week
+        """
+        if week >= self.number_of_weeks:
+            self.build_tables(max(2 * self.number_of_weeks, week + 1))
+
+    def session_places(self, week, stage):
+        """
+        Method to return the places at each of a stage's sessions in a week ('session' service
+        mode)
+        """
+        self.extend(week)
+        return self.places_per_session[week][stage]
+
+    def service_time(self, week, stage):
+        """
+        Method to return the time taken to see each patient at a stage in a week ('continuous'
+        service mode), or infinity if the stage has no places that week
+        """
+        self.extend(week)
+        return self.service_times[week][stage]
+
+    def weekly_slots(self, week):
+        """
+        Method to return the places at every stage in a week
+
+        Returns
+        ---
+        A numpy array with a value for each stage
+        """
+        self.extend(week)
+        return self.slots[week]
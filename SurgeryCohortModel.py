@@ -0,0 +1,356 @@
+# A class to model the Neurosurgery RTT pathway a week at a time, with numbers of patients
+# rather than individual patients
+#
+# For planning questions covering hundreds of thousands of patients over several years,
+# simulating every patient (even in session mode) takes too long to try many scenarios. This
+# model keeps, for every stage of the pathway, the number of patients waiting from each week
+# of referral, as numpy arrays, and moves whole weeks of patients through the pathway at once.
+# A scenario takes milliseconds, whatever the number of patients.
+
+import numpy as np
+import pandas as pd
+
+from global_params import g
+from SurgeryPathwayGraph import build_pathway_graph, EXIT_STAGE
+from SurgeryCapacityCalendar import build_capacity_calendar
+from SurgeryDemandProfile import build_demand_profile
+
+
+class Cohort_Flow_Model:
+    """
+    Models the flow of patients through the pathway week by week, as counts of patients.
+
+    Patients are grouped into cohorts by the week they were referred in (cohort 0 is the
+    patients already waiting at the start, and cohort k the patients referred in week k - 1),
+    so a cohort's weeks waited is the current week minus its week of referral. Each week
+    - the week's referrals join the entry stage of the pathway graph
+    - each stage, in the order of the graph, sees up to its places that week in the capacity
+      calendar (by default sessions_per_week x capacity) of patients, longest-waiting cohorts
+      first
+    - the patients seen are split between the next stages by the routing probabilities.
+      Patients moving on to a later stage can be seen there the same week; patients moving
+      back to an earlier stage (or the same stage) wait until the next week.
+
+    As in `Neurosurgery_Pathway`, patients stop being tracked for the results once they are
+    referred after sim_duration, but new referrals keep using the pathway's capacity, and the
+    model carries on until every tracked patient has left the pathway. A patient's RTT clock
+    stops when they are seen at a clock stop stage, or else at the last stage they are seen at.
+
+    With stochastic=False (the default) the model gives the expected flows, with fractions of
+    patients. With stochastic=True the number of referrals each week is Poisson distributed and
+    the patients seen are routed at random, like a run of the simulation.
+
+    Waits are measured in whole weeks (the week seen minus the week referred), so they are
+    accurate to about a week.
+
+    The parameters are the same as for `Neurosurgery_Pathway` so the two can be driven from
+    the same inputs.
+
+    Parameters
+    ------
+
+    referrals_per_week: int, default is `g.referrals_per_week`
+        Average number of new referrals received to this pathway per week.
+
+    demand_profile: list or dict, default is None
+        Referral rate that changes over time, instead of referrals_per_week (see
+        SurgeryDemandProfile.py). Each week's referrals are the profile's expected referrals
+        in that week.
+
+    surg_clinic_per_week: int, default is `g.surg_clinic_per_week`
+        Number of surgical clinics per week (for the default pathway graph).
+
+    surg_clinic_capacity: int, default is `g.surg_clinic_appts`
+        Capacity (number of people it is possible to see) of a surgical clinic.
+
+    theatre_list_per_week: int, default is `g.theatre_list_per_week`
+        Number of theatre lists per week (for the default pathway graph).
+
+    theatre_list_capacity: int, default is `g.theatre_list_capacity`
+        Capacity (number of people it is possible to operate on) of a single theatre list.
+
+    trauma_list_per_week: int, default is `g.trauma_list_per_week`
+        Number of trauma lists per week.
+
+    weekly_extra_patients: int, default is `g.weekly_extra_patients`
+        Number of extra patients for each trauma list, who take places from the theatre lists
+        (as in `Neurosurgery_Pathway`).
+
+    fill_non_admitted_queue: int, default is `g.fill_non_admitted_queue`.
+        Initial non-admitted queue size.
+
+    fill_admitted_queue: int, default is `g.fill_admitted_queue`
+        Initial admitted queue size.
+
+    sim_duration: int, default is `g.sim_duration`
+        Number of weeks of referrals to track.
+
+    pathway_graph: Pathway_Graph or dict, default is None
+        The stages of the pathway (see SurgeryPathwayGraph.py). If None, a surgical clinic
+        followed by theatre.
+
+    capacity_calendar: dict, default is None
+        Changes to the number of sessions of each stage from week to week (see
+        SurgeryCapacityCalendar.py).
+
+    stochastic: bool, default is False
+        If True, sample the referrals and routing at random rather than using expected values.
+
+    random_seed: int, default is None
+        Seed for the random numbers when stochastic is True.
+
+    max_drain_weeks: int, default is 520
+        Number of weeks after sim_duration to stop at if there are still tracked patients in
+        the pathway (as for the simulation's guard against runs that never finish).
+    """
+    def __init__(self,
+                 referrals_per_week = g.referrals_per_week,
+                 demand_profile = None,
+                 surg_clinic_per_week = g.surg_clinic_per_week,
+                 surg_clinic_capacity = g.surg_clinic_appts,
+                 theatre_list_per_week = g.theatre_list_per_week,
+                 theatre_list_capacity = g.theatre_list_capacity,
+                 trauma_list_per_week = g.trauma_list_per_week,
+                 weekly_extra_patients = g.weekly_extra_patients,
+                 fill_non_admitted_queue = g.fill_non_admitted_queue,
+                 fill_admitted_queue = g.fill_admitted_queue,
+                 sim_duration = g.sim_duration,
+                 pathway_graph = None,
+                 capacity_calendar = None,
+                 stochastic = False,
+                 random_seed = None,
+                 max_drain_weeks = 52 * 10
+                 ):
+
+        self.referrals_per_week = referrals_per_week
+        self.demand_profile = build_demand_profile(demand_profile)
+        self.fill_non_admitted_queue = fill_non_admitted_queue
+        self.fill_admitted_queue = fill_admitted_queue
+        self.sim_duration = sim_duration
+        self.stochastic = stochastic
+        self.max_drain_weeks = max_drain_weeks
+        self.rng = np.random.default_rng(random_seed)
+
+        self.pathway_graph = build_pathway_graph(pathway_graph, surg_clinic_per_week,
+                                                 surg_clinic_capacity, theatre_list_per_week,
+                                                 theatre_list_capacity)
+        if fill_admitted_queue > 0 and self.pathway_graph.admitted_entry_stage is None:
+            raise ValueError("The pathway has no admitted stage for the admitted queue to be prefilled into")
+
+        graph = self.pathway_graph
+        # places at each stage in each week
+        self.capacity_calendar = build_capacity_calendar(
+            capacity_calendar, graph, weekly_extra_patients * trauma_list_per_week,
+            sim_duration + max_drain_weeks + 1)
+        self.non_admitted_stages = np.array([waiting_list == 'non_admitted'
+                                             for waiting_list in graph.waiting_lists])
+
+    def route(self, seen, stage):
+        """
+        Method to split the patients seen at a stage between the stages they go to next
+
+        Parameters
+        ------
+
+        seen: numpy array
+            Number of patients seen from each cohort.
+
+        stage: int
+            The stage they were seen at.
+
+        Returns
+        ---
+        A list of (next stage, numpy array of the number of patients from each cohort going
+        to it)
+        """
+        graph = self.pathway_graph
+        targets = graph.route_targets[stage]
+        if len(targets) == 1:
+            return [(targets[0], seen)]
+
+        probabilities = np.diff(graph.route_cumulative_probabilities[stage], prepend=0)
+        if self.stochastic:
+            split = self.rng.multinomial(seen.astype(np.int64), probabilities).T
+        else:
+            split = np.outer(probabilities, seen)
+        return list(zip(targets, split))
+
+    def run(self):
+        """
+        Method to run the model
+
+        Sets
+        - weekly_queues_df: the number waiting for each waiting list at the start of each week
+        - clock_stops: a 2D array of the number of patients from each cohort (rows) whose RTT
+          clock stopped after each number of weeks waited (columns)
+        - end_week: the week the last tracked patient left the pathway
+        """
+        graph = self.pathway_graph
+        number_of_stages = graph.number_of_stages
+        last_week = self.sim_duration + self.max_drain_weeks
+        number_of_cohorts = last_week + 2
+
+        # patients waiting at each stage from each cohort, whose RTT clock is still running /
+        # has already stopped
+        running = np.zeros((number_of_stages, number_of_cohorts))
+        stopped = np.zeros((number_of_stages, number_of_cohorts))
+        self.clock_stops = np.zeros((number_of_cohorts, last_week + 2))
+
+        running[graph.entry_stage, 0] += self.fill_non_admitted_queue
+        if self.fill_admitted_queue > 0:
+            running[graph.admitted_entry_stage, 0] += self.fill_admitted_queue
+
+        # fractions of a place carried over to the next week (stochastic mode only)
+        places_carried = np.zeros(number_of_stages)
+        # cohorts 0 to sim_duration are tracked
+        tracked = self.sim_duration + 1
+        tolerance = 0.5 if self.stochastic else 1e-6
+
+        weekly_queues = [running.sum(axis=1)]
+        oldest = 0
+
+        # expected referrals in each week
+        if self.demand_profile is None:
+            weekly_referrals = [self.referrals_per_week] * last_week
+        else:
+            weekly_referrals = np.diff(self.demand_profile.cumulative(np.arange(last_week + 1))).tolist()
+
+        for week in range(last_week):
+            # cohort of this week's referrals
+            newest = week + 1
+            if self.stochastic:
+                running[graph.entry_stage, newest] += self.rng.poisson(weekly_referrals[week])
+            else:
+                running[graph.entry_stage, newest] += weekly_referrals[week]
+
+            # only cohorts from the oldest still waiting to the newest can have anyone waiting
+            window = slice(oldest, newest + 1)
+            cohorts = np.arange(oldest, newest + 1)
+            weeks_waited = week + 1 - cohorts
+
+            weekly_capacity = self.capacity_calendar.weekly_slots(week)
+            for stage in range(number_of_stages):
+                if self.stochastic:
+                    places = weekly_capacity[stage] + places_carried[stage]
+                    places_carried[stage] = places - np.floor(places)
+                    places = np.floor(places)
+                else:
+                    places = weekly_capacity[stage]
+
+                running_waiting = running[stage, window]
+                stopped_waiting = stopped[stage, window]
+                waiting = running_waiting + stopped_waiting
+
+                # longest-waiting cohorts first: a cohort gets whatever places the cohorts
+                # before it have left
+                seen = np.minimum(waiting, np.maximum(places - (np.cumsum(waiting) - waiting), 0))
+                if not seen.any():
+                    continue
+                running_seen = np.minimum(running_waiting, seen)
+                stopped_seen = seen - running_seen
+                running[stage, window] = running_waiting - running_seen
+                stopped[stage, window] = np.maximum(stopped_waiting - stopped_seen, 0)
+
+                if graph.clock_stops[stage]:
+                    self.clock_stops[cohorts, weeks_waited] += running_seen
+                    stopped_seen = stopped_seen + running_seen
+                    running_seen = np.zeros_like(running_seen)
+
+                for next_stage, moving in self.route(running_seen, stage):
+                    if next_stage == EXIT_STAGE:
+                        # the clock stops at the last stage patients are seen at
+                        self.clock_stops[cohorts, weeks_waited] += moving
+                    else:
+                        running[next_stage, window] += moving
+                for next_stage, moving in self.route(stopped_seen, stage):
+                    if next_stage != EXIT_STAGE:
+                        stopped[next_stage, window] += moving
+
+            weekly_queues.append(running[:, :newest + 1].sum(axis=1) + stopped[:, :newest + 1].sum(axis=1))
+
+            while oldest < newest and not (running[:, oldest].any() or stopped[:, oldest].any()):
+                oldest += 1
+
+            tracked_waiting = running[:, :tracked].sum() + stopped[:, :tracked].sum()
+            if week + 1 >= self.sim_duration and tracked_waiting < tolerance:
+                break
+
+        self.end_week = week + 1
+
+        weekly_queues = np.array(weekly_queues)
+        clinic_queue = weekly_queues[:, self.non_admitted_stages].sum(axis=1)
+        theatre_queue = weekly_queues[:, ~self.non_admitted_stages].sum(axis=1)
+        self.weekly_queues_df = pd.DataFrame({'week': np.arange(len(weekly_queues)),
+                                              'clinic_queue': clinic_queue,
+                                              'theatres_queue': theatre_queue,
+                                              'total_queue': clinic_queue + theatre_queue})
+
+    def readout_referral_week_waits(self):
+        """
+        Method to summarise the waits of the patients referred in each week
+
+        Must be called after run.
+
+        Returns
+        ---
+        A dataframe with a row per week of referral (from 0 to sim_duration - 1) and columns
+        patients, mean_wait, waits_52_plus and waits_65_plus
+        """
+        cohorts = self.clock_stops[1:self.sim_duration + 1]
+        weeks_waited = np.arange(cohorts.shape[1])
+        patients = cohorts.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_wait = (cohorts * weeks_waited).sum(axis=1) / patients
+
+        return pd.DataFrame({'referral_week': np.arange(self.sim_duration),
+                             'patients': patients,
+                             'mean_wait': mean_wait,
+                             'waits_52_plus': cohorts[:, weeks_waited >= 52].sum(axis=1),
+                             'waits_65_plus': cohorts[:, weeks_waited >= 65].sum(axis=1)
+                             }).set_index('referral_week')
+
+    def readout_kpis(self):
+        """
+        Method to collect the headline figures in one place
+
+        Must be called after run.
+
+        Returns
+        ---
+        A dictionary with the same keys as `Trial_Results_Calculator.readout_kpis`
+        """
+        queues_at_end = self.weekly_queues_df.set_index('week').loc[self.sim_duration]
+        referral_week_waits_df = self.readout_referral_week_waits()
+        final_week = referral_week_waits_df.loc[self.sim_duration - 1]
+
+        return {
+            'clinic_queue_end': float(queues_at_end['clinic_queue']),
+            'theatre_queue_end': float(queues_at_end['theatres_queue']),
+            'total_queue_end': float(queues_at_end['total_queue']),
+            'mean_wait_start': float(referral_week_waits_df.loc[0, 'mean_wait']),
+            'mean_wait_end': float(final_week['mean_wait']),
+            'total_52_plus': int(round(final_week['waits_52_plus'])),
+            'total_65_plus': int(round(final_week['waits_65_plus'])),
+        }
+
+
+def run_cohort_trial(number_of_runs, seed = None, **pathway_params):
+    """
+    Function to run the cohort model a number of times with random referrals and routing
+
+    Each run has its own seed, made from seed as for `run_trial`.
+
+    Returns
+    ---
+    A dataframe with a row per run (numbered from 1) and a column for each of the keys of
+    `Trial_Results_Calculator.readout_kpis`, as given by its readout_run_kpis method
+    """
+    from SurgeryTrial import replication_seeds
+
+    rows = []
+    for run, random_seed in enumerate(replication_seeds(seed, number_of_runs), start=1):
+        cohort_model = Cohort_Flow_Model(stochastic=True, random_seed=random_seed, **pathway_params)
+        cohort_model.run()
+        rows.append({'run': run, **cohort_model.readout_kpis()})
+
+    return pd.DataFrame(rows).set_index('run').astype(float)
@@ -0,0 +1,200 @@
+# A class to compare two scenarios of the Neurosurgery RTT pathway simulation
+#
+# To compare a baseline with an intervention from the command line, run e.g.
+#   python SurgeryComparison.py example_scenario.json intervention.json --runs 10 --antithetic
+# where intervention.json only needs the parameters that differ from the baseline.
+
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from global_params import g
+from SurgeryTrial import run_trial
+
+
+class Scenario_Comparison:
+    """
+    Estimates the effect of an intervention (e.g. an extra theatre list per week) on each KPI.
+
+    Both scenarios are run with the same seeds, so run n of the baseline and run n of the
+    intervention see exactly the same referrals and the same patients needing surgery (common
+    random numbers). Much of the run-to-run noise then cancels out of the difference between
+    the scenarios, so the difference can be estimated precisely from far fewer runs than if the
+    two scenarios were run independently.
+
+    With antithetic=True the runs are also done in antithetic pairs (see SurgeryVariates.py),
+    which can cancel out more of the noise.
+
+    Parameters
+    ------
+
+    baseline_params: dict
+        Keyword arguments for Neurosurgery_Pathway for the baseline scenario.
+
+    intervention_params: dict
+        Keyword arguments for Neurosurgery_Pathway for the intervention. Any parameter not
+        given is the same as for the baseline.
+
+    number_of_runs: int, default is `g.number_of_runs`
+        Number of runs of each scenario.
+
+    seed: int, default is None
+        Seed for both trials. If None, a seed is chosen at random (but the two scenarios
+        still share it).
+
+    antithetic: bool, default is False
+        If True, do the runs of each scenario in antithetic pairs.
+
+    confidence: float, default is 0.95
+        Confidence level of the intervals for the differences.
+
+    output_dir: str, default is 'comparison'
+        Folder to write the results files to (in a subfolder for each scenario).
+
+    **trial_options:
+        Any other keyword arguments for `run_trial` (e.g. workers, result_store).
+    """
+    def __init__(self, baseline_params, intervention_params, number_of_runs = g.number_of_runs,
+                 seed = None, antithetic = False, confidence = 0.95, output_dir = 'comparison',
+                 **trial_options):
+        self.baseline_params = dict(baseline_params)
+        self.intervention_params = {**self.baseline_params, **intervention_params}
+        self.number_of_runs = number_of_runs
+        if seed is None:
+            seed = np.random.SeedSequence().entropy
+        self.seed = seed
+        self.antithetic = antithetic
+        self.confidence = confidence
+        self.output_dir = output_dir
+        self.trial_options = trial_options
+
+    def run(self):
+        """
+        Method to run both scenarios and collect the KPIs of every run
+        """
+        run_kpis = {}
+        for scenario, params in [('baseline', self.baseline_params),
+                                 ('intervention', self.intervention_params)]:
+            print(f"Running the {scenario} scenario")
+            trial_results_calculator = run_trial(number_of_runs=self.number_of_runs,
+                                                 seed=self.seed, antithetic=self.antithetic,
+                                                 output_dir=os.path.join(self.output_dir, scenario),
+                                                 **self.trial_options, **params)
+            run_kpis[scenario] = trial_results_calculator.readout_run_kpis()
+
+        self.baseline_run_kpis_df = run_kpis['baseline']
+        self.intervention_run_kpis_df = run_kpis['intervention']
+
+    def independent_units(self, run_kpis_df):
+        """
+        Method to combine the runs into independent results
+
+        The runs of an antithetic pair are not independent of each other, so each pair is
+        averaged and treated as a single result. Otherwise every run is independent.
+
+        Returns
+        ---
+        A dataframe with a row per independent result
+        """
+        if not self.antithetic:
+            return run_kpis_df
+        # runs are numbered from 1, and runs 1 and 2 are the first pair
+        pairs = (run_kpis_df.index - 1) // 2
+        return run_kpis_df.groupby(pairs).mean()
+
+    def readout_comparison(self):
+        """
+        Method to estimate the difference the intervention makes to each KPI
+
+        Must be called after run.
+
+        Returns
+        ---
+        A dataframe with a row per KPI and columns
+        - baseline, intervention: the mean of the KPI over the runs of each scenario
+        - difference: intervention minus baseline
+        - ci_lower, ci_upper: confidence interval for the difference
+        - independent_half_width: half the width of the interval had the scenarios been run
+          with independent random numbers (estimated from the spread of each scenario's runs)
+        - runs_saved_factor: how many times more runs independent scenarios would need to
+          give an interval as narrow as this one
+        """
+        baseline_df = self.independent_units(self.baseline_run_kpis_df)
+        intervention_df = self.independent_units(self.intervention_run_kpis_df)
+        differences_df = intervention_df - baseline_df
+
+        rows = []
+        for kpi in differences_df.columns:
+            differences = differences_df[kpi].dropna()
+            number_of_units = len(differences)
+
+            row = {'kpi': kpi,
+                   'baseline': baseline_df[kpi].mean(),
+                   'intervention': intervention_df[kpi].mean(),
+                   'difference': differences.mean()}
+
+            if number_of_units > 1:
+                t_value = stats.t.ppf(0.5 + self.confidence / 2, number_of_units - 1)
+                paired_variance = differences.var()
+                independent_variance = baseline_df[kpi].var() + intervention_df[kpi].var()
+                half_width = t_value * np.sqrt(paired_variance / number_of_units)
+                row['ci_lower'] = row['difference'] - half_width
+                row['ci_upper'] = row['difference'] + half_width
+                row['independent_half_width'] = (t_value
+                                                 * np.sqrt(independent_variance / number_of_units))
+                if paired_variance > 0:
+                    row['runs_saved_factor'] = independent_variance / paired_variance
+                else:
+                    # no noise in the difference at all (or in either scenario)
+                    row['runs_saved_factor'] = np.inf if independent_variance > 0 else np.nan
+            else:
+                # a confidence interval needs at least two independent results
+                row['ci_lower'] = row['ci_upper'] = np.nan
+                row['independent_half_width'] = row['runs_saved_factor'] = np.nan
+
+            rows.append(row)
+
+        return pd.DataFrame(rows).set_index('kpi')
+
+
+if __name__ == '__main__':
+    from run_batch import load_scenario
+
+    parser = argparse.ArgumentParser(description='Compare two scenarios of the Neurosurgery RTT pathway simulation')
+    parser.add_argument('baseline', help='json file of the baseline scenario parameters')
+    parser.add_argument('intervention',
+                        help='json file of the parameters that differ in the intervention')
+    parser.add_argument('--runs', type=int, default=None,
+                        help='number of runs of each scenario (overrides the baseline file)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed (overrides the baseline file)')
+    parser.add_argument('--antithetic', action='store_true',
+                        help='do the runs in antithetic pairs')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of runs to do in parallel')
+    parser.add_argument('--output-dir', default='comparison',
+                        help='folder to write the results to')
+    args = parser.parse_args()
+
+    trial_settings, baseline_params = load_scenario(args.baseline)
+    _, intervention_params = load_scenario(args.intervention)
+
+    scenario_comparison = Scenario_Comparison(
+        baseline_params, intervention_params,
+        number_of_runs=args.runs or trial_settings.get('number_of_runs', g.number_of_runs),
+        seed=args.seed if args.seed is not None else trial_settings.get('seed'),
+        antithetic=args.antithetic,
+        output_dir=args.output_dir,
+        workers=args.workers)
+    scenario_comparison.run()
+
+    comparison_df = scenario_comparison.readout_comparison()
+    comparison_df.to_csv(os.path.join(args.output_dir, 'comparison.csv'))
+
+    print()
+    print(f"Effect of the intervention ({scenario_comparison.number_of_runs} runs of each scenario, "
+          f"{scenario_comparison.confidence:.0%} confidence intervals)")
+    print(comparison_df.round(2).to_string())
@@ -0,0 +1,201 @@
+# A class for referral demand that changes over time (e.g. winter pressure, or a recovery trend)
+#
+# By default referrals arrive at a constant referrals_per_week. A demand profile instead gives
+# the referral rate for each week, either
+# - as a list of weekly rates, which repeats (e.g. 52 values for a seasonal pattern), e.g.
+#     "demand_profile": [34, 33, 31, ..., 36]
+# - or as the rates at given weeks, with the rate changing linearly between them and staying
+#   at the first / last rate before / after them (e.g. a trend), e.g.
+#     "demand_profile": {"weeks": [0, 26, 52], "rates": [30, 38, 34]}
+#
+# Referral times are generated by inversion: the cumulative rate Lambda(t) (the expected number
+# of referrals by time t) is worked out for each piece of the profile, and the times of a
+# Poisson process with a rate of 1 (cumulative sums of exponential random numbers, drawn in
+# blocks) are turned into referral times t = Lambda^-1(s) for a whole block at once.
+
+import numpy as np
+
+
+def build_demand_profile(demand_profile):
+    """
+    Function to turn the demand_profile parameter of a model into a Demand_Profile
+
+    Parameters
+    ------
+
+    demand_profile: list, dict, Demand_Profile or None
+        A list of weekly rates (repeated), or a dictionary of 'weeks' and 'rates'.
+
+    Returns
+    ---
+    A Demand_Profile, or None if demand_profile is None (a constant referrals_per_week)
+    """
+    if demand_profile is None or isinstance(demand_profile, Demand_Profile):
+        return demand_profile
+    if isinstance(demand_profile, dict):
+        unknown = set(demand_profile) - {'weeks', 'rates'}
+        if unknown:
+            raise ValueError(f"Unknown demand profile settings: {sorted(unknown)}")
+        return Demand_Profile.piecewise_linear(demand_profile['weeks'], demand_profile['rates'])
+    return Demand_Profile.weekly(demand_profile)
+
+
+class Demand_Profile:
+    """
+    A referral rate that changes over time, made of pieces in which the rate changes linearly.
+
+    Use Demand_Profile.weekly or Demand_Profile.piecewise_linear to create one.
+
+    Parameters
+    ------
+
+    starts: array
+        Time (in weeks) each piece starts at, in increasing order, with the first at 0.
+
+    lengths: array
+        Length of each piece (in weeks).
+
+    start_rates: array
+        Referral rate (per week) at the start of each piece.
+
+    end_rates: array
+        Referral rate at the end of each piece.
+
+    period: float, default is None
+        If given, the profile repeats every period weeks (the pieces must cover the period).
+        Otherwise the rate stays at the end rate of the last piece after it.
+    """
+    def __init__(self, starts, lengths, start_rates, end_rates, period = None):
+        self.starts = np.asarray(starts, dtype=float)
+        self.lengths = np.asarray(lengths, dtype=float)
+        self.start_rates = np.asarray(start_rates, dtype=float)
+        self.end_rates = np.asarray(end_rates, dtype=float)
+        self.period = period
+
+        if len(self.starts) == 0:
+            raise ValueError("The demand profile is empty")
+        if min(self.start_rates.min(), self.end_rates.min()) < 0:
+            raise ValueError("The referral rates of the demand profile can't be negative")
+
+        self.slopes = (self.end_rates - self.start_rates) / self.lengths
+        # expected referrals in each piece, and by the start of each piece
+        self.piece_referrals = (self.start_rates + self.end_rates) / 2 * self.lengths
+        self.cumulative_starts = np.concatenate([[0], np.cumsum(self.piece_referrals)[:-1]])
+        self.total_referrals = self.piece_referrals.sum()
+        # rate after the last piece (if the profile doesn't repeat)
+        self.final_rate = self.end_rates[-1]
+
+    @classmethod
+    def weekly(cls, weekly_rates):
+        """
+        Method to create a profile with a constant rate each week, repeating after the last week
+        """
+        weekly_rates = np.asarray(weekly_rates, dtype=float)
+        number_of_weeks = len(weekly_rates)
+        return cls(np.arange(number_of_weeks), np.ones(number_of_weeks), weekly_rates,
+                   weekly_rates, period=number_of_weeks)
+
+    @classmethod
+    def piecewise_linear(cls, weeks, rates):
+        """
+        Method to create a profile whose rate changes linearly between the rates at the given
+        weeks (and stays at the first and last rates before and after them)
+        """
+        weeks = np.asarray(weeks, dtype=float)
+        rates = np.asarray(rates, dtype=float)
+        if len(weeks) == 0 or len(weeks) != len(rates):
+            raise ValueError("The demand profile needs a rate for each of its weeks")
+        if np.any(np.diff(weeks) <= 0) or weeks[0] < 0:
+            raise ValueError("The weeks of the demand profile must be increasing, from 0 or later")
+
+        # start with a constant piece up to the first week
+        weeks = np.concatenate([[0], weeks]) if weeks[0] > 0 else weeks
+        rates = np.concatenate([[rates[0]], rates]) if len(rates) < len(weeks) else rates
+        if len(weeks) == 1:
+            # a single rate - one piece of a week, which then carries on at the same rate
+            return cls([0], [1], rates, rates)
+        return cls(weeks[:-1], np.diff(weeks), rates[:-1], rates[1:])
+
+    def rate(self, times):
+        """
+        Method to return the referral rate at the given times
+
+        Returns
+        ---
+        A numpy array of rates (per week)
+        """
+        times = np.asarray(times, dtype=float)
+        if self.period is not None:
+            times = times % self.period
+        piece = np.clip(np.searchsorted(self.starts, times, 'right') - 1, 0, len(self.starts) - 1)
+        into_piece = np.minimum(times - self.starts[piece], self.lengths[piece])
+        return self.start_rates[piece] + self.slopes[piece] * into_piece
+
+    def cumulative(self, times):
+        """
+        Method to return the expected number of referrals between time 0 and the given times
+
+        Returns
+        ---
+        A numpy array
+        """
+        times = np.asarray(times, dtype=float)
+        cycles = 0
+        if self.period is not None:
+            cycles, times = np.divmod(times, self.period)
+
+        piece = np.clip(np.searchsorted(self.starts, times, 'right') - 1, 0, len(self.starts) - 1)
+        into_piece = times - self.starts[piece]
+        within = np.minimum(into_piece, self.lengths[piece])
+        after = np.maximum(into_piece - self.lengths[piece], 0)
+        return (cycles * self.total_referrals + self.cumulative_starts[piece]
+                + self.start_rates[piece] * within + self.slopes[piece] * within ** 2 / 2
+                + self.final_rate * after)
+
+    def expected_referrals(self, start, end):
+        """
+        Method to return the expected number of referrals between two times
+        """
+        return float(self.cumulative(end) - self.cumulative(start))
+
+    def inverse_cumulative(self, expected):
+        """
+        Method to return the times by which the given numbers of referrals are expected (the
+        inverse of cumulative)
+
+        Returning infinity where the rate drops to 0 for good before then.
+
+        Returns
+        ---
+        A numpy array of times (in weeks)
+        """
+        expected = np.asarray(expected, dtype=float)
+        cycles = 0
+        if self.period is not None:
+            if self.total_referrals == 0:
+                return np.full(expected.shape, np.inf)
+            cycles, expected = np.divmod(expected, self.total_referrals)
+
+        # ('right' skips pieces with no referrals)
+        piece = np.clip(np.searchsorted(self.cumulative_starts, expected, 'right') - 1,
+                        0, len(self.starts) - 1)
+        remaining = expected - self.cumulative_starts[piece]
+        start_rates = self.start_rates[piece]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # solve start_rate * t + slope * t^2 / 2 = remaining for the time t into the piece
+            # (written so it also holds when the slope is 0)
+            root = np.sqrt(np.maximum(start_rates ** 2 + 2 * self.slopes[piece] * remaining, 0))
+            into_piece = np.where(remaining > 0, 2 * remaining / (start_rates + root), 0.0)
+
+            # beyond the last piece, the rate stays at final_rate
+            beyond = remaining > self.piece_referrals[piece]
+            into_piece = np.where(beyond,
+                                  self.lengths[piece]
+                                  + (remaining - self.piece_referrals[piece]) / self.final_rate,
+                                  into_piece)
+
+        times = self.starts[piece] + into_piece
+        if self.period is not None:
+            times = times + cycles * self.period
+        return times
@@ -0,0 +1,374 @@
+# A class to emulate (approximate) the results of a full trial of the Neurosurgery RTT pathway
+#
+# The emulator is fitted offline by running the simulation at a spread of parameter values.
+# To refit it, run the command
+#   python SurgeryEmulator.py --points 60 --runs 3
+# which saves the fitted emulator to emulator.npz for the Streamlit app to pick up.
+
+import argparse
+import dataclasses
+import inspect
+import os
+import tempfile
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from global_params import g
+from SurgeryAnalyticEstimator import Analytic_Pathway_Estimator
+from SurgeryResultStore import model_version
+from SurgeryScenario import Scenario_Config
+
+
+# Parameters the emulator is trained over, and the range of values used in training.
+# Parameters not listed here are left at their defaults from `g` (so a query that changes
+# one of them, e.g. weekly_extra_patients, is outside the training range).
+EMULATOR_PARAMETER_RANGES = {
+    'referrals_per_week': (10, 60),
+    'surg_clinic_per_week': (1, 5),
+    'surg_clinic_capacity': (4, 12),
+    'theatre_list_per_week': (2, 8),
+    'theatre_list_capacity': (1, 4),
+    'fill_non_admitted_queue': (0, 600),
+    'fill_admitted_queue': (0, 250),
+    'sim_duration': (52, 156),
+}
+
+# Results returned by `Trial_Results_Calculator.readout_kpis` that the emulator predicts
+EMULATOR_KPIS = ['clinic_queue_end', 'theatre_queue_end', 'total_queue_end',
+                 'mean_wait_start', 'mean_wait_end', 'total_52_plus', 'total_65_plus']
+
+EMULATOR_FILE = 'emulator.npz'
+
+# Values used for any parameter not given in a query (the same defaults as the simulation)
+PARAMETER_DEFAULTS = {name: parameter.default for name, parameter
+                      in inspect.signature(Analytic_Pathway_Estimator).parameters.items()}
+
+# The parameters of the simulation itself (settings only used by the estimates, e.g. the
+# time_step of the analytic estimate, don't change the results the emulator predicts)
+SIMULATION_PARAMETERS = {field.name for field in dataclasses.fields(Scenario_Config)}
+
+
+class Pathway_Emulator:
+    """
+    A surrogate model that predicts the trial KPIs in milliseconds rather than minutes.
+
+    Each KPI is predicted with a Bayesian linear regression whose inputs are
+    - the analytic (queueing theory) estimate of that KPI from `Analytic_Pathway_Estimator`
+    - a quadratic polynomial of the pathway parameters, scaled to the training range
+
+    so the emulator only has to learn the correction between the quick estimate and the
+    simulation. The regression gives a predictive standard deviation alongside each prediction.
+
+    Parameters
+    ------
+
+    parameter_ranges: dict, default is `EMULATOR_PARAMETER_RANGES`
+        Mapping of parameter name to the (lowest, highest) value used in training.
+
+    prior_precision: float, default is 1.0
+        Precision of the zero-mean Gaussian prior on the polynomial coefficients (ridge penalty).
+    """
+
+    def __init__(self, parameter_ranges = EMULATOR_PARAMETER_RANGES, prior_precision = 1.0):
+        self.parameter_ranges = dict(parameter_ranges)
+        self.parameter_names = list(self.parameter_ranges)
+        self.prior_precision = prior_precision
+
+        self.lower = np.array([self.parameter_ranges[p][0] for p in self.parameter_names], dtype=float)
+        self.upper = np.array([self.parameter_ranges[p][1] for p in self.parameter_names], dtype=float)
+
+        self.analytic_cache = {}
+
+        # Fitted values - one entry per KPI
+        self.weights = {}
+        self.covariance = {}
+        self.noise_variance = {}
+
+        # fingerprint of the model code the emulator was fitted to (see SurgeryResultStore.py)
+        self.model_version = model_version()
+
+    def sample_training_points(self, number_of_points, seed = None):
+        """
+        Method to pick training points spread across the parameter space (Latin hypercube)
+
+        Each parameter's range is split into number_of_points equal strata, and each stratum is
+        used exactly once, in a random order.
+
+        Returns
+        ---
+        A list of dictionaries of pathway parameters (rounded to whole numbers)
+        """
+        rng = np.random.default_rng(seed)
+        dimensions = len(self.parameter_names)
+
+        strata = np.array([rng.permutation(number_of_points) for _ in range(dimensions)]).T
+        unit_points = (strata + rng.uniform(size=(number_of_points, dimensions))) / number_of_points
+        points = np.round(self.lower + unit_points * (self.upper - self.lower))
+
+        return [dict(zip(self.parameter_names, (int(v) for v in point))) for point in points]
+
+    def scale(self, params):
+        """
+        Method to scale pathway parameters to the range -1 to 1 across the training range
+        """
+        values = np.array([params.get(p, PARAMETER_DEFAULTS[p]) for p in self.parameter_names], dtype=float)
+        return 2 * (values - self.lower) / (self.upper - self.lower) - 1
+
+    def features(self, params, kpi):
+        """
+        Method to build the regression inputs for one set of pathway parameters
+
+        Returns
+        ---
+        A numpy array: [1, analytic estimate of the kpi, scaled parameters,
+        squares and pairwise products of the scaled parameters]
+        """
+        x = self.scale(params)
+        analytic_kpi = self.analytic_kpis(params)[kpi]
+        upper_triangle = np.triu_indices(len(x))
+        quadratic_terms = np.outer(x, x)[upper_triangle]
+
+        return np.concatenate([[1.0, analytic_kpi], x, quadratic_terms])
+
+    def analytic_kpis(self, params):
+        """
+        Method to get (and cache) the analytic estimates for a set of pathway parameters
+        """
+        key = tuple(sorted(params.items()))
+        if key not in self.analytic_cache:
+            self.analytic_cache[key] = Analytic_Pathway_Estimator(**params).estimate_kpis()
+        return self.analytic_cache[key]
+
+    def fit(self, training_params, training_kpis):
+        """
+        Method to fit the emulator to simulation results
+
+        Parameters
+        ------
+        training_params: list of dict
+            Pathway parameters for each training point
+
+        training_kpis: list of dict
+            Output of `Trial_Results_Calculator.readout_kpis` for each training point
+        """
+        self.training_params = list(training_params)
+        self.training_kpis = list(training_kpis)
+
+        for kpi in EMULATOR_KPIS:
+            targets = np.array([result[kpi] for result in self.training_kpis], dtype=float)
+            # e.g. if no patients were referred in the final week the mean wait is missing
+            keep = ~np.isnan(targets)
+            design = np.array([self.features(params, kpi)
+                               for params, use in zip(self.training_params, keep) if use])
+            targets = targets[keep]
+
+            # Posterior of a Bayesian linear regression, with the noise variance estimated from
+            # the residuals of the posterior mean fit
+            precision = design.T @ design + self.prior_precision * np.eye(design.shape[1])
+            covariance = np.linalg.inv(precision)
+            weights = covariance @ design.T @ targets
+
+            # The prior shrinks the coefficients, so the effective number of fitted parameters
+            # is less than the number of features
+            effective_parameters = np.trace(design @ covariance @ design.T)
+            residuals = targets - design @ weights
+            degrees_of_freedom = max(len(targets) - effective_parameters, 1)
+            noise_variance = max(residuals @ residuals / degrees_of_freedom, 1e-9)
+
+            self.weights[kpi] = weights
+            self.covariance[kpi] = covariance * noise_variance
+            self.noise_variance[kpi] = noise_variance
+
+    def outside_training_range(self, params):
+        """
+        Method to list the parameters that are outside the range the emulator was trained on
+
+        The parameters of the simulation the emulator wasn't trained over were left at their
+        defaults in training, so any of them set to another value is outside the range too.
+
+        Returns
+        ---
+        A list of parameter names (empty if the query is within the training range)
+        """
+        outside = [p for p, lowest, highest in zip(self.parameter_names, self.lower, self.upper)
+                   if not lowest <= params.get(p, PARAMETER_DEFAULTS[p]) <= highest]
+        untrained = [p for p, value in params.items()
+                     if p in SIMULATION_PARAMETERS and p not in self.parameter_ranges
+                     and value != PARAMETER_DEFAULTS.get(p, getattr(Scenario_Config, p))]
+        return outside + untrained
+
+    def is_out_of_date(self):
+        """
+        Method to check whether the model code has changed since the emulator was fitted
+
+        Returns
+        ---
+        True if the emulator was fitted to a different version of the model (or an unknown
+        one), so should be refitted
+        """
+        return self.model_version != model_version()
+
+    def predict(self, params):
+        """
+        Method to predict the trial KPIs for a set of pathway parameters
+
+        Returns
+        ---
+        A dictionary with
+        - 'kpis': dictionary of kpi name to (prediction, standard deviation)
+        - 'outside_training_range': list of parameters outside the range trained on. Predictions
+        for these are extrapolations and should not be relied upon.
+        """
+        predictions = {}
+        for kpi in EMULATOR_KPIS:
+            phi = self.features(params, kpi)
+            mean_prediction = float(phi @ self.weights[kpi])
+            variance = self.noise_variance[kpi] + phi @ self.covariance[kpi] @ phi
+            predictions[kpi] = (mean_prediction, float(np.sqrt(variance)))
+
+        return {'kpis': predictions,
+                'outside_training_range': self.outside_training_range(params)}
+
+    def sweep(self, params, parameter_name, values):
+        """
+        Method to predict the KPIs as one parameter is varied and the rest are held fixed
+
+        Returns
+        ---
+        A dataframe with one row per value, with a column per KPI and a '_sd' column with its
+        standard deviation
+        """
+        rows = []
+        for value in values:
+            prediction = self.predict({**params, parameter_name: value})
+            row = {parameter_name: value,
+                   'outside_training_range': bool(prediction['outside_training_range'])}
+            for kpi, (mean_prediction, sd) in prediction['kpis'].items():
+                row[kpi] = mean_prediction
+                row[f'{kpi}_sd'] = sd
+            rows.append(row)
+
+        return pd.DataFrame(rows)
+
+    def save(self, filename = EMULATOR_FILE):
+        """
+        Method to save the fitted emulator to a numpy .npz file
+        """
+        arrays = {'model_version': np.array(self.model_version),
+                  'parameter_names': np.array(self.parameter_names),
+                  'lower': self.lower, 'upper': self.upper,
+                  'prior_precision': np.array(self.prior_precision),
+                  'training_params': np.array([[p[name] for name in self.parameter_names]
+                                               for p in self.training_params], dtype=float),
+                  'training_kpis': np.array([[k[kpi] for kpi in EMULATOR_KPIS]
+                                             for k in self.training_kpis], dtype=float)}
+        for kpi in EMULATOR_KPIS:
+            arrays[f'weights_{kpi}'] = self.weights[kpi]
+            arrays[f'covariance_{kpi}'] = self.covariance[kpi]
+            arrays[f'noise_variance_{kpi}'] = np.array(self.noise_variance[kpi])
+
+        np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename = EMULATOR_FILE):
+        """
+        Method to load an emulator saved with `save`
+
+        Gives a warning if the model code has changed since the emulator was fitted.
+
+        Returns
+        ---
+        A fitted Pathway_Emulator
+        """
+        with np.load(filename) as saved:
+            parameter_ranges = {str(name): (float(lowest), float(highest)) for name, lowest, highest
+                                in zip(saved['parameter_names'], saved['lower'], saved['upper'])}
+            emulator = cls(parameter_ranges, prior_precision=float(saved['prior_precision']))
+
+            emulator.training_params = [dict(zip(emulator.parameter_names, (int(v) for v in row)))
+                                        for row in saved['training_params']]
+            emulator.training_kpis = [dict(zip(EMULATOR_KPIS, row)) for row in saved['training_kpis']]
+            for kpi in EMULATOR_KPIS:
+                emulator.weights[kpi] = saved[f'weights_{kpi}']
+                emulator.covariance[kpi] = saved[f'covariance_{kpi}']
+                emulator.noise_variance[kpi] = float(saved[f'noise_variance_{kpi}'])
+
+            # (emulators saved before the model version was recorded were fitted to an unknown one)
+            emulator.model_version = str(saved['model_version']) if 'model_version' in saved else None
+
+        if emulator.is_out_of_date():
+            warnings.warn(f"The emulator in {filename} was fitted to a different (or unknown) "
+                          "version of the model (the files in MODEL_FILES have changed) - run "
+                          "`python SurgeryEmulator.py` to refit it")
+
+        return emulator
+
+
+def refit_emulator(number_of_points = 60, number_of_runs = g.number_of_runs,
+                   filename = EMULATOR_FILE, seed = None, result_store = None):
+    """
+    Function to run the simulation at a spread of training points and refit the emulator
+
+    This can take a long time, as it runs a full trial at every training point. If a seed and
+    a Result_Store are given, trials already in the store (e.g. from an earlier refit with
+    the same seed) are reused rather than run again.
+
+    Returns
+    ---
+    The fitted Pathway_Emulator (which has also been saved to filename)
+    """
+    # Imported here so that loading a saved emulator does not need the simulation itself
+    from SurgeryTrial import run_trial, replication_seeds
+
+    emulator = Pathway_Emulator()
+    training_params = emulator.sample_training_points(number_of_points, seed=seed)
+    trial_seeds = replication_seeds(seed, number_of_points)
+    training_kpis = []
+
+    filename = os.path.abspath(filename)
+    working_directory = os.getcwd()
+
+    # The simulation writes its results files to the current directory, so run the trials
+    # somewhere they will not overwrite the results of the Streamlit app
+    with tempfile.TemporaryDirectory() as trial_directory:
+        os.chdir(trial_directory)
+        try:
+            for i, params in enumerate(training_params):
+                print(f"Training point {i+1} of {number_of_points}: {params}")
+                trial_results_calculator = run_trial(number_of_runs=number_of_runs,
+                                                     seed=trial_seeds[i],
+                                                     result_store=result_store, **params)
+                training_kpis.append(trial_results_calculator.readout_kpis())
+        finally:
+            os.chdir(working_directory)
+
+    emulator.fit(training_params, training_kpis)
+    emulator.save(filename)
+
+    return emulator
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refit the emulator of the Neurosurgery RTT pathway simulation')
+    parser.add_argument('--points', type=int, default=60,
+                        help='number of parameter combinations to run the simulation at')
+    parser.add_argument('--runs', type=int, default=g.number_of_runs,
+                        help='number of simulation runs at each training point')
+    parser.add_argument('--output', default=EMULATOR_FILE,
+                        help='file to save the fitted emulator to')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed used to choose the training points and run the trials')
+    parser.add_argument('--store', default=None,
+                        help='folder of stored runs to reuse (and add to), if a seed is given')
+    args = parser.parse_args()
+
+    if args.store is not None:
+        from SurgeryResultStore import Result_Store
+        result_store = Result_Store(args.store)
+    else:
+        result_store = None
+
+    refit_emulator(number_of_points=args.points, number_of_runs=args.runs,
+                   filename=args.output, seed=args.seed, result_store=result_store)
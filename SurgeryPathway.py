@@ -5,13 +5,27 @@ import random
 import numpy as np
 import pandas as pd
 import csv
+import contextlib
+import os
 
 from SurgeryPatient import Patient
+from SurgeryPathwayGraph import build_pathway_graph, EXIT_STAGE
+from SurgeryCapacityCalendar import build_capacity_calendar
+from SurgeryDemandProfile import build_demand_profile
+from SurgeryQuantileSketch import Quantile_Sketch, save_sketches
+from SurgeryVariates import Variate_Source
+from SurgeryWaitingList import Waiting_List, URGENT
+from SurgerySteadyState import steady_state_converged
+from SurgeryWaitTimesStore import Wait_Times_Store
 from global_params import g
+from profiling import profile_section
 
 import logging
 # log = logging.getLogger(__name__)
 
+# Waits (in weeks) over which patients still waiting are counted as long waiters
+LONG_WAIT_THRESHOLDS = [18, 52, 65]
+
 from utils import setup_logger
 log = setup_logger(level=logging.INFO)  # Configure global logging
 
@@ -28,6 +42,11 @@ class Neurosurgery_Pathway:
     referrals_per_week: int, default is `g.referrals_per_week`
         Average number of new referrals received to this pathway per week.
 
+    demand_profile: list or dict, default is None
+        Referral rate that changes over time, instead of referrals_per_week: a list of weekly
+        rates that repeats (e.g. 52 weeks of seasonal demand), or a dictionary of 'weeks' and
+        'rates' that the rate changes linearly between (see SurgeryDemandProfile.py).
+
     surg_clinic_per_week: int, default is `g.surg_clinic_per_week`
         Number of surgical clinics per week. Default is `g.surg_clinic_per_week`.
 
@@ -44,10 +63,9 @@ class Neurosurgery_Pathway:
         Number of trauma lists per week. Default is `g.trauma_list_per_week`.
 
     weekly_extra_patients: int, default is `g.weekly_extra_patients`
-        Number of extra patients for trauma lists per week.
-
-    prob_needs_surgery: float, default is `g.prob_needs_surgery`
-        Probability a patient needs surgery post-clinic.
+        Number of extra patients for each trauma list. The extra patients (for all
+        trauma_list_per_week lists) take places from the theatre lists - or any other clock stop
+        stages of the pathway graph - every week.
 
     fill_non_admitted_queue: int, default is `g.fill_non_admitted_queue`.
         Initial non-admitted queue size (patients who are waiting for clinic appointment and potentially surgery).
@@ -60,20 +78,98 @@ class Neurosurgery_Pathway:
         Note that the simulation run may exceed this duration so that the full journey of all patients
         who enter the simulation prior to the point specified by sim_duration will complete their
         full journies.
+
+    max_drain_weeks: int, default is 520
+        Number of weeks after sim_duration to end the simulation at if patients who entered
+        before sim_duration are still in the pathway. If None, the simulation carries on until
+        they have all left.
+
+    drain_mode: str, default is 'patients'
+        How the referrals made after sim_duration (which are not tracked, but add to the load
+        on the pathway while the tracked patients finish their journeys) are modelled
+        - 'patients': as patients, like the referrals before sim_duration
+        - 'capacity': as weekly numbers of referrals, which only use up the capacity of each
+          stage that tracked patients don't need (see serve_stage). This is much quicker
+          when the drain is long, and gives the same results when patients never go back to an
+          earlier stage and no referrals are urgent. If patients do go back, untracked patients
+          waiting for that stage don't delay them, as they would in 'patients' mode. If some
+          referrals are urgent (prob_urgent > 0), urgent untracked patients don't overtake
+          routine tracked patients, as they would in 'patients' mode.
+
+    pathway_graph: Pathway_Graph or dict, default is None
+        The stages of the pathway and the routes between them (see SurgeryPathwayGraph.py).
+        If None, the pathway is a surgical clinic followed by theatre, with the capacities
+        given by the clinic and theatre parameters above (which are not used otherwise).
+
+    capacity_calendar: dict, default is None
+        Changes to the number of sessions of each stage from week to week: repeating session
+        patterns and bank holidays (see SurgeryCapacityCalendar.py). If None, each stage holds
+        the same number of sessions every week.
+
+    service_mode: str, default is 'continuous'
+        How the stages of the pathway see patients
+        - 'continuous': patients are seen one at a time, spread evenly through the week
+        - 'session': each stage holds its sessions (clinics, theatre lists) evenly through the
+          week, and each session sees up to the stage's capacity of patients at once. This is
+          closer to how the pathway works, and much quicker to simulate.
+
+    prob_urgent: float, default is 0.0
+        Probability a new referral is urgent. Urgent patients are seen before routine patients
+        at every stage of the pathway (see SurgeryWaitingList.py).
+
+    reneging_rate: float, default is 0.0
+        Rate (per week) at which patients waiting for a stage leave the waiting list without
+        being seen, e.g. because they are removed when the list is validated or are treated
+        elsewhere. Each time a patient joins a waiting list, the time until they would leave is
+        sampled from an exponential distribution with a mean of 1 / reneging_rate weeks. Their
+        RTT clock stops when they leave, but their wait is not included in the wait times (which
+        are of patients who completed the pathway).
+
+    random_seed: int, default is None
+        Seed for the random numbers used in this run, so that a run can be reproduced exactly.
+        If None, a different (unrepeatable) set of random numbers is used each time.
+
+    antithetic: bool, default is False
+        If True, use the antithetic (mirror image) of the random numbers given by random_seed.
+        See SurgeryVariates.Variate_Source.
+
+    stop_at_steady_state: bool, default is False
+        If True, stop adding tracked patients as soon as the mean wait has settled to a steady
+        state (see `monitor_steady_state`), rather than carrying on until sim_duration. The
+        queue numbers at the end of the run are then those at the week the run stopped at.
+
+    steady_state_precision: float, default is 0.05
+        How precisely the steady state mean wait must be known before the run stops early:
+        the half-width of its 95% confidence interval as a fraction of the mean.
+
+    output_dir: str, default is '.'
+        Folder to write the results files for this run to.
     """
 
     def __init__(self, run_number,
                  referrals_per_week = g.referrals_per_week,
+                 demand_profile = None,
                  surg_clinic_per_week = g.surg_clinic_per_week,
                  surg_clinic_capacity = g.surg_clinic_appts,
                  theatre_list_per_week = g.theatre_list_per_week,
                  theatre_list_capacity = g.theatre_list_capacity,
                  trauma_list_per_week = g.trauma_list_per_week,
                  weekly_extra_patients = g.weekly_extra_patients,     
-                 prob_needs_surgery = g.prob_needs_surgery,
                  fill_non_admitted_queue = g.fill_non_admitted_queue,
                  fill_admitted_queue = g.fill_admitted_queue,
-                 sim_duration = g.sim_duration
+                 sim_duration = g.sim_duration,
+                 max_drain_weeks = 52 * 10,
+                 drain_mode = 'patients',
+                 pathway_graph = None,
+                 capacity_calendar = None,
+                 service_mode = 'continuous',
+                 prob_urgent = 0.0,
+                 reneging_rate = 0.0,
+                 random_seed = None,
+                 antithetic = False,
+                 stop_at_steady_state = False,
+                 steady_state_precision = 0.05,
+                 output_dir = '.'
                  ):
 
         #setup environment
@@ -82,10 +178,25 @@ class Neurosurgery_Pathway:
         self.end_of_sim = self.env.event()
         self.run_number = run_number
         self.sim_duration = sim_duration
+        self.max_drain_weeks = max_drain_weeks
+        self.output_dir = output_dir
+
+        # Each run has its own source of random numbers, so that runs done in parallel (or
+        # one after another) don't share - and can't disturb - each other's random numbers
+        self.variates = Variate_Source(random_seed, antithetic=antithetic)
 
         self.active_entities = 0
         self.patient_counter = 0
 
+        # Referral time of each new (not prefill) tracked patient who is still in the pathway,
+        # in order of referral
+        self.referrals_in_pathway = {}
+
+        self.stop_at_steady_state = stop_at_steady_state
+        self.steady_state_precision = steady_state_precision
+        # week the run stopped adding tracked patients early (if it did)
+        self.steady_state_week = None
+
         # Add an empty list to store our event logs in
         self.event_log = []
 
@@ -112,6 +223,9 @@ class Neurosurgery_Pathway:
         # Calculate the average inter-arrival time between referrals
         self.referral_interval = 1 / referrals_per_week
 
+        # The referral rate over time, if it isn't constant (None otherwise)
+        self.demand_profile = build_demand_profile(demand_profile)
+
         # ---------------- #
         # Surgical Clinic  #
         # ---------------- #
@@ -132,46 +246,63 @@ class Neurosurgery_Pathway:
         self.theatre_total_slots = self.theatre_list_per_week * self.theatre_list_capacity
 
         # calculate total extra patients added on to trauma lists per week
-        # TODO: SR NOTE: Not sure I fully understand this one
+        # These patients aren't modelled individually: they take away from the planned theatre
+        # capacity, through the capacity calendar (see below)
         self.weekly_extra_patients = weekly_extra_patients * trauma_list_per_week
 
-        # calculate equivalent extra patients per non trauma list
-        # SR NOTE: Are these patients ones who exist in the model?
-        # If not, we may want to count them in some way in the results, but I wonder
-        # if they actually need to be excluded
-
-        # TODO: REINCORPORATE THIS! Temporarily commented out to get core theatre slots working
-        # self.extra_patients_adjusted = self.weekly_extra_patients / theatre_list_per_week
-
-        # TODO: REINCORPORATE THIS! Temporarily commented out to get core theatre slots working
-        # calculate new theatre list capacity
-        # self.adjusted_theatre_capacity = theatre_list_capacity + self.extra_patients_adjusted
-        # SR NOTE: assume these patients are actually taking away from the planned capacity?
-        # self.adjusted_theatre_capacity = theatre_list_capacity - self.extra_patients_adjusted
-
-        # TODO: REINCORPORATE THIS! Temporarily commented out to get core theatre slots working
-        # here use adjusted theatre capacity
-        # self.theatre_case_duration = 1 / self.adjusted_theatre_capacity
-
-
         self.theatre_case_duration = 1 / self.theatre_total_slots
         # this is used for determining the gap between theatre cases in the model
         # TODO: Does this need adjusting to take away theatre_case_duration? At moment
         # feels like it might effectively be double counting
         # self.theatre_list_interval = 1 / theatre_list_per_week
 
-        # The probability that a patient, after going to the clinic, will progress to the
-        # step of having surgery
-        self.prob_needs_surgery = prob_needs_surgery
+        # The probability that a new referral is urgent, and the rate at which waiting patients
+        # leave the waiting lists without being seen
+        self.prob_urgent = prob_urgent
+        self.reneging_rate = reneging_rate
+        # number of tracked patients who left a waiting list without being seen
+        self.reneged_patients = 0
+
+        # ---------------- #
+        # Pathway stages   #
+        # ---------------- #
+
+        pathway_graph = build_pathway_graph(pathway_graph, surg_clinic_per_week, surg_clinic_capacity,
+                                            theatre_list_per_week, theatre_list_capacity)
+        self.pathway_graph = pathway_graph
+
+        if fill_admitted_queue > 0 and pathway_graph.admitted_entry_stage is None:
+            raise ValueError("The pathway has no admitted stage for the admitted queue to be prefilled into")
+
+        # The places at each stage in each week, which the processes seeing each stage's
+        # patients look up rather than being blocked by other processes (see
+        # SurgeryCapacityCalendar.py). The table is extended if the drain goes on for longer.
+        self.capacity_calendar = build_capacity_calendar(
+            capacity_calendar, pathway_graph, self.weekly_extra_patients,
+            sim_duration + (max_drain_weeks or 0) + 1)
+
+        if service_mode not in ['continuous', 'session']:
+            raise ValueError(f"Unknown service mode '{service_mode}'")
+        self.service_mode = service_mode
 
         #setup resources
 
-        # Set up a PriorityResource with a capacity of 1.
-        # NOTE: At present their is no concept of priority within the clinic or theatre lists
-        # However, the use of PriorityResource is so that a 'blocking' process with a higher
-        # priority can come in to model the unavailability of the clinic and theatre
-        self.surg_clinic = simpy.PriorityResource(self.env, capacity=1)
-        self.theatres = simpy.PriorityResource(self.env, capacity=1)
+        # The patients waiting for each stage of the pathway, who are seen by priority class
+        # and then in the order they joined (see SurgeryWaitingList.py). Each stage's patients
+        # are seen by a single process - serve_stage, or run_sessions in session mode - which
+        # takes them off the stage's waiting list.
+        self.stage_waiting_lists = [Waiting_List() for _ in range(pathway_graph.number_of_stages)]
+
+        if drain_mode not in ['patients', 'capacity']:
+            raise ValueError(f"Unknown drain mode '{drain_mode}'")
+        self.drain_mode = drain_mode
+
+        # In 'capacity' drain mode, the number of untracked patients waiting for each stage
+        self.untracked_waiting = [0] * pathway_graph.number_of_stages
+
+        # The events that wake each stage's serve_stage process when patients (tracked or
+        # untracked) arrive while it has no one to see
+        self.patient_arrived = [self.env.event() for _ in range(pathway_graph.number_of_stages)]
 
         #variables to keep track of numbers in queues
         # SR NOTE 18/1/25: These were originally named
@@ -184,8 +315,30 @@ class Neurosurgery_Pathway:
         # '#variables to keep track of numbers in queues'
         # I have updated these to have the name '_length' and used them
         # where seems appropriate for keeping track of queues
-        self.clinic_queue_length = 0
-        self.theatre_queue_length = 0
+        # The number waiting for each stage is kept - see the clinic_queue_length and
+        # theatre_queue_length properties for the totals of each waiting list
+        self.stage_queue_lengths = [0] * pathway_graph.number_of_stages
+
+        # Long waiters on the waiting list over time
+        # For each stage, the number of patients waiting for it with their RTT clock still
+        # running, by week of referral (prefill patients count as referred in week 0), and the
+        # number of them waiting over each of LONG_WAIT_THRESHOLDS weeks. These are updated as
+        # patients join and leave each queue, and at each week boundary the referrals from
+        # the week that has just passed each threshold are added - see record_long_waiters.
+        self.waiting_by_referral_week = [[0] * (sim_duration + 2)
+                                         for _ in range(pathway_graph.number_of_stages)]
+        self.long_waiters = [[0] * len(LONG_WAIT_THRESHOLDS)
+                             for _ in range(pathway_graph.number_of_stages)]
+        # the last week boundary the long waiters were counted at
+        self.long_waiters_week = 0
+        # the counts at the end of each week, by stage
+        self.long_waiters_over_time = []
+
+        # Sketches of the waits of the tracked patients (see SurgeryQuantileSketch.py): the
+        # time each spent waiting for each stage, and their overall RTT wait. These give the
+        # percentiles of the waits, and can be merged across runs.
+        self.wait_sketches = {name: Quantile_Sketch()
+                              for name in pathway_graph.stage_names + ['overall']}
 
         # Create dataframe with queue times
         # NOTE: Later in the model, when writing data to this dataframe, it is only used
@@ -205,19 +358,88 @@ class Neurosurgery_Pathway:
         # use these as-is, or use them to generate a distribution from which you sample wait times
         # at simulation start for the prefill patients.
 
-        data = {'time_entered_pathway': [],
-                'overall_queue_time': []}
-        self.queue_times_df = pd.DataFrame(data)
+        # The queue times are collected in lists (appending to a list is much quicker than
+        # adding a row to a dataframe) - see the queue_times_df property for them as a dataframe
+        self.queue_times = {'time_entered_pathway': [],
+                            'overall_queue_time': []}
+
+    @classmethod
+    def from_scenario(cls, run_number, scenario_config, **run_settings):
+        """
+        Method to create the model for a run of a scenario
+
+        Parameters
+        ------
+
+        run_number: int
+            Unique identifier for the simulation run.
+
+        scenario_config: Scenario_Config
+            The scenario's parameters (see SurgeryScenario.py).
+
+        **run_settings:
+            The run's random_seed, antithetic and output_dir, as above.
+
+        Returns
+        ---
+        A Neurosurgery_Pathway
+        """
+        return cls(run_number, **scenario_config.pathway_params(), **run_settings)
+
+    @property
+    def clinic_queue_length(self):
+        """
+        The number of patients waiting for the non-admitted stages of the pathway (e.g. clinic)
+        """
+        return sum(length for length, waiting_list
+                   in zip(self.stage_queue_lengths, self.pathway_graph.waiting_lists)
+                   if waiting_list == 'non_admitted')
+
+    @property
+    def theatre_queue_length(self):
+        """
+        The number of patients waiting for the admitted stages of the pathway (e.g. theatre)
+        """
+        return sum(length for length, waiting_list
+                   in zip(self.stage_queue_lengths, self.pathway_graph.waiting_lists)
+                   if waiting_list == 'admitted')
+
+    @property
+    def queue_times_df(self):
+        """
+        The queue times stored so far, as a dataframe with a row per patient
+        """
+        return pd.DataFrame(self.queue_times)
+
+    def determine_route(self, patient):
+        """
+        Method to choose every stage a patient will go to, when they join the pathway
+
+        All of the patient's routing random numbers are drawn now, in the order patients are
+        referred (from a stream of their own for the prefill patients), rather than as they
+        are seen at each stage. So with the same seed and pathway graph, each patient takes the
+        same route in every scenario (common random numbers), however the queues (and so the
+        order patients are seen in) differ.
 
-    def determine_surgery(self, patient):
+        The patient needs surgery if their route reaches a clock stop stage (e.g. theatre).
+        """
+        graph = self.pathway_graph
+        first_stage = self.first_stage(patient)
+        if patient.from_prefills:
+            patient.route = graph.plan_route(first_stage, self.variates.prefill_routing_uniform)
+        else:
+            patient.route = graph.plan_route(first_stage, self.variates.routing_uniform)
+        patient.needs_surgery = any(graph.clock_stops[stage]
+                                    for stage in [first_stage] + patient.route[:-1])
+
+    def determine_priority(self, patient):
         """
-        Method to determine if patient needs surgery
+        Method to determine if a new referral is urgent
 
-        If randomly generated number from the uniform distribution is below the globally defined
-        probability of needing surgery, patient will be set as needing surgery
+        A random number is only used if some referrals are urgent (prob_urgent > 0).
         """
-        if random.uniform(0,1) < self.prob_needs_surgery:
-            patient.needs_surgery = True
+        if self.prob_urgent > 0 and self.variates.priority_uniform() < self.prob_urgent:
+            patient.priority = URGENT
 
     def determine_end_sim(self, patient):
         """
@@ -263,6 +485,7 @@ class Neurosurgery_Pathway:
             # so will begin at an earlier point in the pathway
             pt.already_seen_clinic = True
             pt.from_prefills = True
+            self.determine_route(pt)
 
             self.event_log.append(
                 {'patient': self.patient_counter, 'event_type': 'arrival_departure',
@@ -272,11 +495,13 @@ class Neurosurgery_Pathway:
                  }
             )
 
-            # Get simpy env to run enter_pathway method with this patient
-            self.env.process(self.enter_pathway(pt))
+            # Start the patient on the pathway
+            self.start_pathway(pt)
 
             # Need to have yield statement so code works - timeout for zero time
-            yield self.env.timeout(0)
+            # (in session mode all the prefill patients are queued before the first sessions)
+            if self.service_mode == 'continuous':
+                yield self.env.timeout(0)
 
         log.debug(f"Prefilling non-admitted queues with {self.fill_non_admitted_queue} patients")
 
@@ -290,6 +515,7 @@ class Neurosurgery_Pathway:
             # Create new patient
             pt = Patient(self.patient_counter)
             pt.from_prefills = True
+            self.determine_route(pt)
             self.event_log.append(
                 {'patient': self.patient_counter, 'event_type': 'arrival_departure',
                  'event': 'arrival', 'time': self.env.now,
@@ -302,11 +528,12 @@ class Neurosurgery_Pathway:
             # So these patients in the non-admitted queue have
             # the sttribute *already_seen_clinic*=False
 
-            # Get simpy env to run enter_pathway method with this patient
-            self.env.process(self.enter_pathway(pt))
+            # Start the patient on the pathway
+            self.start_pathway(pt)
 
             # need to have yield statement so code works - timeout for zero time
-            yield self.env.timeout(0)
+            if self.service_mode == 'continuous':
+                yield self.env.timeout(0)
 
     def generate_referrals(self):
         """
@@ -315,11 +542,24 @@ class Neurosurgery_Pathway:
         These are new patients who join the waiting list while the simulation is running.
         'Prefill' patients - those who were on the waiting list at the time the simulation
         commences - are handled in separate methods.
+
+        With a constant referral rate, the first patient is referred at the start of the
+        simulation. With a demand profile, every referral time (including the first) comes from
+        the profile (see Variate_Source.referral_times).
         """
 
+        if self.demand_profile is not None:
+            referral_times = self.variates.referral_times(self.demand_profile)
+            yield self.env.timeout(next(referral_times))
+
         #keep generating indefinitely (until simulation ends)
         while True:
 
+            # In 'capacity' drain mode, referrals after sim_duration are only counted
+            if self.drain_mode == 'capacity' and self.env.now >= self.sim_duration:
+                self.env.process(self.generate_untracked_referrals())
+                return
+
             # Increment patient counter by 1
             self.patient_counter += 1
 
@@ -327,8 +567,9 @@ class Neurosurgery_Pathway:
             pt = Patient(self.patient_counter)
             log.debug(f"Week {self.env.now:.3f}: Adding Patient {self.patient_counter} to the simulation")
 
-            # Decide if the patient needs surgery
-            self.determine_surgery(pt)
+            # Decide the patient's route through the pathway, and if they are urgent
+            self.determine_route(pt)
+            self.determine_priority(pt)
             # Determine if the patient was generated before the end of the simulation or not
             self.determine_end_sim(pt)
 
@@ -336,6 +577,7 @@ class Neurosurgery_Pathway:
             # Note that the simulation will not terminate until active entities reaches 0!
             if pt.before_end_sim == True:
                 self.active_entities += 1
+                self.referrals_in_pathway[pt.id] = self.env.now
             self.event_log.append(
                 {'patient': self.patient_counter, 'event_type': 'arrival_departure',
                  'event': 'arrival', 'time': self.env.now,
@@ -344,160 +586,185 @@ class Neurosurgery_Pathway:
                  }
             )
 
-            # Get simpy env to run enter_pathway method with this patient
-            self.env.process(self.enter_pathway(pt))
+            # Start the patient on the pathway
+            self.start_pathway(pt)
             #print(f'Patient {pt.id} has been generated and entered the clinic queue')
 
             # Randomly sample time to next referral
-            sampled_interref_time = random.expovariate(1.0/self.referral_interval)
+            if self.demand_profile is None:
+                sampled_interref_time = self.variates.interarrival_time(self.referral_interval)
+            else:
+                sampled_interref_time = next(referral_times) - self.env.now
             log.debug(f"Next patient arriving in {sampled_interref_time:.3f} weeks ({sampled_interref_time * 24 * 60:.2f} minutes)")
 
             # Freeze until time has elapsed
             yield self.env.timeout(sampled_interref_time)
 
-    def enter_pathway(self, patient):
+    def start_pathway(self, patient):
         """
-        Method to put a single patient through the neurosurgery pathway.
+        Method to start a patient's journey through the pathway
 
-        If patients have not already been seen in the clinic, they will first begin queueing
-        for a surgery clinic, which uses the surg_clinic resource.
+        The patient just joins the waiting list for their first stage. Each stage's process
+        (serve_stage, or run_sessions in 'session' service mode) moves them on from there, so
+        patients don't need a simpy process of their own.
+        """
+        patient.time_entered_pathway = self.env.now
+        self.queue_for_stage(patient, self.first_stage(patient))
 
-        Then, all patients who have been passed to this method will progress to entering the
-        theatre queue.
+    def first_stage(self, patient):
+        """
+        Method to return the stage of the pathway graph a patient starts at
 
-        Finally, patients who were **not** a 'prefill' and who complete their journey before
-        the simulation ends will be added to the queue times.
+        Patients who have not already been seen in the clinic start at the entry stage of the
+        pathway graph (the surgical clinic by default), and those who have start at its
+        admitted entry stage (theatre by default).
         """
+        if patient.already_seen_clinic:
+            return self.pathway_graph.admitted_entry_stage
+        return self.pathway_graph.entry_stage
 
-        if not patient.already_seen_clinic:
-            self.event_log.append(
-                {'patient': patient.id, 'event_type': 'queue',
-                 'event': 'queue_clinic', 'time': self.env.now,
-                 'prefill': patient.from_prefills,
-                 'prefill_already_seen_clinic': patient.already_seen_clinic,
-                 'before_end_sim': patient.before_end_sim,
-                 'surgery_required': patient.needs_surgery
-                 }
-            )
-            # record start of queue time and add to tracker
-            start_q_clinic = self.env.now
-            if self.env.now <= self.sim_duration:
-                # self.fill_non_admitted_queue += 1 # SR 16/1 have commented out as think incorrect attribute
-                self.clinic_queue_length += 1
-            #print(f'Patient {patient.id} is waiting for clinic')
-
-            # request clinic resource
-            with self.surg_clinic.request() as req:
-                yield req
-                self.event_log.append(
-                    {'patient': patient.id, 'event_type': 'resource_use',
-                    'event': 'surg_clinic_begins', 'time': self.env.now,
-                    'resource_id': 1,
-                    'prefill': patient.from_prefills,
-                    'prefill_already_seen_clinic': patient.already_seen_clinic,
-                    'before_end_sim': patient.before_end_sim,
-                    'surgery_required': patient.needs_surgery
-                    }
-                )
-
-                # record end of queue time and add to tracker
-                end_q_clinic = self.env.now
-
-                if self.env.now <= self.sim_duration:
-                    # self.fill_non_admitted_queue -= 1 # SR 16/1 have commented out as think incorrect attribute
-                    self.clinic_queue_length -= 1
-
-                # record total queue time
-                # patient.clinic_q_time = end_q_clinic - start_q_clinic # SR this was incorrectly _q_ instead of _queue_
-                patient.clinic_queue_time = end_q_clinic - start_q_clinic
-
-                # freeze for clinic appointment duration
-                yield self.env.timeout(self.surg_clinic_duration)
-
-                self.event_log.append(
-                    {'patient': patient.id, 'event_type': 'resource_use_end',
-                    'event': 'surg_clinic_complete', 'time': self.env.now,
-                    'resource_id': 1,
-                    'prefill': patient.from_prefills,
-                    'prefill_already_seen_clinic': patient.already_seen_clinic,
-                    'before_end_sim': patient.before_end_sim,
-                    'surgery_required': patient.needs_surgery
-                    }
-                )
-                # log.debug(f'Patient {patient.id} has left the clinic queue at {self.env.now:.3f}')
-
-        # Enter queue for theatres
-        # Record start of queue time and add to tracker
-        start_q_theatres = self.env.now
+    def join_stage(self, patient, stage):
+        """
+        Method to record a patient joining the queue for a stage
+        """
         self.event_log.append(
-                {'patient': patient.id, 'event_type': 'queue',
-                 'event': 'queue_theatre', 'time': self.env.now,
-                 'prefill': patient.from_prefills,
-                 'prefill_already_seen_clinic': patient.already_seen_clinic,
-                 'before_end_sim': patient.before_end_sim,
-                 'surgery_required': patient.needs_surgery
-                 }
-            )
+            {'patient': patient.id, 'event_type': 'queue',
+             'event': self.pathway_graph.queue_events[stage], 'time': self.env.now,
+             'prefill': patient.from_prefills,
+             'prefill_already_seen_clinic': patient.already_seen_clinic,
+             'before_end_sim': patient.before_end_sim,
+             'surgery_required': patient.needs_surgery
+             }
+        )
+        # record start of queue time and add to tracker
+        patient.stage_queue_start = self.env.now
+        if self.env.now <= self.sim_duration:
+            self.stage_queue_lengths[stage] += 1
+            if not patient.clock_stopped:
+                self.count_waiting(patient, stage, 1)
 
+    def start_stage(self, patient, stage):
+        """
+        Method to record a patient being seen at a stage (leaving its queue)
+        """
+        graph = self.pathway_graph
+        self.event_log.append(
+            {'patient': patient.id, 'event_type': 'resource_use',
+             'event': graph.begin_events[stage], 'time': self.env.now,
+             'resource_id': 1,
+             'prefill': patient.from_prefills,
+             'prefill_already_seen_clinic': patient.already_seen_clinic,
+             'before_end_sim': patient.before_end_sim,
+             'surgery_required': patient.needs_surgery
+             }
+        )
+
+        # record end of queue time and take off tracker
         if self.env.now <= self.sim_duration:
-            #self.fill_admitted_queue += 1 # SR 16/1 have commented out as think incorrect attribute
-            self.theatre_queue_length += 1
+            self.stage_queue_lengths[stage] -= 1
+        if patient.counted_waiting:
+            self.count_waiting(patient, stage, -1)
+
+        stage_name = graph.stage_names[stage]
+        patient.stage_queue_times[stage_name] = (patient.stage_queue_times.get(stage_name, 0)
+                                                 + self.env.now - patient.stage_queue_start)
+
+        # The RTT clock stops when the patient is first seen at a clock stop stage
+        # (e.g. admitted for surgery), or else at the last stage they are seen at
+        # (e.g. discharged after clinic)
+        if not patient.clock_stopped:
+            patient.overall_queue_time = self.env.now - patient.time_entered_pathway
+            patient.clock_stopped = graph.clock_stops[stage]
+
+    def count_waiting(self, patient, stage, change):
+        """
+        Method to add (change=1) or remove (change=-1) a patient from the long waiter counts
+        of the stage they are waiting for
+        """
+        referral_week = int(patient.time_entered_pathway)
+        self.waiting_by_referral_week[stage][referral_week] += change
+        for i, threshold in enumerate(LONG_WAIT_THRESHOLDS):
+            # referrals from before week (current week - threshold) have waited over threshold weeks
+            if referral_week < self.long_waiters_week - threshold:
+                self.long_waiters[stage][i] += change
+        patient.counted_waiting = change > 0
+
+    def record_long_waiters(self):
+        """
+        Method to record the number of patients on the waiting list, and the number waiting
+        over each of LONG_WAIT_THRESHOLDS weeks, at the end of each week until sim_duration
 
-        # Request theatres resource
-        with self.theatres.request() as req:
-            yield req
-            self.event_log.append(
-                    {'patient': patient.id, 'event_type': 'resource_use',
-                    'event': 'theatre_begins', 'time': self.env.now, 'resource_id': 1,
-                    'prefill': patient.from_prefills,
-                    'prefill_already_seen_clinic': patient.already_seen_clinic,
-                    'before_end_sim': patient.before_end_sim,
-                    'surgery_required': patient.needs_surgery
-                    }
-                )
-
-            # Record end of queue time and add to tracker
-            end_q_theatres = self.env.now
-
-            if self.env.now <= self.sim_duration:
-                #self.fill_admitted_queue -= 1 # SR 16/1 have commented out as think incorrect attribute
-                self.theatre_queue_length -= 1
-
-            # Record theatre queue time and overall queue time
-            # TODO: SR NOTE: For consistency with later results recording, should this also check
-            # whether the simulation duration has elapsed?
-            if not patient.from_prefills:
-                patient.theatre_queue_time = end_q_theatres - start_q_theatres
-                patient.overall_queue_time = end_q_theatres - start_q_clinic
-                patient.time_entered_pathway = start_q_clinic
-
-            # Freeze for theatre case duration
-            yield self.env.timeout(self.theatre_case_duration)
-            self.event_log.append(
-                    {'patient': patient.id, 'event_type': 'resource_use_end',
-                    'event': 'theatre_complete', 'time': self.env.now, 'resource_id': 1,
-                    'prefill': patient.from_prefills,
-                    'prefill_already_seen_clinic': patient.already_seen_clinic,
-                    'before_end_sim': patient.before_end_sim,
-                    'surgery_required': patient.needs_surgery
-                    }
-                )
-
-            # Decrement counter if before end sim patient
-            # Note that the number of active entities are tracked to determine when the
-            # simulation should terminate. However, patients are only added to the count of
-            # active entities if they were a prefill or generated during the initial simulation
-            # runtime.
-            if patient.before_end_sim == True:
-                self.active_entities -= 1
+        Only the referrals from one week pass each threshold at each week boundary, so the
+        counts are brought up to date by adding them, rather than by going through every
+        patient waiting.
+        """
+        while self.env.now + 1 <= self.sim_duration:
+            yield self.env.timeout(1)
+            week = int(round(self.env.now))
+            self.long_waiters_week = week
+
+            for stage in range(self.pathway_graph.number_of_stages):
+                waiting_by_referral_week = self.waiting_by_referral_week[stage]
+                long_waiters = self.long_waiters[stage]
+                for i, threshold in enumerate(LONG_WAIT_THRESHOLDS):
+                    if week - threshold - 1 >= 0:
+                        long_waiters[i] += waiting_by_referral_week[week - threshold - 1]
+
+                self.long_waiters_over_time.append(
+                    [week, self.pathway_graph.stage_names[stage], sum(waiting_by_referral_week)]
+                    + long_waiters)
+
+    def complete_stage(self, patient, stage):
+        """
+        Method to record a patient's appointment / case at a stage finishing
+
+        Returns
+        ---
+        The stage the patient goes to next (or EXIT_STAGE if they leave the pathway), from the
+        route chosen when they joined the pathway (see determine_route)
+        """
+        graph = self.pathway_graph
+        self.event_log.append(
+            {'patient': patient.id, 'event_type': 'resource_use_end',
+             'event': graph.complete_events[stage], 'time': self.env.now,
+             'resource_id': 1,
+             'prefill': patient.from_prefills,
+             'prefill_already_seen_clinic': patient.already_seen_clinic,
+             'before_end_sim': patient.before_end_sim,
+             'surgery_required': patient.needs_surgery
+             }
+        )
+
+        next_stage = patient.route[patient.stages_completed]
+        patient.stages_completed += 1
+        return next_stage
+
+    def leave_pathway(self, patient, reneged = False):
+        """
+        Method to record a patient leaving the pathway having completed all of their activities
+        (or, if reneged, having left a waiting list without being seen - see renege)
+        """
+        # Decrement counter if before end sim patient
+        # Note that the number of active entities are tracked to determine when the
+        # simulation should terminate. However, patients are only added to the count of
+        # active entities if they were a prefill or generated during the initial simulation
+        # runtime.
+        if patient.before_end_sim == True:
+            self.active_entities -= 1
+            self.check_end_of_sim()
 
         # Add patient to queue times dataframe
         # NOTE - only patients who were **not prefills** and who were
         # TODO - though it will make your dataframe bigger, you may wish at some point to switch
         # to recording all patients in your dataframe, but add additional columns that log whether
         # they were prefill patients and whether they were added before the end of the simulation
+        # Patients who reneged didn't complete the pathway, so are only counted
         if not patient.from_prefills and patient.before_end_sim == True:
-            self.store_queue_times(patient)
+            if reneged:
+                self.reneged_patients += 1
+            else:
+                self.store_queue_times(patient)
+            del self.referrals_in_pathway[patient.id]
 
         # Make a note of the time the patient leaves the system having completed all of their
         # activities
@@ -511,56 +778,203 @@ class Neurosurgery_Pathway:
                  }
             )
 
-    # SR NOTE 17/1: Have commented these out for now as taken a slightly different approach to
-    # getting the simulation putting the correct number of people through the clinics per week
-    # def clinic_unavail(self):
-    #     """
-    #     Method to model interval between clinic appointments
+    def queue_for_stage(self, patient, stage):
+        """
+        Method to add a patient to the waiting list for a stage, or take them out of the
+        pathway if they have finished
+        """
+        if stage == EXIT_STAGE:
+            self.leave_pathway(patient)
+            return
 
-    #     Sends in a high priority resource that will hog the clinic until
-    #     the next case should be sent in (modelling unavailability e.g. overnight
-    #     or otherwise)
-    #     """
+        self.join_stage(patient, stage)
+        self.stage_waiting_lists[stage].add(patient, patient.priority)
 
-    #     while True:
+        # wake the stage's serve_stage process if it is waiting for patients
+        if not self.patient_arrived[stage].triggered:
+            self.patient_arrived[stage].succeed()
 
-    #         # Freeze clinic_unavail function for duration of clinic
-    #         yield self.env.timeout(1)
+        if self.reneging_rate > 0:
+            # the patient leaves the list at this time, unless they have been seen by then
+            reneging_time = self.variates.reneging_time(1 / self.reneging_rate)
+            joined = self.env.now
+            self.env.timeout(reneging_time).callbacks.append(
+                lambda event: self.renege(patient, stage, joined))
 
-    #         # Request clinic with max priority and hold until next clinic
-    #         with self.surg_clinic.request(priority=-1) as req:
-    #             # Freeze the function until the request can be met (this
-    #             # ensures that the last patient in clinic will be seen)
-    #             yield req
+    def renege(self, patient, stage, joined):
+        """
+        Method to take a patient off the waiting list for a stage without being seen, and out
+        of the pathway
 
-    #             yield self.env.timeout(self.surg_clinic_interval)
+        Parameters
+        ------
 
-    # def theatres_unavail(self):
-    #     """
-    #     Method to model interval between theatre lists
+        joined: float
+            The time the patient joined the waiting list. Nothing is done if they have been seen
+            since (or have left the list and joined it again).
+        """
+        if patient.stage_queue_start != joined:
+            return
+        if self.stage_waiting_lists[stage].remove(patient.id) is None:
+            return
+
+        self.event_log.append(
+            {'patient': patient.id, 'event_type': 'queue',
+             'event': 'renege', 'time': self.env.now,
+             'prefill': patient.from_prefills,
+             'prefill_already_seen_clinic': patient.already_seen_clinic,
+             'before_end_sim': patient.before_end_sim,
+             'surgery_required': patient.needs_surgery
+             }
+        )
+
+        # take off the queue trackers, as when seen (see start_stage)
+        if self.env.now <= self.sim_duration:
+            self.stage_queue_lengths[stage] -= 1
+        if patient.counted_waiting:
+            self.count_waiting(patient, stage, -1)
 
-    #     Sends in a high priority resource that will hog the theatre until
-    #     the next case should be sent in (modelling unavailability e.g. overnight
-    #     or otherwise)
-    #     """
-    #     while True:
+        stage_name = self.pathway_graph.stage_names[stage]
+        patient.stage_queue_times[stage_name] = (patient.stage_queue_times.get(stage_name, 0)
+                                                 + self.env.now - patient.stage_queue_start)
+        if not patient.clock_stopped:
+            patient.overall_queue_time = self.env.now - patient.time_entered_pathway
+            patient.clock_stopped = True
+
+        self.leave_pathway(patient, reneged=True)
+
+    def serve_stage(self, stage):
+        """
+        Method to see the patients waiting for a stage one at a time ('continuous' service mode)
+
+        A single process per stage takes the next patient off the stage's waiting list, sees
+        them, and moves them on to their next stage, then takes the next patient. When no
+        tracked patients are waiting, untracked patients ('capacity' drain mode) are seen
+        instead, so they only use the capacity that tracked patients don't need and never
+        delay them other than by finishing an appointment already started.
+
+        The time taken to see each patient is looked up in the capacity calendar for the
+        current week. In a week with no places (e.g. every session lost), the stage sees no one
+        until the next week.
+        """
+        calendar = self.capacity_calendar
+        waiting_list = self.stage_waiting_lists[stage]
+
+        while True:
+            week = int(self.env.now)
+            service_time = calendar.service_time(week, stage)
+
+            if service_time == np.inf:
+                yield self.env.timeout(week + 1 - self.env.now)
+
+            elif waiting_list:
+                patient = waiting_list.pop()
+                self.start_stage(patient, stage)
+
+                # freeze for the appointment / case duration
+                yield self.env.timeout(service_time)
+
+                self.queue_for_stage(patient, self.complete_stage(patient, stage))
+
+            elif self.untracked_waiting[stage] > 0:
+                self.untracked_waiting[stage] -= 1
+                yield self.env.timeout(service_time)
+                self.add_untracked(self.untracked_next_stage(stage))
+
+            else:
+                self.patient_arrived[stage] = self.env.event()
+                yield self.patient_arrived[stage]
+
+    def run_sessions(self, stage):
+        """
+        Method to hold the sessions (clinics, theatre lists) of a stage ('session' service mode)
+
+        The stage's sessions_per_week sessions are held one after another, evenly spaced
+        through each week. At the start of each session, up to the stage's capacity of
+        patients are taken from the front of its waiting list and seen; when the session ends
+        they all move on to their next stage. So there is a single simpy event per session, however
+        many patients it sees.
+
+        The places at each session are looked up in the capacity calendar for the session's
+        week, so weeks with sessions lost (e.g. to bank holidays) or taken by extra patients
+        have fewer places, without any extra simpy events. If the places aren't a whole
+        number, the fraction of a place left over is carried on to the next session (places
+        left unused because the queue is empty are not).
+        """
+        graph = self.pathway_graph
+        calendar = self.capacity_calendar
+        waiting_list = self.stage_waiting_lists[stage]
+        session_length = 1 / graph.sessions_per_week[stage]
+        places = 0
 
-    #         # Freeze theatres_unavail function for duration of list
-    #         yield self.env.timeout(1)
+        while True:
+            # (the week the middle of the session is in, which rounding errors in the session
+            # start times can't move into the next or previous week)
+            week = int(self.env.now + session_length / 2)
+            places += calendar.session_places(week, stage)
+            whole_places = int(places)
+            places -= whole_places
+            number_seen = min(whole_places, len(waiting_list))
+
+            session = [waiting_list.pop() for _ in range(number_seen)]
+            for patient in session:
+                self.start_stage(patient, stage)
+
+            # any places left are used by untracked patients ('capacity' drain mode)
+            untracked_seen = min(whole_places - number_seen, self.untracked_waiting[stage])
+            self.untracked_waiting[stage] -= untracked_seen
+
+            yield self.env.timeout(session_length)
+
+            for patient in session:
+                self.queue_for_stage(patient, self.complete_stage(patient, stage))
+            for _ in range(untracked_seen):
+                self.add_untracked(self.untracked_next_stage(stage))
+
+    def generate_untracked_referrals(self):
+        """
+        Method to add the referrals made after sim_duration to the pathway as numbers of
+        patients ('capacity' drain mode)
 
-    #         # Request resource with max priority and hold until next list
-    #         with self.theatres.request(priority=-1) as req:
-    #             # Freeze the function until the request can be met (this
-    #             # ensures that the last theatre case will be completed)
-    #             yield req
+        At the start of each week, the number of referrals in the week is sampled (from a
+        Poisson distribution, with the week's expected referrals from the demand profile if
+        there is one) and added to the number of untracked patients waiting for the entry stage,
+        without creating a patient, a simpy process or event log entries for any of them.
+        """
+        while True:
+            if self.demand_profile is None:
+                weekly_referrals = self.referrals_per_week
+            else:
+                weekly_referrals = self.demand_profile.expected_referrals(self.env.now, self.env.now + 1)
+            self.add_untracked(self.pathway_graph.entry_stage,
+                               self.variates.drain_referrals(weekly_referrals))
+            yield self.env.timeout(1)
 
-    #             yield self.env.timeout(self.theatre_list_interval)
+    def add_untracked(self, stage, number = 1):
+        """
+        Method to add untracked patients to the queue for a stage ('capacity' drain mode)
+        """
+        if stage == EXIT_STAGE or number == 0:
+            return
+        self.untracked_waiting[stage] += number
+        # wake the stage's serve_stage process if it is waiting for patients
+        if not self.patient_arrived[stage].triggered:
+            self.patient_arrived[stage].succeed()
+
+    def untracked_next_stage(self, stage):
+        """
+        Method to choose the stage an untracked patient goes to next ('capacity' drain mode)
+        """
+        graph = self.pathway_graph
+        if graph.is_branching(stage):
+            return graph.next_stage(stage, self.variates.drain_uniform())
+        return graph.route_targets[stage][0]
 
-    def monitor(self):
+    def check_end_of_sim(self):
         """
-        Method to check if simulation should continue
+        Method to end the simulation if every tracked patient has left the pathway
 
-        It should continue until both
+        The simulation should continue until both
         - the simulation time is later than the 'sim_duration' parameter
         - the number of active entities in the simulation is 0
 
@@ -568,96 +982,199 @@ class Neurosurgery_Pathway:
         - were prefills OR were added to the simulation during the period between 0 and sim_duration
         - have not yet completed their journey through the pathway
 
-        Therefore, the number of active entities will not reach 0 until all prefill patients or
-        patients generated during the initial sim runtime have had surgery or left the pathway
-        at a different point.
+        This is checked whenever a tracked patient leaves the pathway (and once at
+        sim_duration, in case they have all left already), so the simulation ends at the
+        moment the last of them leaves, rather than at the next weekly check.
         """
-        while True:
-            if self.env.now >= self.sim_duration and self.active_entities <= 0:
-                # trigger end of simulation event
-                self.end_of_sim.succeed()
-                log.info(f"""Simulation terminated at week {self.env.now} after reaching 0 active
+        if (self.env.now >= self.sim_duration and self.active_entities <= 0
+                and not self.end_of_sim.triggered):
+            # trigger end of simulation event
+            self.end_of_sim.succeed()
+            log.info(f"""Simulation terminated at week {self.env.now:.3f} after reaching 0 active
 entities and exceeding the minimum number of weeks ({self.sim_duration})""")
-                break
-            elif self.env.now >= (self.sim_duration + (52 * 10) ):
-                # trigger end of simulation event
-                log.warning(f"""Simulation terminated at week {self.env.now} due to extreme long-running
-behaviour (active entities remaining after simulation weeks x 10).
+
+    def drain_guard(self):
+        """
+        Method to end the simulation at sim_duration + max_drain_weeks if tracked patients are
+        still in the pathway (e.g. because the pathway doesn't have the capacity to clear its
+        queues), so that runs can't go on for ever
+        """
+        yield self.env.timeout(self.sim_duration)
+        self.check_end_of_sim()
+
+        if self.max_drain_weeks is None:
+            return
+
+        # sim_duration may have been brought forward by monitor_steady_state
+        yield self.env.timeout(max(self.sim_duration + self.max_drain_weeks - self.env.now, 0))
+        if not self.end_of_sim.triggered:
+            log.warning(f"""Simulation terminated at week {self.env.now} due to extreme long-running
+behaviour (active entities remaining {self.max_drain_weeks} weeks after the end of the simulation).
 Number of active entities remaining was {self.active_entities}""")
-                self.end_of_sim.succeed()
-                break
-            else:
-                log.info(f"Simulation week {self.env.now}: {self.active_entities} active entities remaining")
+            self.end_of_sim.succeed()
 
-            # Check conditions every 1 time unit
-            # Note that in this model, 1 time unit represents 1 week
+    def monitor_steady_state(self):
+        """
+        Method to end the period of adding tracked patients once the waits reach a steady state
+
+        Every week, the waits of the patients who have completed the pathway are checked in
+        order of referral (stopping at the earliest referral still in the pathway, so that
+        only patients with a known wait are used). Once the warm-up at the start of the run
+        has been found (see SurgerySteadyState.mser_truncation), the waits after it cover at
+        least a year of referrals, and their mean is known to within steady_state_precision,
+        sim_duration is brought forward to the current week. Patients already in the pathway
+        still complete their journeys.
+
+        Only the patients who completed the pathway since the last check are added each week.
+        The earliest referral still in the pathway only gets later, so once a patient's wait
+        is included it stays in place (in order of referral).
+        """
+        # the waits included so far (in order of referral), and those of patients who have
+        # completed the pathway but were referred after someone still in it
+        referral_times = np.empty(0)
+        waits = np.empty(0)
+        pending_referral_times = np.empty(0)
+        pending_waits = np.empty(0)
+        patients_checked = 0
+
+        while self.env.now < self.sim_duration:
             yield self.env.timeout(1)
 
+            if self.referrals_in_pathway:
+                earliest_referral_waiting = next(iter(self.referrals_in_pathway.values()))
+            else:
+                earliest_referral_waiting = np.inf
+
+            # the patients who completed the pathway in the last week
+            patients_completed = len(self.queue_times['time_entered_pathway'])
+            pending_referral_times = np.concatenate(
+                [pending_referral_times,
+                 self.queue_times['time_entered_pathway'][patients_checked:patients_completed]])
+            pending_waits = np.concatenate(
+                [pending_waits,
+                 self.queue_times['overall_queue_time'][patients_checked:patients_completed]])
+            patients_checked = patients_completed
+
+            ready = pending_referral_times < earliest_referral_waiting
+            order = np.argsort(pending_referral_times[ready], kind='stable')
+            referral_times = np.concatenate([referral_times, pending_referral_times[ready][order]])
+            waits = np.concatenate([waits, pending_waits[ready][order]])
+            pending_referral_times = pending_referral_times[~ready]
+            pending_waits = pending_waits[~ready]
+
+            if steady_state_converged(waits, self.steady_state_precision,
+                                      times=referral_times, minimum_span=52):
+                log.info(f"Simulation week {self.env.now}: wait times have reached a steady state, "
+                         f"so no more patients will be tracked")
+                self.steady_state_week = self.env.now
+                self.sim_duration = self.env.now
+                self.check_end_of_sim()
+                break
+
     def store_queue_times(self, patient):
         """
         Method to store queue times
         """
 
-        # create temporary dataframe with queue times
-        df_to_add = pd.DataFrame({'time_entered_pathway': [patient.time_entered_pathway],
-                                  'overall_queue_time': [patient.overall_queue_time]})
+        self.queue_times['time_entered_pathway'].append(patient.time_entered_pathway)
+        self.queue_times['overall_queue_time'].append(patient.overall_queue_time)
 
-        # Add to main dataframe
-
-        # TODO: SR NOTE: At some point you may want to adjust this to speed up the model
-        # Concatenating dataframes is relatively slow and memory-heavy compared to something
-        # like concatenating a list of dictionaries and turning it into a dataframe at the end
-
-        self.queue_times_df = pd.concat([self.queue_times_df, df_to_add])
+        self.wait_sketches['overall'].add(patient.overall_queue_time)
+        for stage_name, stage_queue_time in patient.stage_queue_times.items():
+            self.wait_sketches[stage_name].add(stage_queue_time)
 
     def write_queue_times(self):
         """
-        A method to save the wait times from this run to a csv file
+        A method to save the wait times from this run to the trial's Wait_Times_Store
         """
-        # Preview the dataframe in the console
-        print(self.queue_times_df.head())
+        Wait_Times_Store(self.output_dir).append_run(self.run_number, self.queue_times)
 
-        # Write the entire dataframe to a csv file
-        self.queue_times_df.to_csv(f'wait_times_run_{self.run_number}.csv', index=False)
+    def write_long_waiters(self):
+        """
+        A method to write the long waiters on the waiting list at the end of each week to a csv file
+        """
+        pd.DataFrame(self.long_waiters_over_time,
+                     columns=['week', 'stage', 'waiting']
+                             + [f'waiting_over_{threshold}' for threshold in LONG_WAIT_THRESHOLDS]
+                     ).to_csv(os.path.join(self.output_dir, f'long_waiters_run_{self.run_number}.csv'),
+                              index=False)
+
+    def write_wait_sketches(self):
+        """
+        A method to save the sketches of the waits to a json file
+        """
+        save_sketches(self.wait_sketches,
+                      os.path.join(self.output_dir, f'wait_sketches_run_{self.run_number}.json'))
 
     def write_queue_numbers(self):
         """
-        A method to write the queue numbers to a csv file
+        A method to write the queue numbers to a csv file, with the week the run stopped adding
+        tracked patients (sim_duration, unless the run stopped early at a steady state)
         """
-        with open('queue_numbers.csv', 'a', newline='') as csvfile:
+        with open(os.path.join(self.output_dir, 'queue_numbers.csv'), 'a', newline='') as csvfile:
             writer = csv.writer(csvfile, delimiter=',')
             writer.writerow([self.run_number,
                              self.clinic_queue_length,
-                             self.theatre_queue_length])
+                             self.theatre_queue_length,
+                             self.sim_duration])
 
     def write_event_log(self):
         """
         A method to write the full event log
         """
         # Write the entire dataframe to a csv file
-        pd.DataFrame(self.event_log).sort_values(['patient', 'time']).to_csv(f'event_log_run_{self.run_number}.csv', index=False)
+        pd.DataFrame(self.event_log).sort_values(['patient', 'time']).to_csv(
+            os.path.join(self.output_dir, f'event_log_run_{self.run_number}.csv'), index=False)
 
-    def run(self):
+    def run(self, profile=False, profile_dir='profiles'):
         """
         A method to run the simulation
-        """
-        # Fill queues
-        self.env.process(self.prefill_queues())
 
-        # Start entity generators
-        self.env.process(self.generate_referrals())
+        Parameters
+        ------
+        profile: bool, default is False
+            If True, profile the CPU time and memory use of the run (including writing the
+            results) and write a report and the raw profiles to profile_dir.
+            See profiling.profile_section for details.
 
-        # Simulate interval between clinics and lists
-        # self.env.process(self.clinic_unavail())
-        # self.env.process(self.theatres_unavail())
-
-        # Use monitor() to check if sim should end
-        self.env.process(self.monitor())
-
-        # Run simulation
-        self.env.run(until=self.end_of_sim)
-
-        # Write results to csv
-        self.write_queue_times()
-        self.write_queue_numbers()
-        self.write_event_log()
+        profile_dir: str, default is 'profiles'
+            Folder to write the profiling outputs to.
+        """
+        if profile:
+            profiler = profile_section(f'pathway_run_{self.run_number}', profile_dir)
+        else:
+            profiler = contextlib.nullcontext()
+
+        with profiler:
+            # Fill queues
+            self.env.process(self.prefill_queues())
+
+            # Start entity generators
+            self.env.process(self.generate_referrals())
+
+            # See the patients waiting for each stage, one at a time or in sessions
+            for stage in range(self.pathway_graph.number_of_stages):
+                if self.service_mode == 'session':
+                    self.env.process(self.run_sessions(stage))
+                else:
+                    self.env.process(self.serve_stage(stage))
+
+            # Count the long waiters at the end of each week
+            self.env.process(self.record_long_waiters())
+
+            # End the simulation if tracked patients are still in the pathway long after
+            # sim_duration (otherwise it ends when the last of them leaves - see check_end_of_sim)
+            self.env.process(self.drain_guard())
+
+            if self.stop_at_steady_state:
+                self.env.process(self.monitor_steady_state())
+
+            # Run simulation
+            self.env.run(until=self.end_of_sim)
+
+            # Write results to csv
+            self.write_queue_times()
+            self.write_queue_numbers()
+            self.write_long_waiters()
+            self.write_wait_sketches()
+            self.write_event_log()
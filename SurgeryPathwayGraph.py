@@ -0,0 +1,300 @@
+# A class to define the stages of the Neurosurgery RTT pathway and the routes between them
+#
+# The pathway is described as data rather than code: a set of stages (e.g. surgical clinic,
+# MRI, follow-up clinic, pre-op assessment, theatre), each with its capacity and the
+# probabilities of where patients go next. The definition is checked and then compiled into
+# flat lists indexed by stage number, which Neurosurgery_Pathway uses to move every patient
+# through the pathway with the same loop, however many stages there are.
+#
+# A pathway can be saved as a json file - see example_pathway.json. For example
+#   {
+#     "entry": "surg_clinic",
+#     "stages": {
+#       "surg_clinic": {"sessions_per_week": 2, "capacity": 6, "waiting_list": "non_admitted",
+#                       "routes": {"mri": 0.3, "theatre": 0.7}},
+#       ...
+#     }
+#   }
+
+import bisect
+import copy
+import json
+import math
+
+from global_params import g
+
+# The name of the 'stage' patients are routed to when they leave the pathway
+EXIT = 'exit'
+
+# The stage number used for EXIT in the compiled routing tables
+EXIT_STAGE = -1
+
+# The waiting list each stage counts towards (reported as the clinic and theatre queues)
+WAITING_LISTS = ['non_admitted', 'admitted']
+
+# The settings a stage can have, and their defaults (None means the setting must be given)
+STAGE_SETTINGS = {'sessions_per_week': None,
+                  'capacity': None,
+                  'waiting_list': 'non_admitted',
+                  'clock_stop': False,
+                  'routes': None}
+
+
+def default_pathway_definition(surg_clinic_per_week = g.surg_clinic_per_week,
+                               surg_clinic_capacity = g.surg_clinic_appts,
+                               theatre_list_per_week = g.theatre_list_per_week,
+                               theatre_list_capacity = g.theatre_list_capacity):
+    """
+    Function to create the definition of the original pathway: a surgical clinic, then theatre
+
+    Returns
+    ---
+    A dictionary that can be passed to Pathway_Graph
+    """
+    return {'entry': 'surg_clinic',
+            'stages': {
+                'surg_clinic': {'sessions_per_week': surg_clinic_per_week,
+                                'capacity': surg_clinic_capacity,
+                                'waiting_list': 'non_admitted',
+                                'routes': {'theatre': 1.0}},
+                'theatre': {'sessions_per_week': theatre_list_per_week,
+                            'capacity': theatre_list_capacity,
+                            'waiting_list': 'admitted',
+                            'clock_stop': True,
+                            'routes': {EXIT: 1.0}}}}
+
+
+def build_pathway_graph(pathway_graph = None,
+                        surg_clinic_per_week = g.surg_clinic_per_week,
+                        surg_clinic_capacity = g.surg_clinic_appts,
+                        theatre_list_per_week = g.theatre_list_per_week,
+                        theatre_list_capacity = g.theatre_list_capacity):
+    """
+    Function to turn the pathway_graph parameter of a model into a Pathway_Graph
+
+    Parameters
+    ------
+
+    pathway_graph: Pathway_Graph, dict or None
+        If None, the default pathway is built from the clinic and theatre parameters.
+
+    Returns
+    ---
+    A Pathway_Graph
+    """
+    if pathway_graph is None:
+        pathway_graph = default_pathway_definition(surg_clinic_per_week, surg_clinic_capacity,
+                                                   theatre_list_per_week, theatre_list_capacity)
+    if not isinstance(pathway_graph, Pathway_Graph):
+        pathway_graph = Pathway_Graph(pathway_graph)
+    return pathway_graph
+
+
+class Pathway_Graph:
+    """
+    A pathway of stages that patients queue for, compiled for the simulation.
+
+    Each stage is a resource that sees sessions_per_week * capacity patients per week, one
+    after another. After a stage, the patient moves to one of the stages in its routes (or
+    leaves the pathway, for EXIT), chosen at random with the given probabilities. Routes can
+    loop back (e.g. a follow-up clinic sending patients for another scan), as long as every
+    stage can eventually reach EXIT.
+
+    The patient's RTT clock stops when they are first seen at a stage with clock_stop set
+    (e.g. admission to theatre). If they leave the pathway without reaching one (e.g. they are
+    discharged after clinic), it stops when they are seen at their last stage.
+
+    Parameters
+    ------
+
+    definition: dict
+        The pathway, with keys
+        - stages: a dictionary of stage name to its settings
+            - sessions_per_week: number of sessions (clinics, lists) per week
+            - capacity: number of patients seen per session
+            - waiting_list: 'non_admitted' (default) or 'admitted' - which queue the patients
+              waiting for the stage are counted in
+            - clock_stop: bool, default is False
+            - routes: a dictionary of next stage name (or EXIT) to probability
+        - entry: the stage new referrals (and non-admitted prefill patients) join
+        - admitted_entry: optional - the stage admitted prefill patients join. Default is the
+          first admitted stage.
+    """
+    def __init__(self, definition):
+        self.definition = copy.deepcopy(definition)
+        self.validate()
+        self.compile()
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Method to create a Pathway_Graph from a json file
+        """
+        with open(filename) as f:
+            return cls(json.load(f))
+
+    def to_dict(self):
+        """
+        Method to return the definition of the pathway (e.g. to save as json)
+        """
+        return copy.deepcopy(self.definition)
+
+    def validate(self):
+        """
+        Method to check the definition is complete and consistent
+
+        Raises a ValueError describing the first problem found
+        """
+        stages = self.definition.get('stages')
+        if not stages:
+            raise ValueError("The pathway has no stages")
+        if EXIT in stages:
+            raise ValueError(f"'{EXIT}' can't be used as a stage name")
+
+        for stage_name in [self.definition.get('entry'), self.definition.get('admitted_entry')]:
+            if stage_name is not None and stage_name not in stages:
+                raise ValueError(f"The pathway has no stage '{stage_name}'")
+        if self.definition.get('entry') is None:
+            raise ValueError("The pathway has no entry stage")
+
+        for stage_name, stage in stages.items():
+            unknown = set(stage) - set(STAGE_SETTINGS)
+            if unknown:
+                raise ValueError(f"Unknown settings for stage '{stage_name}': {sorted(unknown)}")
+            missing = [setting for setting, default in STAGE_SETTINGS.items()
+                       if default is None and setting not in stage]
+            if missing:
+                raise ValueError(f"Stage '{stage_name}' is missing {missing}")
+            if stage['sessions_per_week'] * stage['capacity'] <= 0:
+                raise ValueError(f"Stage '{stage_name}' has no capacity")
+            if stage.get('waiting_list', 'non_admitted') not in WAITING_LISTS:
+                raise ValueError(f"The waiting list of stage '{stage_name}' must be one of {WAITING_LISTS}")
+
+            routes = stage['routes']
+            for next_stage, probability in routes.items():
+                if next_stage != EXIT and next_stage not in stages:
+                    raise ValueError(f"Stage '{stage_name}' routes to unknown stage '{next_stage}'")
+                if probability < 0:
+                    raise ValueError(f"Stage '{stage_name}' has a negative routing probability")
+            if not math.isclose(sum(routes.values()), 1, abs_tol=1e-6):
+                raise ValueError(f"The routing probabilities of stage '{stage_name}' don't add up to 1")
+
+        # every stage must be able to reach EXIT, or patients could be stuck in a loop forever
+        can_exit = {EXIT}
+        added = True
+        while added:
+            added = False
+            for stage_name, stage in stages.items():
+                if stage_name not in can_exit and any(
+                        probability > 0 and next_stage in can_exit
+                        for next_stage, probability in stage['routes'].items()):
+                    can_exit.add(stage_name)
+                    added = True
+        stuck = [stage_name for stage_name in stages if stage_name not in can_exit]
+        if stuck:
+            raise ValueError(f"Patients can never leave the pathway from stages {stuck}")
+
+    def compile(self):
+        """
+        Method to turn the definition into lists indexed by stage number
+
+        The routing of each stage is precomputed as its possible next stages and the
+        cumulative probabilities of going to each, so choosing the next stage only takes a
+        binary search of a short list.
+        """
+        stages = self.definition['stages']
+
+        self.stage_names = list(stages)
+        self.stage_index = {stage_name: i for i, stage_name in enumerate(self.stage_names)}
+        self.number_of_stages = len(self.stage_names)
+
+        # time taken to see each patient, with each stage seeing
+        # sessions_per_week * capacity patients a week
+        self.service_times = [1 / (stage['sessions_per_week'] * stage['capacity'])
+                              for stage in stages.values()]
+        self.sessions_per_week = [stage['sessions_per_week'] for stage in stages.values()]
+        self.capacities = [stage['capacity'] for stage in stages.values()]
+        self.waiting_lists = [stage.get('waiting_list', 'non_admitted') for stage in stages.values()]
+        self.clock_stops = [bool(stage.get('clock_stop', False)) for stage in stages.values()]
+
+        self.route_targets = []
+        self.route_cumulative_probabilities = []
+        for stage in stages.values():
+            routes = {next_stage: probability for next_stage, probability in stage['routes'].items()
+                      if probability > 0}
+            self.route_targets.append([EXIT_STAGE if next_stage == EXIT else self.stage_index[next_stage]
+                                       for next_stage in routes])
+            cumulative_probabilities = []
+            total = 0
+            for probability in routes.values():
+                total += probability
+                cumulative_probabilities.append(total)
+            # make sure a random number just below 1 always has a route
+            cumulative_probabilities[-1] = 1.0
+            self.route_cumulative_probabilities.append(cumulative_probabilities)
+
+        # the event log entries for each stage
+        self.queue_events = [f'queue_{stage_name}' for stage_name in self.stage_names]
+        self.begin_events = [f'{stage_name}_begins' for stage_name in self.stage_names]
+        self.complete_events = [f'{stage_name}_complete' for stage_name in self.stage_names]
+
+        self.entry_stage = self.stage_index[self.definition['entry']]
+        if self.definition.get('admitted_entry') is not None:
+            self.admitted_entry_stage = self.stage_index[self.definition['admitted_entry']]
+        elif 'admitted' in self.waiting_lists:
+            self.admitted_entry_stage = self.waiting_lists.index('admitted')
+        else:
+            self.admitted_entry_stage = None
+
+    def is_branching(self, stage):
+        """
+        Method to check whether patients leaving a stage can go to more than one place
+        """
+        return len(self.route_targets[stage]) > 1
+
+    def next_stage(self, stage, uniform):
+        """
+        Method to choose the stage a patient goes to next
+
+        Parameters
+        ------
+
+        stage: int
+            The stage the patient has just been seen at.
+
+        uniform: float
+            A random number between 0 and 1.
+
+        Returns
+        ---
+        The number of the next stage, or EXIT_STAGE
+        """
+        return self.route_targets[stage][
+            bisect.bisect_right(self.route_cumulative_probabilities[stage], uniform)]
+
+    def plan_route(self, stage, routing_uniform):
+        """
+        Method to choose every stage a patient goes to after the stage they start at
+
+        Parameters
+        ------
+
+        stage: int
+            The stage the patient starts at.
+
+        routing_uniform: function
+            Returns a random number between 0 and 1. It is only called at branching stages.
+
+        Returns
+        ---
+        A list of the stage the patient goes to after each stage they are seen at, ending
+        with EXIT_STAGE
+        """
+        route = []
+        while stage != EXIT_STAGE:
+            if self.is_branching(stage):
+                stage = self.next_stage(stage, routing_uniform())
+            else:
+                stage = self.route_targets[stage][0]
+            route.append(stage)
+        return route
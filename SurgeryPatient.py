@@ -1,3 +1,6 @@
+from SurgeryWaitingList import ROUTINE
+
+
 class Patient:
     """
     A class representing patients referred to Neurosurgery
@@ -9,10 +12,28 @@ class Patient:
         self.id = p_id
         self.needs_surgery = False
 
+        # the stage the patient goes to after each stage they are seen at (chosen when they
+        # join the pathway - see Neurosurgery_Pathway.determine_route), and how many stages
+        # they have been seen at so far
+        self.route = []
+        self.stages_completed = 0
+
+        # the patient's priority class on the waiting lists (see SurgeryWaitingList.py)
+        self.priority = ROUTINE
+
         self.time_entered_pathway = 0
 
-        self.clinic_queue_time = 0
-        self.theatre_queue_time = 0
+        # time spent queueing for each stage of the pathway (by stage name), and when the
+        # patient joined the queue they are in now
+        self.stage_queue_times = {}
+        self.stage_queue_start = 0
+
+        # whether the patient's RTT clock has stopped (see Neurosurgery_Pathway.start_stage)
+        self.clock_stopped = False
+
+        # whether the patient is in the long waiter counts of the stage they are waiting for
+        # (see Neurosurgery_Pathway.count_waiting)
+        self.counted_waiting = False
         self.overall_queue_time = 0
 
         # Attribute for patients who are pre-filled into queues
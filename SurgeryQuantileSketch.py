@@ -0,0 +1,171 @@
+# A class to estimate percentiles of wait times without keeping every wait
+#
+# Percentiles (e.g. the median and 92nd percentile RTT wait) normally need all the waits sorted,
+# which for thousands of runs of tens of thousands of patients is a lot of data. A sketch
+# instead counts the waits in buckets whose widths grow with the wait (like a histogram on a log
+# scale), so any percentile can be estimated to within a set relative accuracy from a fixed,
+# small number of counts. Sketches of different runs (or scenarios) can be merged by adding
+# their counts, giving exactly the sketch of all their waits together.
+#
+# This is the DDSketch method (Masson, Rim and Lee, 2019).
+
+import json
+import math
+
+import numpy as np
+
+
+class Quantile_Sketch:
+    """
+    A mergeable sketch of a set of non-negative values (e.g. waits in weeks), from which
+    quantiles can be estimated.
+
+    Each value x is counted in bucket ceil(log(x) / log(gamma)), where
+    gamma = (1 + relative_accuracy) / (1 - relative_accuracy), so every value in a bucket is
+    within relative_accuracy of the bucket's representative value. Values no bigger than
+    min_value (e.g. patients who didn't wait at all) are counted separately, as 0.
+
+    The number of buckets only depends on the range of the values (about 700 for waits
+    between a minute and 20 years with the default accuracy), not on how many values there are.
+
+    Parameters
+    ------
+
+    relative_accuracy: float, default is 0.01
+        Largest error of an estimated quantile, as a fraction of its true value.
+
+    min_value: float, default is 1e-4
+        Values at or below this (about a minute, in weeks) are counted as 0.
+    """
+    def __init__(self, relative_accuracy = 0.01, min_value = 1e-4):
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+
+        self.zero_count = 0
+        # count of values in each bucket, by bucket index
+        self.bins = {}
+
+    @property
+    def count(self):
+        """
+        The number of values added to the sketch
+        """
+        return self.zero_count + sum(self.bins.values())
+
+    def add(self, value):
+        """
+        Method to add a single value to the sketch
+        """
+        if value <= self.min_value:
+            self.zero_count += 1
+        else:
+            index = math.ceil(math.log(value) / self.log_gamma)
+            self.bins[index] = self.bins.get(index, 0) + 1
+
+    def add_many(self, values):
+        """
+        Method to add an array of values to the sketch at once
+        """
+        values = np.asarray(values, dtype=float)
+        self.zero_count += int((values <= self.min_value).sum())
+
+        indexes, counts = np.unique(np.ceil(np.log(values[values > self.min_value]) / self.log_gamma),
+                                    return_counts=True)
+        for index, count in zip(indexes.astype(int).tolist(), counts.tolist()):
+            self.bins[index] = self.bins.get(index, 0) + count
+
+    def merge(self, other):
+        """
+        Method to add the values of another sketch (with the same accuracy) to this one
+        """
+        if other.relative_accuracy != self.relative_accuracy or other.min_value != self.min_value:
+            raise ValueError("Only sketches with the same relative_accuracy and min_value can be merged")
+        self.zero_count += other.zero_count
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+
+    def quantile(self, q):
+        """
+        Method to estimate a quantile of the values added to the sketch
+
+        Parameters
+        ------
+
+        q: float
+            The quantile, between 0 and 1 (e.g. 0.5 for the median).
+
+        Returns
+        ---
+        A float (NaN if the sketch is empty)
+        """
+        count = self.count
+        if count == 0:
+            return np.nan
+
+        # the quantile is the value with this many values below it
+        rank = q * (count - 1)
+        if rank < self.zero_count:
+            return 0.0
+
+        values_so_far = self.zero_count
+        for index in sorted(self.bins):
+            values_so_far += self.bins[index]
+            if values_so_far > rank:
+                # the middle of the bucket (in relative terms)
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def to_dict(self):
+        """
+        Method to return the sketch as a dictionary (e.g. to save as json)
+        """
+        return {'relative_accuracy': self.relative_accuracy,
+                'min_value': self.min_value,
+                'zero_count': self.zero_count,
+                'bins': {str(index): count for index, count in self.bins.items()}}
+
+    @classmethod
+    def from_dict(cls, sketch_dict):
+        """
+        Method to create a sketch from a dictionary made by to_dict
+        """
+        sketch = cls(sketch_dict['relative_accuracy'], sketch_dict['min_value'])
+        sketch.zero_count = sketch_dict['zero_count']
+        sketch.bins = {int(index): count for index, count in sketch_dict['bins'].items()}
+        return sketch
+
+
+def save_sketches(sketches, filename):
+    """
+    Function to save a dictionary of named sketches to a json file
+    """
+    with open(filename, 'w') as f:
+        json.dump({name: sketch.to_dict() for name, sketch in sketches.items()}, f)
+
+
+def load_sketches(filename):
+    """
+    Function to read a dictionary of named sketches saved by save_sketches
+    """
+    with open(filename) as f:
+        return {name: Quantile_Sketch.from_dict(sketch_dict)
+                for name, sketch_dict in json.load(f).items()}
+
+
+def merge_sketches(sketches_list):
+    """
+    Function to merge dictionaries of named sketches (e.g. from several runs or scenarios)
+
+    Returns
+    ---
+    A dictionary with a sketch for every name, of the values of all the sketches with that name
+    """
+    merged = {}
+    for sketches in sketches_list:
+        for name, sketch in sketches.items():
+            if name not in merged:
+                merged[name] = Quantile_Sketch(sketch.relative_accuracy, sketch.min_value)
+            merged[name].merge(sketch)
+    return merged
@@ -0,0 +1,272 @@
+# A class to keep the results of simulation runs on disk so they can be reused
+#
+# A run of the simulation is completely determined by its scenario (a Scenario_Config), its
+# random numbers and the model code, so a run that has been done before (by the Streamlit app,
+# a batch job or a sweep) doesn't need doing again. Each run's results are saved in the store
+# under a hash of all three, and any process using the same store folder can pick them up.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import pandas as pd
+
+from SurgeryWaitTimesStore import Wait_Times_Store
+
+RESULT_STORE_DIR = 'result_store'
+
+# 1 GB
+RESULT_STORE_MAX_SIZE = 1024 ** 3
+
+# The files that define the model. Their contents are part of every key, so changing the model
+# means old results are no longer reused (they are evicted once the store is full).
+MODEL_FILES = ['SurgeryPathway.py', 'SurgeryPatient.py', 'SurgeryVariates.py', 'SurgerySteadyState.py',
+               'SurgeryPathwayGraph.py', 'SurgeryQuantileSketch.py', 'SurgeryWaitingList.py',
+               'SurgeryCapacityCalendar.py', 'SurgeryDemandProfile.py', 'SurgeryScenario.py',
+               'global_params.py']
+
+
+def model_version():
+    """
+    Function to create a fingerprint of the model code
+
+    Returns
+    ---
+    A string (the sha256 hash of the files in MODEL_FILES)
+    """
+    model_hash = hashlib.sha256()
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    for filename in MODEL_FILES:
+        with open(os.path.join(module_dir, filename), 'rb') as f:
+            model_hash.update(f.read())
+    return model_hash.hexdigest()
+
+
+class Result_Store:
+    """
+    An on-disk store of the results of individual simulation runs.
+
+    Each run is stored in its own folder, named by the hash of the scenario (the key of its
+    Scenario_Config), the run's random seed (and whether it used the antithetic random
+    numbers) and the model code, holding
+    - wait_times: the run's wait times (a Wait_Times_Store holding them as run 0)
+    - event_log.csv: the run's event log
+    - long_waiters.csv: the run's long waiters on the waiting list at the end of each week
+    - wait_sketches.json: the sketches of the run's waits
+    - result.json: the scenario, seed, queue numbers and KPIs of the run
+
+    The store can be shared by several processes at once:
+    - results are written to a temporary folder and then renamed into place, so a run is
+      either in the store completely or not at all
+    - when the store grows beyond max_size, the least recently used runs are deleted
+
+    Runs without a random seed can't be repeated, so are never stored.
+
+    Parameters
+    ------
+
+    store_dir: str, default is `RESULT_STORE_DIR`
+        Folder to keep the results in (created if it does not exist).
+
+    max_size: int, default is `RESULT_STORE_MAX_SIZE`
+        Size of the store (in bytes) above which old results are deleted.
+    """
+    def __init__(self, store_dir = RESULT_STORE_DIR, max_size = RESULT_STORE_MAX_SIZE):
+        self.store_dir = os.path.abspath(store_dir)
+        self.max_size = max_size
+        self.model_version = model_version()
+
+        self.runs_dir = os.path.join(self.store_dir, 'runs')
+        os.makedirs(self.runs_dir, exist_ok=True)
+
+    def key(self, scenario_config, random_seed, antithetic = False):
+        """
+        Method to create the key a run is stored under
+
+        Returns
+        ---
+        A string (a sha256 hash)
+        """
+        run = {'model_version': self.model_version,
+               'scenario': scenario_config.key(),
+               'random_seed': random_seed,
+               'antithetic': antithetic}
+        return hashlib.sha256(json.dumps(run, sort_keys=True).encode()).hexdigest()
+
+    def run_dir(self, key):
+        """
+        Method to return the folder a run is (or would be) stored in
+        """
+        return os.path.join(self.runs_dir, key)
+
+    def get(self, run_number, scenario_config, random_seed, antithetic = False, output_dir = '.'):
+        """
+        Method to copy a stored run's results to output_dir, as if the run had just been done
+
+        This writes the same results as `Neurosurgery_Pathway.run` (the run's wait times in
+        output_dir's Wait_Times_Store, event_log_run_{n}.csv, long_waiters_run_{n}.csv,
+        wait_sketches_run_{n}.json and a row of queue_numbers.csv).
+
+        Returns
+        ---
+        The run's result (a dictionary, as saved by `put`), or None if the run isn't stored
+        """
+        if random_seed is None:
+            return None
+
+        run_dir = self.run_dir(self.key(scenario_config, random_seed, antithetic))
+        try:
+            with open(os.path.join(run_dir, 'result.json')) as f:
+                result = json.load(f)
+            wait_times = Wait_Times_Store(run_dir).read_run(0)
+            Wait_Times_Store(output_dir).append_run(run_number, wait_times)
+            shutil.copyfile(os.path.join(run_dir, 'event_log.csv'),
+                            os.path.join(output_dir, f'event_log_run_{run_number}.csv'))
+            shutil.copyfile(os.path.join(run_dir, 'long_waiters.csv'),
+                            os.path.join(output_dir, f'long_waiters_run_{run_number}.csv'))
+            shutil.copyfile(os.path.join(run_dir, 'wait_sketches.json'),
+                            os.path.join(output_dir, f'wait_sketches_run_{run_number}.json'))
+            # mark the run as recently used, so it is kept when the store is full
+            os.utime(run_dir)
+        except FileNotFoundError:
+            # not stored (or deleted by another process while being read)
+            return None
+
+        with open(os.path.join(output_dir, 'queue_numbers.csv'), 'a', newline='') as csvfile:
+            csvfile.write(f"{run_number},{result['clinic_queue']},{result['theatre_queue']},"
+                          f"{result['sim_duration']}\n")
+
+        return result
+
+    def put(self, pathway_model, scenario_config, random_seed, antithetic = False):
+        """
+        Method to save the results of a run that has just been done
+
+        Parameters
+        ------
+
+        pathway_model: Neurosurgery_Pathway
+            The model, after its run method has been called.
+
+        scenario_config: Scenario_Config
+            The scenario the model was created from.
+
+        random_seed: int
+            The seed the run was done with.
+
+        antithetic: bool, default is False
+            Whether the run used the antithetic random numbers.
+        """
+        if random_seed is None:
+            return
+
+        key = self.key(scenario_config, random_seed, antithetic)
+        if os.path.exists(self.run_dir(key)):
+            return
+
+        wait_times_df = pathway_model.queue_times_df
+        result = {'params': scenario_config.pathway_params(),
+                  'random_seed': random_seed,
+                  'antithetic': antithetic,
+                  'clinic_queue': pathway_model.clinic_queue_length,
+                  'theatre_queue': pathway_model.theatre_queue_length,
+                  # the week the run stopped adding tracked patients
+                  'sim_duration': pathway_model.sim_duration,
+                  'kpis': self.run_kpis(wait_times_df, pathway_model.sim_duration,
+                                        pathway_model.clinic_queue_length,
+                                        pathway_model.theatre_queue_length),
+                  'created': time.time()}
+
+        # write everything to a temporary folder in the store, then rename it into place
+        temporary_dir = tempfile.mkdtemp(prefix=f'.{key}_', dir=self.runs_dir)
+        try:
+            Wait_Times_Store(temporary_dir).append_run(0, pathway_model.queue_times)
+            shutil.copyfile(os.path.join(pathway_model.output_dir,
+                                         f'event_log_run_{pathway_model.run_number}.csv'),
+                            os.path.join(temporary_dir, 'event_log.csv'))
+            shutil.copyfile(os.path.join(pathway_model.output_dir,
+                                         f'long_waiters_run_{pathway_model.run_number}.csv'),
+                            os.path.join(temporary_dir, 'long_waiters.csv'))
+            shutil.copyfile(os.path.join(pathway_model.output_dir,
+                                         f'wait_sketches_run_{pathway_model.run_number}.json'),
+                            os.path.join(temporary_dir, 'wait_sketches.json'))
+            with open(os.path.join(temporary_dir, 'result.json'), 'w') as f:
+                json.dump(result, f, indent=2)
+            os.replace(temporary_dir, self.run_dir(key))
+        except OSError:
+            # another process stored the same run first
+            pass
+        finally:
+            shutil.rmtree(temporary_dir, ignore_errors=True)
+
+        self.evict()
+
+    def run_kpis(self, wait_times_df, sim_duration, clinic_queue, theatre_queue):
+        """
+        Method to calculate the headline figures for a single run
+
+        Returns
+        ---
+        A dictionary with the same keys as `Trial_Results_Calculator.readout_kpis`
+        """
+        last_week = sim_duration - 1
+        entered_first_week = wait_times_df[wait_times_df['time_entered_pathway'] < 1]
+        entered_final_week = wait_times_df[wait_times_df['time_entered_pathway'] > last_week]
+
+        return {
+            'clinic_queue_end': float(clinic_queue),
+            'theatre_queue_end': float(theatre_queue),
+            'total_queue_end': float(clinic_queue + theatre_queue),
+            'mean_wait_start': float(entered_first_week['overall_queue_time'].mean()),
+            'mean_wait_end': float(entered_final_week['overall_queue_time'].mean()),
+            'total_52_plus': int((entered_final_week['overall_queue_time'] >= 52).sum()),
+            'total_65_plus': int((entered_final_week['overall_queue_time'] >= 65).sum()),
+        }
+
+    def stored_runs(self):
+        """
+        Method to list the runs in the store
+
+        Returns
+        ---
+        A dataframe with a row per run: its key, size (bytes) and when it was last used
+        """
+        rows = []
+        for key in os.listdir(self.runs_dir):
+            run_dir = self.run_dir(key)
+            # skip runs still being written
+            if key.startswith('.'):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(folder, filename))
+                           for folder, _, filenames in os.walk(run_dir) for filename in filenames)
+                rows.append({'key': key, 'size': size, 'last_used': os.stat(run_dir).st_mtime})
+            except FileNotFoundError:
+                continue
+
+        return pd.DataFrame(rows, columns=['key', 'size', 'last_used'])
+
+    def size(self):
+        """
+        Method to return the total size of the store in bytes
+        """
+        return int(self.stored_runs()['size'].sum())
+
+    def evict(self):
+        """
+        Method to delete the least recently used runs until the store is no bigger than max_size
+        """
+        stored_runs_df = self.stored_runs().sort_values('last_used', ascending=False)
+        size_so_far = stored_runs_df['size'].cumsum()
+        for key in stored_runs_df.loc[size_so_far > self.max_size, 'key']:
+            shutil.rmtree(self.run_dir(key), ignore_errors=True)
+
+    def clear(self):
+        """
+        Method to delete every run in the store
+        """
+        shutil.rmtree(self.runs_dir, ignore_errors=True)
+        os.makedirs(self.runs_dir, exist_ok=True)
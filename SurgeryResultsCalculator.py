@@ -6,70 +6,203 @@ import numpy as np
 import pandas as pd
 import csv
 from statistics import mean
-import matplotlib.pyplot as plt
 #import seaborn as sns
 import os
-import plotly.express as px
 
 from global_params import g
+from SurgerySteadyState import mser_truncation, batch_means_interval, batch_means
+from SurgeryWaitTimesStore import Wait_Times_Store
+from SurgeryQuantileSketch import load_sketches, merge_sketches
+from SurgeryWaitIndex import Wait_Time_Index
 from SurgeryPathway import Neurosurgery_Pathway
 from SurgeryPatient import Patient
 
+# Largest number of patients shown in the wait times chart (sampled from all the runs)
+PLOT_POINTS = 20000
+
 
 class Trial_Results_Calculator:
     def __init__(self,
                  number_of_runs = g.number_of_runs,
                  sim_duration = g.sim_duration,
                  fill_non_admitted_queue = g.fill_non_admitted_queue,
-                 fill_admitted_queue = g.fill_admitted_queue):
+                 fill_admitted_queue = g.fill_admitted_queue,
+                 output_dir = '.'):
         #self.trial_results_df = pd.DataFrame()
 
+        # folder the runs' results files were written to (and the collated results will be)
+        self.output_dir = output_dir
+        # every run's wait times, which are worked through a run at a time
+        self.wait_times_store = Wait_Times_Store(output_dir)
+
         self.number_of_runs = number_of_runs
         self.sim_duration = sim_duration
         self.fill_non_admitted_queue = fill_non_admitted_queue
         self.fill_admitted_queue = fill_admitted_queue
 
-    def concatenate_wait_times(self):
+        # counts of the waits by week of referral, built the first time they're needed
+        self.wait_index = None
+        # the week each run stopped adding tracked patients (read from queue_numbers.csv)
+        self.run_sim_durations = {}
+
+    @classmethod
+    def from_scenario(cls, scenario_config, number_of_runs = g.number_of_runs, output_dir = '.'):
         """
-        A method to concatenate the multiple wait time CSVs
+        A method to create the calculator for a trial of a scenario (a Scenario_Config, see
+        SurgeryScenario.py)
         """
+        return cls(number_of_runs=number_of_runs,
+                   sim_duration=scenario_config.sim_duration,
+                   fill_non_admitted_queue=scenario_config.fill_non_admitted_queue,
+                   fill_admitted_queue=scenario_config.fill_admitted_queue,
+                   output_dir=output_dir)
 
-        # create empty dataframe
-        nodata = {'time_entered_pathway': [],
-                    'overall_queue_time': [],
-                    'run': []}
-        all_wait_times_df = pd.DataFrame(nodata)
+    def concatenate_wait_times(self, write_csv = True):
+        """
+        A method to check every run's wait times have been saved, and write them all to
+        all_wait_times.csv
 
+        The csv file is written a run at a time, so memory use doesn't grow with the number of
+        runs. None of the readouts need it (they read the wait times from the trial's
+        Wait_Times_Store), so for trials with thousands of runs it can be skipped with
+        write_csv=False.
+        """
+        missing_runs = [i for i in range(self.number_of_runs)
+                        if not self.wait_times_store.has_run(i)]
+        if missing_runs:
+            raise FileNotFoundError(f"No wait times found in {self.wait_times_store.store_dir} "
+                                    f"for runs {missing_runs}")
+
+        if write_csv:
+            csv_filename = os.path.join(self.output_dir, 'all_wait_times.csv')
+            pd.DataFrame(columns=['time_entered_pathway', 'overall_queue_time', 'run']).to_csv(csv_filename)
+            for run, wait_times_this_run in self.iter_run_wait_times():
+                # Add column indicating the run these wait times come from
+                wait_times_this_run['run'] = run
+                wait_times_this_run.to_csv(csv_filename, mode='a', header=False)
+
+    def iter_run_wait_times(self):
+        """
+        A method to go through the wait times of the trial one run at a time
+
+        Returns
+        ---
+        A generator of (run, dataframe of the run's wait times) with runs numbered from 1, as
+        in all_wait_times.csv
+        """
         for i in range(self.number_of_runs):
-            wait_times_this_run = pd.read_csv(f'wait_times_run_{i}.csv')
-             # Add column indicating the run these wait times come from
-            wait_times_this_run['run'] = i+1
-            all_wait_times_df = pd.concat([all_wait_times_df, wait_times_this_run])
+            yield i + 1, self.wait_times_store.read_run_df(i)
+
+    def readout_binned_wait_times(self, bin_width = 1):
+        """
+        Method to summarise the wait times of each run by the week patients were referred in
 
-        # save to csv
-        # print(all_wait_times_df.head())
-        all_wait_times_df['run'] = all_wait_times_df['run'].astype('int')
-        all_wait_times_df.to_csv('all_wait_times.csv')
+        This is a small table however many patients there are (a row per run and week), so
+        it's used for the wait times chart instead of every patient's wait.
 
-        # delete individual run files
-        for i in range(self.number_of_runs):
-            os.remove(f'wait_times_run_{i}.csv')
+        Parameters
+        ------
+
+        bin_width: float, default is 1
+            Number of weeks of referrals in each row.
+
+        Returns
+        ---
+        A dataframe indexed by run (numbered from 1, as in all_wait_times.csv) and week (the
+        start of the bin), with columns patients (the number referred), mean_wait and the 10th,
+        50th and 90th percentiles of the wait (p10, p50 and p90)
+        """
+        binned_runs = []
+        for run, run_df in self.iter_run_wait_times():
+            week = np.floor(run_df['time_entered_pathway'].to_numpy() / bin_width) * bin_width
+            waits = run_df['overall_queue_time'].groupby(week)
+            binned_df = waits.quantile([0.1, 0.5, 0.9]).unstack()
+            binned_df.columns = ['p10', 'p50', 'p90']
+            binned_df.insert(0, 'mean_wait', waits.mean())
+            binned_df.insert(0, 'patients', waits.size())
+            binned_runs.append(binned_df.assign(run=run))
+
+        binned_df = pd.concat(binned_runs)
+        binned_df.index.name = 'week'
+        return binned_df.reset_index().set_index(['run', 'week'])
+
+    def sample_wait_times(self, max_points = PLOT_POINTS, random_seed = None):
+        """
+        Method to pick a random sample of the patients' wait times, from all the runs
+
+        The sample is drawn by reservoir sampling, a run at a time, so every patient has the
+        same chance of being picked but only max_points patients are ever held in memory.
 
-    def plot_wait_times(self):
+        Returns
+        ---
+        A dataframe of up to max_points patients, with the columns of all_wait_times.csv
         """
-        A method to read in the run results csv file and print them for the user
+        rng = np.random.default_rng(random_seed)
+        reservoir = np.empty((max_points, 3))
+        patients_seen = 0
+
+        for run, run_df in self.iter_run_wait_times():
+            patients = np.column_stack([run_df['time_entered_pathway'].to_numpy(),
+                                        run_df['overall_queue_time'].to_numpy(),
+                                        np.full(len(run_df), run)])
+
+            # fill the reservoir first
+            filled = min(len(patients), max(0, max_points - patients_seen))
+            reservoir[patients_seen:patients_seen + filled] = patients[:filled]
+            patients_seen += filled
+            patients = patients[filled:]
+
+            # then each later patient replaces a random place in the reservoir, with
+            # probability max_points / (the number of patients so far). Where two patients of a
+            # run pick the same place, the later one is kept, as when done one at a time.
+            places = rng.integers(0, patients_seen + np.arange(1, len(patients) + 1))
+            replaces = places < max_points
+            reservoir[places[replaces]] = patients[replaces]
+            patients_seen += len(patients)
+
+        sample_df = pd.DataFrame(reservoir[:min(patients_seen, max_points)],
+                                 columns=['time_entered_pathway', 'overall_queue_time', 'run'])
+        sample_df['run'] = sample_df['run'].astype(int)
+        return sample_df
+
+    def plot_wait_times(self, show_points = True, bin_width = 1):
         """
-        trial_results_df = pd.read_csv('all_wait_times.csv')
-        trial_results_df['run'] = trial_results_df['run'].astype('str')
+        A method to plot the wait times against the week patients were referred
 
-        fig = px.scatter(trial_results_df, x='time_entered_pathway',
-                            y='overall_queue_time', opacity=0.3, trendline='ols',
-                            trendline_color_override='black',
-                            trendline_scope = 'overall',
-                            color="run",
-                            title='Total wait time vs time of referral',
-                            labels={'time_entered_pathway': 'Week of referral',
-                                    'overall_queue_time': 'Total wait time (weeks)'})
+        The chart shows the 10th to 90th percentile and the median and mean of the waits of
+        the patients referred in each week (averaged over the runs), from
+        readout_binned_wait_times. With show_points, a random sample of PLOT_POINTS patients
+        from sample_wait_times is drawn as well, so the size of the chart doesn't grow with the
+        number of patients or runs.
+        """
+        # plotly is only needed for the charts, so is imported here to keep it out of
+        # headless (command line) runs
+        import plotly.graph_objects as go
+
+        binned_df = self.readout_binned_wait_times(bin_width).groupby('week').mean()
+        # plot each bin at its middle
+        weeks = binned_df.index + bin_width / 2
+
+        fig = go.Figure()
+        if show_points:
+            sample_df = self.sample_wait_times()
+            fig.add_scatter(x=sample_df['time_entered_pathway'], y=sample_df['overall_queue_time'],
+                            mode='markers', opacity=0.3, marker={'size': 4, 'color': 'grey'},
+                            name='Sample of patients')
+
+        fig.add_scatter(x=weeks, y=binned_df['p90'], mode='lines', line={'width': 0},
+                        showlegend=False, hoverinfo='skip')
+        fig.add_scatter(x=weeks, y=binned_df['p10'], mode='lines', line={'width': 0},
+                        fill='tonexty', fillcolor='rgba(99, 110, 250, 0.3)',
+                        name='10th to 90th percentile')
+        fig.add_scatter(x=weeks, y=binned_df['p50'], mode='lines',
+                        line={'color': 'rgb(99, 110, 250)'}, name='Median')
+        fig.add_scatter(x=weeks, y=binned_df['mean_wait'], mode='lines',
+                        line={'color': 'black', 'dash': 'dash'}, name='Mean')
+
+        fig.update_layout(title='Total wait time vs time of referral',
+                          xaxis_title='Week of referral',
+                          yaxis_title='Total wait time (weeks)')
         return fig
 
     def calculate_mean_queue_numbers(self):
@@ -78,7 +211,15 @@ class Trial_Results_Calculator:
         """
 
         # read in queue numbers csv
-        self.queue_numbers_df = pd.read_csv('queue_numbers.csv')
+        self.queue_numbers_df = pd.read_csv(os.path.join(self.output_dir, 'queue_numbers.csv'))
+
+        # runs that stopped at a steady state (stop_at_steady_state) stopped adding tracked
+        # patients before sim_duration (files written before this was recorded have no column)
+        if 'sim_duration' not in self.queue_numbers_df:
+            self.queue_numbers_df['sim_duration'] = self.sim_duration
+        # (queue_numbers.csv numbers the runs from 0)
+        self.run_sim_durations = dict(zip(self.queue_numbers_df['run'] + 1,
+                                          self.queue_numbers_df['sim_duration']))
 
         # calculate mean queue numbers
         data = {
@@ -100,6 +241,8 @@ class Trial_Results_Calculator:
         """
         Plot the average queue numbers as an interactive plot using the plotly express module
         """
+        import plotly.express as px
+
         fig = px.bar(self.overall_q_numbers_df, barmode='group',
                      title='Numbers in waiting lists at start and end of simulation',
                      labels={'value': 'Patients waiting',
@@ -134,11 +277,8 @@ class Trial_Results_Calculator:
 
         """
 
-        #read trial results csv
-        trial_results_df = pd.read_csv('all_wait_times.csv')
-
         #return average wait time for patients who entered pathway on day 0
-        return trial_results_df[trial_results_df['time_entered_pathway'] < 1]['overall_queue_time'].mean()
+        return self.mean_wait_for_referrals(entered_before=1)
 
     def readout_wait_time_end(self):
         """
@@ -147,17 +287,66 @@ class Trial_Results_Calculator:
         Returns
         ---
         A single float representing the average wait time for entered the pathway on the final day
-        of the simulation or later
+        of the simulation or later (the final day of each run, for runs that stopped early)
 
         TODO: Check whether this will be an underestimate for the prefills
         """
 
-        # read trial results csv
-        trial_results_df = pd.read_csv('all_wait_times.csv')
-
         # return average wait time for patients who entered pathway on final day of simulation
-        last_day = self.sim_duration - 1
-        return trial_results_df[trial_results_df['time_entered_pathway'] > last_day]['overall_queue_time'].mean()
+        total_wait = 0.0
+        number_of_patients = 0
+        for run, run_df in self.iter_run_wait_times():
+            waits = self.final_week_waits(run, run_df)
+            total_wait += waits.sum()
+            number_of_patients += len(waits)
+
+        return total_wait / number_of_patients if number_of_patients else np.nan
+
+    def run_sim_duration(self, run):
+        """
+        Method to return the week a run stopped adding tracked patients - sim_duration, or the
+        week it reached a steady state if it stopped early (stop_at_steady_state)
+
+        Uses sim_duration for every run until calculate_mean_queue_numbers has been called.
+
+        Parameters
+        ------
+
+        run: int
+            The run (numbered from 1, as in all_wait_times.csv).
+        """
+        return self.run_sim_durations.get(run, self.sim_duration)
+
+    def final_week_waits(self, run, run_df):
+        """
+        Method to return the waits of the patients referred in the final week of a run
+
+        Returns
+        ---
+        A series of overall queue times
+        """
+        last_week = self.run_sim_duration(run) - 1
+        return run_df.loc[run_df['time_entered_pathway'] > last_week, 'overall_queue_time']
+
+    def mean_wait_for_referrals(self, entered_after = -np.inf, entered_before = np.inf):
+        """
+        Method to calculate the average wait of the patients referred between two times
+        (not including the times themselves), over all runs
+
+        Returns
+        ---
+        A single float (NaN if no patients were referred between the times)
+        """
+        total_wait = 0.0
+        number_of_patients = 0
+        for run, run_df in self.iter_run_wait_times():
+            entered = run_df['time_entered_pathway']
+            waits = run_df.loc[(entered > entered_after) & (entered < entered_before),
+                               'overall_queue_time']
+            total_wait += waits.sum()
+            number_of_patients += len(waits)
+
+        return total_wait / number_of_patients if number_of_patients else np.nan
 
 
     def readout_total_52_plus(self):
@@ -169,14 +358,9 @@ class Trial_Results_Calculator:
         Float
         """
 
-        # read trial results csv
-        trial_results_df = pd.read_csv('all_wait_times.csv')
-
         # return number waiting over 52 weeks who entered pathway on final week of simulation
-        last_week = self.sim_duration - 1
-        entered_final_week = trial_results_df[trial_results_df['time_entered_pathway'] > last_week]
-        long_wait = entered_final_week[entered_final_week['overall_queue_time'] >= 52]
-        return int(long_wait.groupby('run').count()['overall_queue_time'].mean().round(0))
+        # (averaged over the runs, including any without long waiters)
+        return int(round(self.final_week_long_waiters_per_run(52).mean()))
 
 
         # return trial_results_df[trial_results_df['time_entered_pathway'] > last_week]['overall_queue_time']>52
@@ -191,12 +375,304 @@ class Trial_Results_Calculator:
         Float
         """
 
-        # read trial results csv
-        trial_results_df = pd.read_csv('all_wait_times.csv')
-
         # return number waiting over 65 weeks who entered pathway on final week of simulation
-        last_week = self.sim_duration - 1
-        entered_final_week = trial_results_df[trial_results_df['time_entered_pathway'] > last_week]
-        long_wait = entered_final_week[entered_final_week['overall_queue_time'] >= 65]
-        return int(long_wait.groupby('run').count()['overall_queue_time'].mean().round(0))
+        # (averaged over the runs, including any without long waiters)
+        return int(round(self.final_week_long_waiters_per_run(65).mean()))
         # return trial_results_df[trial_results_df['time_entered_pathway'] > last_week]['overall_queue_time']>65
+
+    def final_week_long_waiters_per_run(self, weeks):
+        """
+        Method to count the patients referred in the final week of the simulation who waited
+        at least the given number of weeks, in each run
+
+        Returns
+        ---
+        A series with the count for each run (numbered from 1)
+        """
+        counts = {}
+        for run, run_df in self.iter_run_wait_times():
+            counts[run] = int((self.final_week_waits(run, run_df) >= weeks).sum())
+        return pd.Series(counts, dtype=float).rename_axis('run')
+
+    def wait_time_index(self):
+        """
+        Method to return the cumulative counts of the waits of every run by week of referral
+        (see SurgeryWaitIndex.py)
+
+        The counts are built from the wait times the first time this is called, and kept, so
+        the number of long waiters for any threshold and weeks of referral can then be looked
+        up straight away.
+
+        Returns
+        ---
+        A Wait_Time_Index
+        """
+        if self.wait_index is None:
+            self.wait_index = Wait_Time_Index((run_df for run, run_df in self.iter_run_wait_times()),
+                                              self.number_of_runs, self.sim_duration)
+        return self.wait_index
+
+    def readout_long_waiters(self):
+        """
+        Method to count the patients waiting 52 or more and 65 or more weeks in each run
+        (out of all the patients referred during the simulation), as in readout_kpis
+
+        Returns
+        ---
+        A dataframe with a row per run (numbered from 1) and columns 'Long Waiters 52+' and
+        'Long Waiters 65+'
+        """
+        rows = []
+        for run, run_df in self.iter_run_wait_times():
+            waits = run_df['overall_queue_time']
+            rows.append({'run': run,
+                         'Long Waiters 52+': int((waits >= 52).sum()),
+                         'Long Waiters 65+': int((waits >= 65).sum())})
+        return pd.DataFrame(rows, columns=['run', 'Long Waiters 52+', 'Long Waiters 65+']).set_index('run')
+
+    def readout_long_waiters_over_time(self, by_stage = False):
+        """
+        Method to average the number of patients on the waiting list, and the number waiting
+        over 18, 52 and 65 weeks, at the end of each week over all the runs
+
+        These are the patients still waiting at the end of the week (with their RTT clock
+        still running), including prefill patients, who count as referred at the start of the
+        simulation. They are read from each run's long_waiters_run_{n}.csv, so only one run's
+        weekly counts are read at a time. Runs that stopped early at a steady state
+        (stop_at_steady_state) only count towards the weeks before they stopped.
+
+        Parameters
+        ------
+
+        by_stage: bool, default is False
+            If True, give the counts for each stage of the pathway separately.
+
+        Returns
+        ---
+        A dataframe with a row per week (from 1 to sim_duration), or per week and stage, and
+        columns waiting, waiting_over_18, waiting_over_52 and waiting_over_65
+        """
+        group_by = ['week', 'stage'] if by_stage else ['week']
+        total_df = None
+        # number of runs that recorded each week
+        runs_recorded = None
+        for run in range(self.number_of_runs):
+            run_df = pd.read_csv(os.path.join(self.output_dir, f'long_waiters_run_{run}.csv'))
+            # (the weeks after a run stopped tracking patients, which the model doesn't
+            # record, are left out whatever file is read)
+            run_df = run_df[run_df['week'] <= self.run_sim_duration(run + 1)]
+            run_df = run_df.groupby(group_by).sum(numeric_only=True)
+            run_recorded = pd.Series(1, index=run_df.index)
+            total_df = run_df if total_df is None else total_df.add(run_df, fill_value=0)
+            runs_recorded = (run_recorded if runs_recorded is None
+                             else runs_recorded.add(run_recorded, fill_value=0))
+        return total_df.div(runs_recorded, axis=0)
+
+    def plot_long_waiters_over_time(self):
+        """
+        Plot the average number of long waiters on the waiting list at the end of each week as
+        an interactive plot using the plotly express module
+        """
+        import plotly.express as px
+
+        long_waiters_df = self.readout_long_waiters_over_time().drop(columns='waiting')
+        fig = px.line(long_waiters_df.rename(columns=lambda column: column.replace('waiting_over_', 'Over ') + ' weeks'),
+                      title='Patients on the waiting list waiting a long time',
+                      labels={'value': 'Average number of patients waiting',
+                              'week': 'Week of simulation',
+                              'variable': 'Wait so far'})
+        return fig
+
+    def wait_sketches(self):
+        """
+        Method to merge the sketches of the waits from every run (see SurgeryQuantileSketch.py)
+
+        The result can be merged with the sketches of other trials (e.g. other scenarios) with
+        merge_sketches.
+
+        Returns
+        ---
+        A dictionary of Quantile_Sketch, one for the wait for each stage of the pathway and
+        one ('overall') for the overall RTT wait
+        """
+        return merge_sketches(
+            load_sketches(os.path.join(self.output_dir, f'wait_sketches_run_{run}.json'))
+            for run in range(self.number_of_runs))
+
+    def readout_wait_percentiles(self, percentiles = (50, 92)):
+        """
+        Method to estimate percentiles of the waits of the patients referred during the
+        simulation, over all the runs
+
+        The percentiles come from sketches of the waits, so are within 1% of the percentiles
+        of every patient's wait, and take the same time and memory however many patients and
+        runs there are.
+
+        Returns
+        ---
+        A dataframe with a row for the wait for each stage and for the overall wait, and a
+        column for each percentile (e.g. p50, p92)
+        """
+        return pd.DataFrame({f'p{percentile}': {name: sketch.quantile(percentile / 100)
+                                                for name, sketch in self.wait_sketches().items()}
+                             for percentile in percentiles})
+
+    def readout_kpis(self):
+        """
+        Method to collect the headline figures for the trial in one place
+
+        Must be called after concatenate_wait_times and calculate_mean_queue_numbers.
+
+        Returns
+        ---
+        A dictionary with the same keys as `Analytic_Pathway_Estimator.estimate_kpis`
+        (other than drain_week), so that estimates and simulation results can be compared
+        """
+        return {
+            'clinic_queue_end': float(self.overall_q_numbers_df.loc['Clinic', 'After']),
+            'theatre_queue_end': float(self.overall_q_numbers_df.loc['Theatres', 'After']),
+            'total_queue_end': float(self.readout_total_queue_numbers()),
+            'mean_wait_start': float(self.readout_wait_time_start()),
+            'mean_wait_end': float(self.readout_wait_time_end()),
+            'total_52_plus': self.readout_total_52_plus(),
+            'total_65_plus': self.readout_total_65_plus(),
+        }
+
+    def readout_run_kpis(self):
+        """
+        Method to calculate the headline figures for each run separately
+
+        Must be called after concatenate_wait_times and calculate_mean_queue_numbers.
+
+        Returns
+        ---
+        A dataframe with a row per run (numbered from 1, as in all_wait_times.csv) and a column
+        for each of the keys of `readout_kpis`. The mean of each column is the figure given by
+        `readout_kpis` (other than the rounding of the long waiter counts).
+        """
+        # queue_numbers.csv numbers the runs from 0
+        queue_numbers_df = self.queue_numbers_df.set_index(self.queue_numbers_df['run'] + 1)
+
+        rows = []
+        for run, run_df in self.iter_run_wait_times():
+            entered = run_df['time_entered_pathway']
+            first_week_waits = run_df.loc[entered < 1, 'overall_queue_time']
+            final_week_waits = self.final_week_waits(run, run_df)
+            clinic_queue = queue_numbers_df.loc[run, 'clinic_queue']
+            theatre_queue = queue_numbers_df.loc[run, 'theatres_queue']
+
+            rows.append({'run': run,
+                         'clinic_queue_end': clinic_queue,
+                         'theatre_queue_end': theatre_queue,
+                         'total_queue_end': clinic_queue + theatre_queue,
+                         'mean_wait_start': first_week_waits.mean(),
+                         'mean_wait_end': final_week_waits.mean(),
+                         'total_52_plus': (final_week_waits >= 52).sum(),
+                         'total_65_plus': (final_week_waits >= 65).sum()})
+
+        return pd.DataFrame(rows).set_index('run').astype(float)
+
+    def steady_state_wait_times(self):
+        """
+        Method to remove the warm-up period from the start of each run's wait times
+
+        The warm-up of each run is found with MSER-5 (see SurgerySteadyState.mser_truncation),
+        using the run's waits in order of referral.
+
+        Returns
+        ---
+        A tuple of
+        - a dataframe of the wait times (as in all_wait_times.csv) after each run's warm-up
+        - a dataframe with a row per run giving its warm-up: the number of patients deleted,
+          the week of referral the steady state starts from, and whether the warm-up found is
+          reliable (if not, the run's waits had not settled down by the end of the simulation,
+          e.g. because the waiting list was still growing)
+        """
+        steady_state_runs = []
+        warm_up_rows = []
+        for run, run_df, warm_up_row in self.iter_steady_state_wait_times():
+            steady_state_runs.append(run_df.assign(run=run))
+            warm_up_rows.append(warm_up_row)
+
+        return (pd.concat(steady_state_runs), pd.DataFrame(warm_up_rows).set_index('run'))
+
+    def iter_steady_state_wait_times(self):
+        """
+        A method to go through the wait times of the trial one run at a time, with each run's
+        warm-up removed (see `steady_state_wait_times`)
+
+        Returns
+        ---
+        A generator of (run, dataframe of the run's wait times after its warm-up in order of
+        referral, dictionary describing the run's warm-up)
+        """
+        for run, run_df in self.iter_run_wait_times():
+            run_df = run_df.sort_values('time_entered_pathway', kind='stable')
+            warm_up, reliable = mser_truncation(run_df['overall_queue_time'])
+            warm_up_week = (run_df['time_entered_pathway'].iloc[min(warm_up, len(run_df) - 1)]
+                            if len(run_df) else np.nan)
+
+            yield run, run_df.iloc[warm_up:], {'run': run,
+                                               'warm_up_patients': warm_up,
+                                               'warm_up_week': warm_up_week,
+                                               'reliable': reliable}
+
+    def readout_steady_state_wait(self):
+        """
+        Method to calculate the average wait once the pathway has settled into a steady state
+
+        Unlike readout_wait_time_start and readout_wait_time_end, this isn't affected by the
+        queues the simulation is prefilled with, as each run's warm-up is removed first.
+
+        Returns
+        ---
+        A dataframe with a row per run giving its warm-up (see `steady_state_wait_times`) and
+        the mean wait after the warm-up, with the half-width of its 95% confidence interval
+        (from batch means, as consecutive waits are correlated)
+        """
+        rows = []
+        for run, run_df, warm_up_row in self.iter_steady_state_wait_times():
+            mean, half_width = batch_means_interval(run_df['overall_queue_time'])
+            rows.append({**warm_up_row, 'steady_state_mean_wait': mean, 'half_width': half_width})
+
+        return pd.DataFrame(rows).set_index('run')
+
+    def readout_batch_means(self, confidence = 0.95):
+        """
+        Method to estimate steady state KPIs, with confidence intervals, from each run on its own
+
+        This is meant for a trial of a single long run, as an alternative to averaging over
+        many runs (which each pay the cost of the prefill and the drain at the end). Each
+        run's warm-up is deleted (see `steady_state_wait_times`) and the rest of its waits,
+        in order of referral, are analysed by batch means (see SurgerySteadyState.batch_means).
+
+        The KPIs are
+        - mean_wait: mean wait (weeks)
+        - share_18_plus, share_52_plus: the proportion of patients waiting 18+ or 52+ weeks
+
+        Returns
+        ---
+        A dataframe with a row per run and KPI, giving the estimate, its confidence interval,
+        the batches used, and whether the batch means passed the autocorrelation check.
+        If either the warm-up or the autocorrelation check is not reliable, the run is too
+        short (or the pathway has no steady state) and the interval should not be trusted.
+        """
+        rows = []
+        for run, run_df, warm_up_row in self.iter_steady_state_wait_times():
+            waits = run_df['overall_queue_time'].to_numpy()
+            for kpi, values in [('mean_wait', waits),
+                                ('share_18_plus', waits >= 18),
+                                ('share_52_plus', waits >= 52)]:
+                result = batch_means(values, confidence=confidence)
+                rows.append({'run': run, 'kpi': kpi,
+                             'estimate': result['mean'],
+                             'ci_lower': result['mean'] - result['half_width'],
+                             'ci_upper': result['mean'] + result['half_width'],
+                             'batch_size': result['batch_size'],
+                             'number_of_batches': result['number_of_batches'],
+                             'lag1_autocorrelation': result['lag1_autocorrelation'],
+                             'autocorrelation_ok': result['autocorrelation_ok'],
+                             'warm_up_week': warm_up_row['warm_up_week'],
+                             'warm_up_reliable': warm_up_row['reliable']})
+
+        return pd.DataFrame(rows).set_index(['run', 'kpi'])
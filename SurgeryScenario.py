@@ -0,0 +1,175 @@
+# A class holding every parameter of a scenario of the Neurosurgery RTT pathway model
+#
+# The parameters of a scenario used to be passed around as keyword arguments, with anything
+# not given taken from the defaults in global_params.g. A Scenario_Config holds all of them in
+# one object that can't be changed once it is created, so
+# - it can be sent to worker processes as a single small object
+# - it has a key (a hash of every parameter) that is the same in every process and every
+#   session, which the result store uses to find earlier runs of the scenario
+# - two scenarios with the same parameters are equal, so it can be used as a dictionary key
+#
+# For example
+#   scenario_config = Scenario_Config(referrals_per_week=35, service_mode='session')
+#   trial_results_calculator = run_trial(number_of_runs=10, seed=42, scenario_config=scenario_config)
+
+import dataclasses
+import hashlib
+import json
+
+import numpy as np
+
+from global_params import g
+from SurgeryPathwayGraph import Pathway_Graph
+
+# The parameters given as settings (dictionaries or lists) rather than single values. These
+# are held as json text, so they can't be changed and compare (and hash) the same whatever
+# order their keys were given in.
+SETTINGS_PARAMETERS = ['demand_profile', 'pathway_graph', 'capacity_calendar']
+
+
+def json_value(value):
+    """
+    Function to turn numpy arrays and numbers into values that can be written as json
+    """
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    raise TypeError(f"A {type(value).__name__} can't be part of a scenario - give its settings instead")
+
+
+def canonical_json(value):
+    """
+    Function to write a value as json, the same way every time (with sorted keys and no spaces)
+
+    Returns
+    ---
+    A string
+    """
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), default=json_value)
+
+
+def build_scenario_config(scenario_config = None, **pathway_params):
+    """
+    Function to create the Scenario_Config for a model or trial
+
+    Parameters
+    ------
+
+    scenario_config: Scenario_Config or dict, default is None
+        The scenario to start from. If None, the defaults from `g`.
+
+    **pathway_params:
+        Any keyword arguments accepted by `Neurosurgery_Pathway` (e.g. referrals_per_week),
+        which replace the scenario's.
+
+    Returns
+    ---
+    A Scenario_Config
+    """
+    if scenario_config is None:
+        return Scenario_Config(**pathway_params)
+    if isinstance(scenario_config, dict):
+        return Scenario_Config(**{**scenario_config, **pathway_params})
+    return dataclasses.replace(scenario_config, **pathway_params)
+
+
+@dataclasses.dataclass(frozen=True)
+class Scenario_Config:
+    """
+    Every parameter of a scenario of the pathway model (see `Neurosurgery_Pathway` for what
+    each one means), fixed once it is created.
+
+    The settings parameters (demand_profile, pathway_graph, capacity_calendar) can be given as
+    dictionaries or lists (or a pathway graph as a Pathway_Graph), and are held as json text.
+    pathway_params() gives them back as dictionaries and lists.
+
+    The settings of a run rather than a scenario - its run number, random seed, whether it
+    uses antithetic random numbers and where it writes its results - are not part of it.
+    """
+    referrals_per_week: float = g.referrals_per_week
+    demand_profile: str = None
+    surg_clinic_per_week: int = g.surg_clinic_per_week
+    surg_clinic_capacity: int = g.surg_clinic_appts
+    theatre_list_per_week: int = g.theatre_list_per_week
+    theatre_list_capacity: int = g.theatre_list_capacity
+    trauma_list_per_week: int = g.trauma_list_per_week
+    weekly_extra_patients: int = g.weekly_extra_patients
+    fill_non_admitted_queue: int = g.fill_non_admitted_queue
+    fill_admitted_queue: int = g.fill_admitted_queue
+    sim_duration: int = g.sim_duration
+    max_drain_weeks: int = 52 * 10
+    drain_mode: str = 'patients'
+    pathway_graph: str = None
+    capacity_calendar: str = None
+    service_mode: str = 'continuous'
+    prob_urgent: float = 0.0
+    reneging_rate: float = 0.0
+    stop_at_steady_state: bool = False
+    steady_state_precision: float = 0.05
+
+    def __post_init__(self):
+        # (object.__setattr__ is needed to set attributes of a frozen dataclass)
+        for field in dataclasses.fields(self):
+            value = getattr(self, field.name)
+
+            if field.name in SETTINGS_PARAMETERS:
+                if isinstance(value, Pathway_Graph):
+                    value = value.to_dict()
+                elif isinstance(value, str):
+                    # already json (e.g. from another Scenario_Config) - rewritten the same way
+                    value = json.loads(value)
+                if value is not None:
+                    value = canonical_json(value)
+
+            elif isinstance(value, np.generic):
+                # numpy numbers (e.g. from a parameter sweep) as python numbers
+                value = value.item()
+
+            # so that e.g. 30 and 30.0 referrals per week (or 4 and 4.0 clinics per week) are
+            # the same scenario, with the same key
+            if field.type is float and isinstance(value, int) and not isinstance(value, bool):
+                value = float(value)
+            elif field.type is int and isinstance(value, float):
+                if not value.is_integer():
+                    raise ValueError(f"{field.name} must be a whole number, not {value}")
+                value = int(value)
+
+            object.__setattr__(self, field.name, value)
+
+    def pathway_params(self):
+        """
+        Method to return the scenario as keyword arguments for `Neurosurgery_Pathway`
+
+        Returns
+        ---
+        A dictionary with a value for every parameter (settings as dictionaries and lists)
+        """
+        params = dataclasses.asdict(self)
+        for name in SETTINGS_PARAMETERS:
+            if params[name] is not None:
+                params[name] = json.loads(params[name])
+        return params
+
+    def to_json(self):
+        """
+        Method to write the scenario as compact json, the same way every time
+        """
+        return canonical_json(self.pathway_params())
+
+    @classmethod
+    def from_json(cls, text):
+        """
+        Method to read a scenario written by to_json
+        """
+        return cls(**json.loads(text))
+
+    def key(self):
+        """
+        Method to create a fingerprint of the scenario, which is the same in every process
+
+        (Python's own hash of a string changes from one process to the next, so isn't used.)
+
+        Returns
+        ---
+        A string (the sha256 hash of the scenario's json)
+        """
+        return hashlib.sha256(self.to_json().encode()).hexdigest()
@@ -0,0 +1,220 @@
+# Functions to find the steady state of the Neurosurgery RTT pathway simulation
+#
+# At the start of a run, the waits are affected by the queues the run is prefilled with
+# (e.g. prefill patients have no wait before the simulation starts), so waits from the early
+# part of a run (the 'warm-up') don't represent how the pathway behaves in the long run.
+# These functions find where the warm-up ends, so it can be left out of the results.
+
+import numpy as np
+
+
+def mser_truncation(values, batch_size = 5):
+    """
+    Function to find the warm-up period of a series using MSER (Marginal Standard Error Rule)
+
+    The series is averaged in batches of batch_size (MSER-5 with the default), and the
+    warm-up is the number of batches to delete from the start that minimises
+        (variance of the remaining batch means) / (number of remaining batch means)
+    i.e. the squared standard error of the mean of what is left. Deleting a transient makes
+    what's left less variable, but deleting too much leaves too little data, so the minimum
+    balances the two. Only the first half of the series is considered for deletion, as
+    MSER tends to favour deleting all but the last few batches of a series.
+
+    Parameters
+    ------
+
+    values: array-like
+        The series, in time order (e.g. wait times in order of referral).
+
+    batch_size: int, default is 5
+        Number of values averaged into each batch.
+
+    Returns
+    ---
+    A tuple of
+    - the number of values to delete from the start of the series
+    - whether the result is reliable. If the minimum is at the end of the first half of the
+      series, the series is still changing (e.g. the waiting list is still growing), so has
+      not reached a steady state.
+    """
+    values = np.asarray(values, dtype=float)
+    number_of_batches = len(values) // batch_size
+    if number_of_batches < 4:
+        return 0, False
+
+    batch_means = values[:number_of_batches * batch_size].reshape(number_of_batches, batch_size).mean(axis=1)
+
+    # sums (and sums of squares) of the batch means left after deleting d batches,
+    # for every d at once
+    remaining_sum = np.cumsum(batch_means[::-1])[::-1]
+    remaining_sum_of_squares = np.cumsum(batch_means[::-1] ** 2)[::-1]
+    remaining_count = np.arange(number_of_batches, 0, -1)
+
+    sum_of_squared_deviations = remaining_sum_of_squares - remaining_sum ** 2 / remaining_count
+    mser = sum_of_squared_deviations / remaining_count ** 2
+
+    half_of_batches = number_of_batches // 2
+    deleted_batches = int(np.argmin(mser[:half_of_batches + 1]))
+
+    return deleted_batches * batch_size, deleted_batches < half_of_batches
+
+
+def batch_averages(values, batch_size):
+    """
+    Function to split a series into equal batches of batch_size values and average each one
+
+    Any values left over are dropped from the start, where the series is least settled.
+
+    Returns
+    ---
+    A numpy array with the mean of each batch
+    """
+    values = np.asarray(values, dtype=float)
+    number_of_batches = len(values) // batch_size
+    return values[len(values) - number_of_batches * batch_size:].reshape(
+        number_of_batches, batch_size).mean(axis=1)
+
+
+def batch_means_interval(values, number_of_batches = 10, confidence = 0.95, batch_size = None):
+    """
+    Function to calculate a confidence interval for the mean of a series of correlated values
+
+    Consecutive waits are correlated (patients referred at about the same time meet the same
+    queues), so a confidence interval that treats each wait as independent is far too narrow.
+    Instead the series is split into number_of_batches equal batches (or, if batch_size is
+    given, as many batches of batch_size as fit), whose means are close to independent. The
+    mean and the interval are both calculated from the batch means, so both leave out the
+    same values left over at the start.
+
+    Returns
+    ---
+    A tuple of the mean and the half-width of the confidence interval (NaN if there are fewer
+    values than batches, and the half-width is NaN if there is only one batch)
+    """
+    values = np.asarray(values, dtype=float)
+    if batch_size is None:
+        batch_size = len(values) // number_of_batches
+    if batch_size == 0 or len(values) < batch_size:
+        return np.nan, np.nan
+
+    means_of_batches = batch_averages(values, batch_size)
+    number_of_batches = len(means_of_batches)
+    if number_of_batches < 2:
+        return float(means_of_batches.mean()), np.nan
+
+    # scipy is only needed for the interval, so is imported here to keep it (and its memory)
+    # out of runs that don't report one
+    from scipy import stats
+    t_value = stats.t.ppf(0.5 + confidence / 2, number_of_batches - 1)
+    half_width = t_value * means_of_batches.std(ddof=1) / np.sqrt(number_of_batches)
+
+    return float(means_of_batches.mean()), float(half_width)
+
+
+def steady_state_converged(values, precision = 0.05, minimum_values = 200, batch_size = 5,
+                           number_of_batches = 10, confidence = 0.95, times = None,
+                           minimum_span = 0):
+    """
+    Function to check whether the steady state mean of a series is known precisely enough
+
+    The warm-up is found with `mser_truncation` and deleted, and the mean of the rest is
+    estimated with `batch_means_interval`.
+
+    If the times of the values are given (e.g. the weeks of referral), the values after the
+    warm-up must also cover at least minimum_span of time. Otherwise a short stretch of a
+    slowly changing series can look settled.
+
+    Returns
+    ---
+    True if
+    - the warm-up result is reliable
+    - the half-width of the confidence interval is no more than `precision` times the mean
+    - the means of the first and second halves of the series after the warm-up are within
+      `precision` of each other (a slow trend can otherwise pass for a steady state)
+    """
+    if len(values) < minimum_values:
+        return False
+
+    warm_up, reliable = mser_truncation(values, batch_size)
+    if not reliable:
+        return False
+
+    if times is not None and len(times) > 0 and times[-1] - times[warm_up] < minimum_span:
+        return False
+
+    steady_state_values = np.asarray(values[warm_up:], dtype=float)
+    mean, half_width = batch_means_interval(steady_state_values, number_of_batches, confidence)
+
+    first_half, second_half = np.array_split(steady_state_values, 2)
+    trend = abs(second_half.mean() - first_half.mean())
+
+    return bool(half_width <= precision * abs(mean) and trend <= precision * abs(mean))
+
+
+def lag1_autocorrelation(values):
+    """
+    Function to calculate the correlation between each value of a series and the next
+
+    Returns
+    ---
+    A float (NaN if the series has fewer than 3 values or doesn't vary)
+    """
+    values = np.asarray(values, dtype=float)
+    if len(values) < 3:
+        return np.nan
+    deviations = values - values.mean()
+    sum_of_squares = np.sum(deviations ** 2)
+    if sum_of_squares == 0:
+        return np.nan
+    return float(np.sum(deviations[:-1] * deviations[1:]) / sum_of_squares)
+
+
+def batch_means(values, confidence = 0.95, initial_batches = 256, minimum_batches = 10,
+                max_autocorrelation = 0.2):
+    """
+    Function to estimate the mean of a long series of correlated values, with its confidence
+    interval, choosing the batch size automatically
+
+    The series is split into equal batches, starting with initial_batches of them. The batch
+    means are only treated as independent if the correlation between neighbouring batch
+    means (the lag 1 autocorrelation) is below max_autocorrelation, so the batch size is
+    doubled until it is - or until there would be fewer than minimum_batches batches, in
+    which case the series is too short for a reliable interval.
+
+    Any warm-up should already have been removed (e.g. with `mser_truncation`).
+
+    Returns
+    ---
+    A dictionary of
+    - mean, half_width: the mean of the series (of the values in the batches), and the
+      half-width of its confidence interval (from `batch_means_interval`)
+    - batch_size, number_of_batches: the batches used
+    - lag1_autocorrelation: of the batch means
+    - autocorrelation_ok: whether lag1_autocorrelation is below max_autocorrelation
+    """
+    values = np.asarray(values, dtype=float)
+    if len(values) < minimum_batches:
+        return {'mean': float(values.mean()) if len(values) else np.nan, 'half_width': np.nan,
+                'batch_size': 0, 'number_of_batches': 0, 'lag1_autocorrelation': np.nan,
+                'autocorrelation_ok': False}
+
+    batch_size = max(1, len(values) // initial_batches)
+
+    while True:
+        means_of_batches = batch_averages(values, batch_size)
+        number_of_batches = len(means_of_batches)
+        autocorrelation = lag1_autocorrelation(means_of_batches)
+
+        autocorrelation_ok = bool(np.isnan(autocorrelation) or autocorrelation < max_autocorrelation)
+        if autocorrelation_ok or len(values) // (batch_size * 2) < minimum_batches:
+            break
+        batch_size *= 2
+
+    mean, half_width = batch_means_interval(values, confidence=confidence, batch_size=batch_size)
+
+    return {'mean': mean,
+            'half_width': half_width,
+            'batch_size': batch_size,
+            'number_of_batches': number_of_batches,
+            'lag1_autocorrelation': autocorrelation,
+            'autocorrelation_ok': autocorrelation_ok and number_of_batches >= minimum_batches}
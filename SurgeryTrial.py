@@ -0,0 +1,353 @@
+# Functions to run a full trial (multiple runs) of the Neurosurgery RTT pathway model
+
+import contextlib
+import csv
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from global_params import g
+from SurgeryPathway import Neurosurgery_Pathway
+from SurgeryResultsCalculator import Trial_Results_Calculator
+from SurgeryScenario import build_scenario_config
+from profiling import profile_section
+
+
+def replication_seeds(seed, number_of_runs):
+    """
+    Function to create a separate random seed for each run of a trial
+
+    The seeds are spread out using numpy's SeedSequence, so that runs don't produce
+    overlapping streams of random numbers.
+
+    Returns
+    ---
+    A list of ints (or a list of None if seed is None, so every run is unrepeatable)
+    """
+    if seed is None:
+        return [None] * number_of_runs
+    return [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(number_of_runs)]
+
+
+def replication_settings(seed, number_of_runs, antithetic = False):
+    """
+    Function to create the random number settings for each run of a trial
+
+    With antithetic=True, the runs are done in antithetic pairs: runs 0 and 1 share a seed,
+    with run 1 using the antithetic random numbers, and so on (see SurgeryVariates.py).
+
+    Returns
+    ---
+    A list with a dictionary of keyword arguments for Neurosurgery_Pathway for each run
+    """
+    if not antithetic:
+        return [{'random_seed': run_seed} for run_seed in replication_seeds(seed, number_of_runs)]
+
+    # The two runs of a pair need the same seed, even if the trial as a whole isn't repeatable
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    pair_seeds = replication_seeds(seed, (number_of_runs + 1) // 2)
+    return [{'random_seed': pair_seeds[run // 2], 'antithetic': run % 2 == 1}
+            for run in range(number_of_runs)]
+
+
+def start_queue_numbers_file(output_dir = '.'):
+    """
+    Function to create the file that each run adds its end-of-simulation queue numbers to
+    """
+    with open(os.path.join(output_dir, 'queue_numbers.csv'), 'w') as csvfile:
+        writer = csv.writer(csvfile, delimiter=',')
+        writer.writerow(['run','clinic_queue', 'theatres_queue', 'sim_duration'])
+
+
+def collate_trial(number_of_runs, scenario_config, output_dir = '.'):
+    """
+    Function to collate the results once every run of a trial is complete
+
+    Returns
+    ---
+    A Trial_Results_Calculator that has already concatenated the wait times and calculated the
+    mean queue numbers, ready for the readout methods to be called
+    """
+    trial_results_calculator = Trial_Results_Calculator.from_scenario(
+        scenario_config, number_of_runs=number_of_runs, output_dir=output_dir)
+
+    trial_results_calculator.concatenate_wait_times()
+    trial_results_calculator.calculate_mean_queue_numbers()
+
+    return trial_results_calculator
+
+
+def run_replication(run_number, scenario_config, random_seed = None, antithetic = False,
+                    output_dir = '.', result_store = None):
+    """
+    Function to do a single run of a scenario (a Scenario_Config), writing its results to
+    output_dir
+
+    This is a plain function (rather than a method) so it can be sent to worker processes,
+    along with the scenario as a single small object.
+
+    If a Result_Store is given and it already holds this run (the same parameters and seed),
+    the stored results are copied to output_dir instead of running the simulation again.
+    Otherwise the run's results are added to the store.
+
+    Returns
+    ---
+    A tuple of the run number and the number of patients in the clinic and theatre queues at
+    the end of the simulation
+    """
+    if result_store is not None:
+        stored_result = result_store.get(run_number, scenario_config, random_seed, antithetic,
+                                         output_dir)
+        if stored_result is not None:
+            return run_number, stored_result['clinic_queue'], stored_result['theatre_queue']
+
+    pathway_model = Neurosurgery_Pathway.from_scenario(run_number, scenario_config,
+                                                       random_seed=random_seed,
+                                                       antithetic=antithetic,
+                                                       output_dir=output_dir)
+    pathway_model.run()
+
+    if result_store is not None:
+        result_store.put(pathway_model, scenario_config, random_seed, antithetic)
+
+    return run_number, pathway_model.clinic_queue_length, pathway_model.theatre_queue_length
+
+
+def run_trial(number_of_runs = g.number_of_runs, seed = None, workers = 1, output_dir = '.',
+              profile = False, profile_dir = 'profiles', result_store = None,
+              antithetic = False, scenario_config = None, **pathway_params):
+    """
+    Function to run the simulation several times and collate the results
+
+    Parameters
+    ------
+
+    number_of_runs: int, default is `g.number_of_runs`
+        Number of times to run the simulation.
+
+    seed: int, default is None
+        Seed for the trial. Each run gets its own seed derived from this, so the whole trial
+        can be reproduced exactly. If None, each trial gives different results.
+
+    workers: int, default is 1
+        Number of processes to do the runs in. With more than 1, runs are done in parallel.
+
+    output_dir: str, default is '.'
+        Folder to write the results files to (created if it does not exist).
+
+    profile: bool, default is False
+        If True, profile the CPU time and memory use of the whole trial (all of the runs and
+        collating the results) and write a report and the raw profiles to profile_dir.
+        See profiling.profile_section for details. Runs done in worker processes are not
+        included in the profile.
+
+    profile_dir: str, default is 'profiles'
+        Folder to write the profiling outputs to.
+
+    result_store: Result_Store, default is None
+        Store of earlier runs to reuse (see SurgeryResultStore.py). Runs already in the store
+        are not done again, and new runs are added to it. Only used if seed is given.
+
+    antithetic: bool, default is False
+        If True, do the runs in antithetic pairs (see `replication_settings`). This gives
+        more precise averages for the same number of runs, but means the runs are no longer
+        independent, so number_of_runs should be even.
+
+    scenario_config: Scenario_Config, default is None
+        The scenario to run (see SurgeryScenario.py). If None, the defaults from `g`.
+
+    **pathway_params:
+        Any keyword arguments accepted by `Neurosurgery_Pathway` (e.g. referrals_per_week),
+        which replace those of scenario_config.
+
+    Returns
+    ---
+    A Trial_Results_Calculator that has already concatenated the wait times and calculated the
+    mean queue numbers, ready for the readout methods to be called
+    """
+    scenario_config = build_scenario_config(scenario_config, **pathway_params)
+    os.makedirs(output_dir, exist_ok=True)
+    run_settings = replication_settings(seed, number_of_runs, antithetic)
+
+    if profile:
+        profiler = profile_section('trial', profile_dir)
+    else:
+        profiler = contextlib.nullcontext()
+
+    with profiler:
+        start_queue_numbers_file(output_dir)
+
+        # For the number of runs specified, create an instance of the
+        # Neurosurgery_Pathway class, and call its run method
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(run_replication, run, scenario_config,
+                                           output_dir=output_dir, result_store=result_store,
+                                           **run_settings[run])
+                           for run in range(number_of_runs)]
+                for completed, future in enumerate(futures):
+                    future.result()
+                    print (f"Run {completed+1} of {number_of_runs} complete")
+        else:
+            for run in range(number_of_runs):
+                print (f"Run {run+1} of {number_of_runs}")
+                run_replication(run, scenario_config, output_dir=output_dir,
+                                result_store=result_store, **run_settings[run])
+
+        trial_results_calculator = collate_trial(number_of_runs, scenario_config, output_dir)
+
+    return trial_results_calculator
+
+
+class Trial_Job:
+    """
+    A trial running in the background, e.g. while the Streamlit app stays responsive.
+
+    The runs are submitted to an executor (such as a ProcessPoolExecutor shared by the whole
+    app) as soon as the job is created. The job can then be polled for its progress, cancelled,
+    or asked for its results once every run is complete.
+
+    Parameters
+    ------
+
+    executor: concurrent.futures.Executor
+        Executor to do the runs in.
+
+    number_of_runs: int, default is `g.number_of_runs`
+        Number of times to run the simulation.
+
+    seed: int, default is None
+        Seed for the trial, as for `run_trial`.
+
+    output_dir: str, default is None
+        Folder to write the results files to. If None, a new temporary folder is used so
+        that jobs from different users of the app cannot overwrite each other's results.
+
+    result_store: Result_Store, default is None
+        Store of earlier runs to reuse, as for `run_trial`.
+
+    antithetic: bool, default is False
+        If True, do the runs in antithetic pairs, as for `run_trial`.
+
+    scenario_config: Scenario_Config, default is None
+        The scenario to run, as for `run_trial`.
+
+    **pathway_params:
+        Any keyword arguments accepted by `Neurosurgery_Pathway`, which replace those of
+        scenario_config.
+    """
+    def __init__(self, executor, number_of_runs = g.number_of_runs, seed = None,
+                 output_dir = None, result_store = None, antithetic = False,
+                 scenario_config = None, **pathway_params):
+        self.number_of_runs = number_of_runs
+        self.seed = seed
+        self.antithetic = antithetic
+        self.scenario_config = build_scenario_config(scenario_config, **pathway_params)
+        self.cancelled = False
+        self.trial_results_calculator = None
+
+        if output_dir is None:
+            output_dir = tempfile.mkdtemp(prefix='neurosurgery_trial_')
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+
+        start_queue_numbers_file(self.output_dir)
+
+        run_settings = replication_settings(seed, number_of_runs, antithetic)
+        self.futures = [executor.submit(run_replication, run, self.scenario_config,
+                                        output_dir=self.output_dir, result_store=result_store,
+                                        **run_settings[run])
+                        for run in range(number_of_runs)]
+
+    def completed_runs(self):
+        """
+        Method to count the runs that have finished
+        """
+        return sum(1 for future in self.futures if future.done() and not future.cancelled())
+
+    def progress(self):
+        """
+        Method to return the fraction of runs that have finished (between 0 and 1)
+        """
+        return self.completed_runs() / self.number_of_runs
+
+    def done(self):
+        """
+        Method to check whether every run has finished (successfully or not)
+        """
+        return all(future.done() for future in self.futures)
+
+    def running(self):
+        """
+        Method to check whether the job still has runs to do
+        """
+        return not self.cancelled and not self.done()
+
+    def error(self):
+        """
+        Method to return the first error raised by any of the runs (or None if there were none)
+        """
+        for future in self.futures:
+            if future.done() and not future.cancelled() and future.exception() is not None:
+                return future.exception()
+        return None
+
+    def cancel(self):
+        """
+        Method to cancel the job
+
+        Runs that have not started yet are cancelled straight away. Any run that is already
+        under way is left to finish, but its results are not used.
+        """
+        self.cancelled = True
+        for future in self.futures:
+            future.cancel()
+
+    def results(self):
+        """
+        Method to collate the results once every run is complete
+
+        The results are only collated once, however many times this is called.
+
+        Returns
+        ---
+        A Trial_Results_Calculator, as returned by `run_trial`
+        """
+        if self.cancelled:
+            raise RuntimeError("The trial was cancelled, so has no results")
+        if not self.done():
+            raise RuntimeError(f"The trial is still running ({self.completed_runs()} of "
+                               f"{self.number_of_runs} runs complete)")
+        if self.error() is not None:
+            raise self.error()
+
+        if self.trial_results_calculator is None:
+            self.trial_results_calculator = collate_trial(self.number_of_runs,
+                                                          self.scenario_config, self.output_dir)
+        return self.trial_results_calculator
+
+    def cleanup(self):
+        """
+        Method to cancel the job (if it is still running) and delete its results files
+
+        A run that is already under way still writes its results (creating the folder again if
+        it had been deleted), so the folder is deleted once every run has finished or been
+        cancelled.
+        """
+        self.cancel()
+        for future in self.futures:
+            # (called straight away for runs that have already finished)
+            future.add_done_callback(self.remove_output_dir)
+
+    def remove_output_dir(self, future = None):
+        """
+        Method to delete the job's results files, if none of its runs are still under way
+
+        Used by cleanup as a done-callback of each run.
+        """
+        if self.done():
+            shutil.rmtree(self.output_dir, ignore_errors=True)
@@ -0,0 +1,174 @@
+# A class to supply the random numbers used by the Neurosurgery RTT pathway model
+
+import math
+
+import numpy as np
+
+
+class Variate_Source:
+    """
+    Supplies the random numbers for one run of the simulation.
+
+    Rather than drawing a single random number each time a patient is referred or routed
+    (which is slow when done one at a time from Python), the random numbers are drawn from
+    numpy in large blocks and handed out one by one from a buffer.
+
+    Each purpose (referral inter-arrival times, routing between stages, referrals after the end of
+    the simulation in the 'capacity' drain mode, urgency and leaving the waiting lists) has its
+    own random number stream, created from the run's seed with numpy's SeedSequence. This keeps
+    runs reproducible by seed, and means that (for example) a change to how patients are routed
+    can't change the times at which patients are referred.
+
+    Parameters
+    ------
+
+    random_seed: int, default is None
+        Seed for the run. If None, the random numbers are different every time.
+
+    block_size: int, default is 8192
+        Number of random numbers to draw at once for each stream.
+
+    antithetic: bool, default is False
+        If True, every uniform random number u is replaced by 1 - u before being used. A run
+        with this set and a run without it, both with the same seed, make an antithetic pair:
+        where one run has an unusually busy spell of referrals the other has a quiet one, so
+        the average of the pair varies less than the average of two independent runs.
+    """
+
+    # The purposes random numbers are needed for, each with its own stream
+    # (new streams are added at the end, which leaves the numbers of the others unchanged)
+    STREAMS = ['arrivals', 'routing', 'drain', 'waiting_list', 'prefill_routing']
+
+    def __init__(self, random_seed = None, block_size = 8192, antithetic = False):
+        self.block_size = block_size
+        self.antithetic = antithetic
+
+        seed_sequences = np.random.SeedSequence(random_seed).spawn(len(self.STREAMS))
+        self.generators = {stream: np.random.default_rng(seed_sequence)
+                           for stream, seed_sequence in zip(self.STREAMS, seed_sequences)}
+
+        # Endless iterators over each stream's random numbers, drawn a block at a time
+        self.arrivals = self.variates('arrivals')
+        self.routing = self.variates('routing')
+        self.drain = self.variates('drain')
+        self.waiting_list = self.variates('waiting_list')
+        self.prefill_routing = self.variates('prefill_routing')
+
+    def draw_block(self, stream):
+        """
+        Method to draw a new block of random numbers for a stream
+
+        Every stream starts from uniform random numbers (between 0 and 1), which are
+        transformed to the distribution the stream needs for the whole block at once.
+
+        Returns
+        ---
+        A list of floats (taking single values from a list is faster than from an array)
+        """
+        block = self.generators[stream].random(self.block_size)
+
+        if self.antithetic:
+            # keep the numbers below 1 (1 - u would be exactly 1 if u were 0), as they are
+            # for ordinary runs
+            block = np.minimum(1.0 - block, np.nextafter(1.0, 0.0))
+
+        if stream == 'arrivals':
+            # exponential times with a mean of 1, from the inverse of the exponential
+            # distribution's CDF (1 - u is never 0, so these are all finite)
+            block = -np.log1p(-block)
+
+        return block.tolist()
+
+    def variates(self, stream):
+        """
+        Method to hand out a stream's random numbers one at a time, drawing a new block
+        whenever the last one runs out
+        """
+        while True:
+            yield from self.draw_block(stream)
+
+    def interarrival_time(self, mean_interval):
+        """
+        Method to sample the time until the next referral
+
+        Returns
+        ---
+        A time from an exponential distribution with the given mean
+        """
+        return mean_interval * next(self.arrivals)
+
+    def referral_times(self, demand_profile):
+        """
+        Method to generate the referral times for a demand profile whose rate changes over time
+        (see SurgeryDemandProfile.py)
+
+        A block of exponential random numbers at a time is added up into the referral times of
+        a Poisson process with a rate of 1, which the profile's inverse cumulative rate turns
+        into referral times all at once.
+
+        Returns
+        ---
+        An endless iterator of referral times, in weeks from the start of the simulation (which
+        are infinite if the rate drops to 0 for good)
+        """
+        expected_referrals = 0.0
+        while True:
+            block = expected_referrals + np.cumsum(self.draw_block('arrivals'))
+            expected_referrals = block[-1]
+            yield from demand_profile.inverse_cumulative(block).tolist()
+
+    def routing_uniform(self):
+        """
+        Method to return a uniform random number (between 0 and 1) for deciding a patient's route
+        (drawn for every branching stage on the route when the patient joins the pathway)
+        """
+        return next(self.routing)
+
+    def prefill_routing_uniform(self):
+        """
+        Method to return a uniform random number (between 0 and 1) for deciding the route of a
+        patient prefilled into the queues
+
+        (The prefill patients have their own stream, so the routes of the referrals don't
+        depend on how the prefill patients and the first referrals are interleaved.)
+        """
+        return next(self.prefill_routing)
+
+    def drain_referrals(self, mean):
+        """
+        Method to sample the number of referrals in a week of the drain (see
+        Neurosurgery_Pathway's drain_mode)
+
+        Returns
+        ---
+        An int from a Poisson distribution with the given mean
+        """
+        # scipy is only needed in the 'capacity' drain mode, so is imported here to keep it
+        # (and its memory) out of other runs
+        from scipy import stats
+        return int(stats.poisson.ppf(next(self.drain), mean))
+
+    def drain_uniform(self):
+        """
+        Method to return a uniform random number (between 0 and 1) for routing a patient
+        referred during the drain
+        """
+        return next(self.drain)
+
+    def priority_uniform(self):
+        """
+        Method to return a uniform random number (between 0 and 1) for deciding whether a
+        referral is urgent
+        """
+        return next(self.waiting_list)
+
+    def reneging_time(self, mean_time):
+        """
+        Method to sample the time until a patient who has joined a waiting list leaves it
+        without being seen
+
+        Returns
+        ---
+        A time from an exponential distribution with the given mean
+        """
+        return -mean_time * math.log1p(-next(self.waiting_list))
@@ -0,0 +1,182 @@
+# A class to count long waiters for any wait threshold and any weeks of referral, instantly
+#
+# The headline results count the patients referred in the final week who waited 52 or 65
+# weeks. Answering the same question for another threshold or other weeks of referral would
+# mean reading every patient's wait again. Instead, the waits of a trial are counted once into
+# a histogram by run, week of referral and wait (in bins of a week), which is then summed
+# cumulatively along the weeks and the waits. Any count of patients referred between two
+# weeks who waited at least a given time is then just four lookups in that table, however
+# many patients there are.
+
+import math
+
+import numpy as np
+import pandas as pd
+
+# The largest wait threshold (in weeks) that can be looked up - the largest the app's slider
+# can select. Longer waits are all counted in the last bin, which keeps the size of the table
+# the same however long the longest wait of an overloaded pathway is.
+MAX_WAIT_THRESHOLD = 104
+
+
+class Wait_Time_Index:
+    """
+    Cumulative histograms of the waits of every run of a trial, by week of referral.
+
+    cumulative_counts[r, w, b] is the number of patients in run r referred before week w whose
+    wait was in a bin below b, and cumulative_waits[r, w] is the total wait of the patients in
+    run r referred before week w. Weeks are numbered from 0 (the patients referred between
+    time 0 and 1, including the prefill patients), as in the results.
+
+    The tables are filled in a run at a time, so only one run's waits are held at once.
+
+    Parameters
+    ------
+
+    run_wait_times: iterable
+        A dataframe of the wait times of each run (with the columns of all_wait_times.csv),
+        e.g. from Trial_Results_Calculator.iter_run_wait_times.
+
+    number_of_runs: int
+        Number of runs in run_wait_times.
+
+    number_of_weeks: int
+        Number of weeks patients were referred in (the simulation's sim_duration).
+
+    wait_bin_width: float, default is 1
+        Width of the wait bins, in weeks. Thresholds are rounded up to a whole number of bins,
+        so counts are exact for thresholds that are a multiple of this.
+
+    max_threshold: float, default is `MAX_WAIT_THRESHOLD`
+        Largest threshold that can be looked up. Waits of at least this are counted together.
+    """
+    def __init__(self, run_wait_times, number_of_runs, number_of_weeks, wait_bin_width = 1,
+                 max_threshold = MAX_WAIT_THRESHOLD):
+        self.number_of_weeks = number_of_weeks
+        self.wait_bin_width = wait_bin_width
+        self.max_threshold = max_threshold
+
+        # the last bin holds every wait of at least max_threshold
+        last_bin = math.ceil(max_threshold / wait_bin_width)
+        self.number_of_bins = last_bin + 1
+
+        # a leading row and column of zeros, so that 'before week 0' and 'below bin 0' are
+        # looked up like any other week and bin
+        self.cumulative_counts = np.zeros((number_of_runs, number_of_weeks + 1,
+                                           self.number_of_bins + 1), dtype=np.int32)
+        self.cumulative_waits = np.zeros((number_of_runs, number_of_weeks + 1))
+
+        run = -1
+        for run, run_df in enumerate(run_wait_times):
+            weeks = np.clip(np.floor(run_df['time_entered_pathway'].to_numpy()),
+                            0, number_of_weeks - 1).astype(int)
+            waits = run_df['overall_queue_time'].to_numpy()
+            wait_bins = np.minimum(np.floor(waits / wait_bin_width), last_bin).astype(int)
+
+            run_table = self.cumulative_counts[run]
+            run_table[1:, 1:] = np.bincount(weeks * self.number_of_bins + wait_bins,
+                                            minlength=number_of_weeks * self.number_of_bins
+                                            ).reshape(number_of_weeks, self.number_of_bins)
+            np.cumsum(run_table, axis=0, dtype=np.int32, out=run_table)
+            np.cumsum(run_table, axis=1, dtype=np.int32, out=run_table)
+
+            self.cumulative_waits[run, 1:] = np.cumsum(
+                np.bincount(weeks, weights=waits, minlength=number_of_weeks))
+
+        # (in case there were fewer runs than expected)
+        self.number_of_runs = run + 1
+        self.cumulative_counts = self.cumulative_counts[:self.number_of_runs]
+        self.cumulative_waits = self.cumulative_waits[:self.number_of_runs]
+
+        # the same, added up over the runs
+        self.total_cumulative_counts = self.cumulative_counts.sum(axis=0, dtype=np.int64)
+        self.total_cumulative_waits = self.cumulative_waits.sum(axis=0)
+
+    def week_range(self, first_week, last_week):
+        """
+        Method to turn a range of weeks of referral (including both ends) into the rows of the
+        cumulative tables to look up
+        """
+        if last_week is None:
+            last_week = self.number_of_weeks - 1
+        start = min(max(int(first_week), 0), self.number_of_weeks)
+        end = min(max(int(last_week) + 1, start), self.number_of_weeks)
+        return start, end
+
+    def threshold_bin(self, threshold):
+        """
+        Method to return the first wait bin whose waits are all at least the threshold
+        """
+        if threshold > self.max_threshold:
+            raise ValueError(f"Wait thresholds over {self.max_threshold} weeks can't be looked up "
+                             f"(see max_threshold)")
+        return max(math.ceil(threshold / self.wait_bin_width), 0)
+
+    def long_waiters_per_run(self, threshold, first_week = 0, last_week = None):
+        """
+        Method to count the patients referred between two weeks who waited at least threshold
+        weeks, in each run
+
+        Parameters
+        ------
+
+        threshold: float
+            Wait in weeks.
+
+        first_week, last_week: int
+            Weeks of referral to count, including both (numbered from 0). last_week defaults
+            to the final week of the simulation.
+
+        Returns
+        ---
+        A series with the count for each run (numbered from 1, as in all_wait_times.csv)
+        """
+        start, end = self.week_range(first_week, last_week)
+        b = self.threshold_bin(threshold)
+        table = self.cumulative_counts
+        referred = table[:, end, -1] - table[:, start, -1]
+        below_threshold = table[:, end, b] - table[:, start, b]
+        return pd.Series(referred - below_threshold,
+                         index=pd.RangeIndex(1, self.number_of_runs + 1, name='run'), dtype=float)
+
+    def long_waiters(self, threshold, first_week = 0, last_week = None):
+        """
+        Method to count the patients referred between two weeks who waited at least threshold
+        weeks, averaged over the runs
+
+        Returns
+        ---
+        A single float
+        """
+        start, end = self.week_range(first_week, last_week)
+        b = self.threshold_bin(threshold)
+        table = self.total_cumulative_counts
+        referred = table[end, -1] - table[start, -1]
+        below_threshold = table[end, b] - table[start, b]
+        return (referred - below_threshold) / self.number_of_runs
+
+    def referrals(self, first_week = 0, last_week = None):
+        """
+        Method to count the patients referred between two weeks, averaged over the runs
+
+        Returns
+        ---
+        A single float
+        """
+        start, end = self.week_range(first_week, last_week)
+        table = self.total_cumulative_counts
+        return (table[end, -1] - table[start, -1]) / self.number_of_runs
+
+    def mean_wait(self, first_week = 0, last_week = None):
+        """
+        Method to calculate the average wait of the patients referred between two weeks, over
+        all runs
+
+        Returns
+        ---
+        A single float (NaN if no patients were referred in those weeks)
+        """
+        start, end = self.week_range(first_week, last_week)
+        number_of_patients = self.total_cumulative_counts[end, -1] - self.total_cumulative_counts[start, -1]
+        total_wait = self.total_cumulative_waits[end] - self.total_cumulative_waits[start]
+        return total_wait / number_of_patients if number_of_patients else np.nan
@@ -0,0 +1,107 @@
+# A class to store the wait times from every run of a trial on disk, a column and a run at a time
+#
+# A trial at production volumes can have thousands of runs of tens of thousands of patients,
+# which is too much to hold in memory at once. Each run's wait times are saved as their own
+# numpy files (one per column), which are read back memory-mapped, so the results can be
+# worked through one run at a time with memory use that doesn't grow with the number of runs.
+
+import os
+
+import numpy as np
+import pandas as pd
+
+# The columns saved for each patient
+WAIT_TIMES_COLUMNS = ['time_entered_pathway', 'overall_queue_time']
+
+
+class Wait_Times_Store:
+    """
+    On-disk columnar store of the wait times of each run of a trial.
+
+    The wait times are kept in a 'wait_times' folder in output_dir, with a .npy file for each
+    column of each run (e.g. run_0_overall_queue_time.npy). Runs are numbered as for
+    `Neurosurgery_Pathway` (from 0).
+
+    Parameters
+    ------
+
+    output_dir: str, default is '.'
+        Folder the trial's results are written to.
+    """
+    def __init__(self, output_dir = '.'):
+        self.store_dir = os.path.join(output_dir, 'wait_times')
+
+    def chunk_path(self, run_number, column):
+        """
+        Method to return the file a column of a run's wait times is saved in
+        """
+        return os.path.join(self.store_dir, f'run_{run_number}_{column}.npy')
+
+    def append_run(self, run_number, wait_times):
+        """
+        Method to save the wait times of a run
+
+        Each file is written under a temporary name and then renamed, so a half-written run is
+        never read.
+
+        Parameters
+        ------
+
+        run_number: int
+            The run the wait times are from.
+
+        wait_times: dict or dataframe
+            Values for each of WAIT_TIMES_COLUMNS.
+        """
+        os.makedirs(self.store_dir, exist_ok=True)
+        for column in WAIT_TIMES_COLUMNS:
+            path = self.chunk_path(run_number, column)
+            temporary_path = f'{path}.{os.getpid()}.tmp'
+            with open(temporary_path, 'wb') as f:
+                np.save(f, np.asarray(wait_times[column], dtype=float))
+            os.replace(temporary_path, path)
+
+    def has_run(self, run_number):
+        """
+        Method to check whether the wait times of a run have been saved
+        """
+        return all(os.path.exists(self.chunk_path(run_number, column))
+                   for column in WAIT_TIMES_COLUMNS)
+
+    def read_run(self, run_number, columns = WAIT_TIMES_COLUMNS):
+        """
+        Method to read the wait times of a run
+
+        The files are memory-mapped, so only the parts that are used are read from disk.
+
+        Returns
+        ---
+        A dictionary of numpy arrays, one for each column
+        """
+        return {column: np.load(self.chunk_path(run_number, column), mmap_mode='r')
+                for column in columns}
+
+    def read_run_df(self, run_number, columns = WAIT_TIMES_COLUMNS):
+        """
+        Method to read the wait times of a run into a dataframe
+
+        Returns
+        ---
+        A dataframe with a row per patient
+        """
+        return pd.DataFrame({column: np.asarray(values)
+                             for column, values in self.read_run(run_number, columns).items()})
+
+    def number_of_patients(self, run_number):
+        """
+        Method to return the number of patients with wait times in a run
+        """
+        return len(self.read_run(run_number, WAIT_TIMES_COLUMNS[:1])[WAIT_TIMES_COLUMNS[0]])
+
+    def remove_run(self, run_number):
+        """
+        Method to delete the wait times of a run
+        """
+        for column in WAIT_TIMES_COLUMNS:
+            if os.path.exists(self.chunk_path(run_number, column)):
+                os.remove(self.chunk_path(run_number, column))
@@ -0,0 +1,85 @@
+# A class for the waiting list of a stage of the Neurosurgery RTT pathway
+#
+# Patients on a waiting list are seen in order of their priority class (e.g. urgent before
+# routine), and in the order they joined the list within each class. Patients can also leave
+# the list without being seen (e.g. removed when the list is validated, or treated elsewhere).
+#
+# The list is kept as a heap, so adding a patient and taking the next patient to be seen take
+# O(log n) time. Removing a patient from the middle of the list only marks their entry as
+# removed (O(1)); removed entries are skipped when they reach the front of the heap. This keeps
+# lists of tens of thousands of patients fast, where removing a queued simpy request has to
+# search the whole queue.
+
+import heapq
+import itertools
+
+# The priority classes of patients, in the order they are seen
+PRIORITY_CLASSES = {'urgent': 0, 'routine': 1}
+URGENT = PRIORITY_CLASSES['urgent']
+ROUTINE = PRIORITY_CLASSES['routine']
+
+
+class Waiting_List:
+    """
+    A waiting list of patients, seen by priority class and then in the order they joined.
+
+    Each patient can only be on the list once, and is looked up by their id.
+    """
+    def __init__(self):
+        # entries of [priority, order joined, patient], with removed patients set to None
+        self.heap = []
+        # the entry of each patient on the list, by patient id
+        self.entries = {}
+        self.order_joined = itertools.count()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, patient_id):
+        return patient_id in self.entries
+
+    def add(self, patient, priority = ROUTINE):
+        """
+        Method to add a patient to the back of their priority class on the list
+        """
+        if patient.id in self.entries:
+            raise ValueError(f"Patient {patient.id} is already on the waiting list")
+        entry = [priority, next(self.order_joined), patient]
+        self.entries[patient.id] = entry
+        heapq.heappush(self.heap, entry)
+
+    def remove(self, patient_id):
+        """
+        Method to take a patient off the list without them being seen
+
+        Returns
+        ---
+        The patient, or None if they were not on the list
+        """
+        entry = self.entries.pop(patient_id, None)
+        if entry is None:
+            return None
+        patient = entry[-1]
+        entry[-1] = None
+
+        # if most of the heap is removed entries, rebuild it without them so it doesn't keep
+        # growing when many patients leave the list
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [entry for entry in self.heap if entry[-1] is not None]
+            heapq.heapify(self.heap)
+        return patient
+
+    def pop(self):
+        """
+        Method to take the next patient to be seen off the list
+
+        Returns
+        ---
+        The patient (raises an IndexError if the list is empty)
+        """
+        while self.heap:
+            patient = heapq.heappop(self.heap)[-1]
+            if patient is not None:
+                del self.entries[patient.id]
+                return patient
+        raise IndexError("The waiting list is empty")
@@ -0,0 +1,230 @@
+# Benchmarks for the Neurosurgery RTT pathway simulation
+#
+# Times Neurosurgery_Pathway.run and the Trial_Results_Calculator pipeline at several scales,
+# records the results to a json file and compares them against a stored baseline.
+#
+# Usage:
+#   python benchmark.py                              # run all scales and compare to the baseline
+#   python benchmark.py --scales small default       # run selected scales only
+#   python benchmark.py --update-baseline            # store these results as the new baseline
+#
+# The script exits with a non-zero status if any scale is slower (or uses more memory) than
+# the baseline by more than the tolerance.
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+from global_params import g
+
+BASELINE_FILE = 'benchmark_baseline.json'
+RESULTS_FILE = 'benchmark_results.json'
+
+# Scales to benchmark. The default parameters in `g` are roughly a tenth of our production
+# volumes, so 'production' uses the production figures noted in global_params.py, with
+# clinic and theatre capacity scaled up by the same factor so the pathway is equally loaded.
+BENCHMARK_SCALES = {
+    'small': 0.5,
+    'default': 1,
+    'medium': 3,
+    'production': 350 / 30,
+}
+
+
+def scaled_parameters(scale):
+    """
+    Function to scale the default pathway parameters by the given factor
+
+    Returns
+    ---
+    A dictionary of keyword arguments for Neurosurgery_Pathway
+    """
+    factor = BENCHMARK_SCALES[scale]
+    if scale == 'production':
+        referrals_per_week, fill_non_admitted_queue, fill_admitted_queue = 350, 4163, 1143
+    else:
+        referrals_per_week = round(g.referrals_per_week * factor)
+        fill_non_admitted_queue = round(g.fill_non_admitted_queue * factor)
+        fill_admitted_queue = round(g.fill_admitted_queue * factor)
+
+    return dict(referrals_per_week=referrals_per_week,
+                surg_clinic_per_week=g.surg_clinic_per_week,
+                surg_clinic_capacity=max(round(g.surg_clinic_appts * factor), 1),
+                theatre_list_per_week=g.theatre_list_per_week,
+                theatre_list_capacity=max(round(g.theatre_list_capacity * factor), 1),
+                fill_non_admitted_queue=fill_non_admitted_queue,
+                fill_admitted_queue=fill_admitted_queue,
+                sim_duration=g.sim_duration)
+
+
+def benchmark_scale(scale, number_of_runs):
+    """
+    Function to time a trial at a single scale
+
+    This is run in a fresh process for each scale so the peak memory use is specific to it.
+
+    Returns
+    ---
+    A dictionary of timings, event counts and peak memory use
+    """
+    params = scaled_parameters(scale)
+    run_times = []
+    simpy_events = 0
+    model_events = 0
+
+    # The simulation writes its results (and log) files to the current directory
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as trial_directory, \
+            contextlib.redirect_stdout(io.StringIO()):
+        os.chdir(trial_directory)
+
+        from SurgeryPathway import Neurosurgery_Pathway
+        from SurgeryResultsCalculator import Trial_Results_Calculator
+        from SurgeryTrial import start_queue_numbers_file
+
+        # Only report warnings, so the console logging does not dominate the timings
+        logging.getLogger("dual_logger").setLevel(logging.WARNING)
+
+        start_queue_numbers_file()
+
+        for run in range(number_of_runs):
+            # fix the random numbers so the same work is done every time the benchmark runs
+            pathway_model = Neurosurgery_Pathway(run, random_seed=run, **params)
+
+            # count the events processed by SimPy by wrapping its step method
+            events_processed = [0]
+            simpy_step = pathway_model.env.step
+            def counting_step():
+                events_processed[0] += 1
+                simpy_step()
+            pathway_model.env.step = counting_step
+
+            start = time.perf_counter()
+            pathway_model.run()
+            run_times.append(time.perf_counter() - start)
+
+            simpy_events += events_processed[0]
+            model_events += len(pathway_model.event_log)
+
+        start = time.perf_counter()
+        trial_results_calculator = Trial_Results_Calculator(
+            number_of_runs=number_of_runs,
+            sim_duration=params['sim_duration'],
+            fill_non_admitted_queue=params['fill_non_admitted_queue'],
+            fill_admitted_queue=params['fill_admitted_queue'])
+        trial_results_calculator.concatenate_wait_times()
+        trial_results_calculator.calculate_mean_queue_numbers()
+        trial_results_calculator.readout_kpis()
+        calculator_time = time.perf_counter() - start
+
+        os.chdir(working_directory)
+
+    run_time = sum(run_times)
+
+    return {
+        'parameters': params,
+        'number_of_runs': number_of_runs,
+        'run_wall_time': run_time,
+        'mean_run_wall_time': run_time / number_of_runs,
+        'calculator_wall_time': calculator_time,
+        'total_wall_time': run_time + calculator_time,
+        'simpy_events': simpy_events,
+        'model_events': model_events,
+        'events_per_sec': simpy_events / run_time,
+        # the number of SimPy events changes whenever the engine is restructured (e.g.
+        # sessions), but the model events (the event log) are the same work every time
+        'model_events_per_sec': model_events / run_time,
+        # ru_maxrss is in kilobytes on Linux (but bytes on macOS)
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                       / (1024 * 1024 if sys.platform == 'darwin' else 1024),
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Function to compare benchmark results with the baseline
+
+    Returns
+    ---
+    A list of strings describing each regression (empty if there were none)
+    """
+    regressions = []
+    for scale, result in results['scales'].items():
+        if scale not in baseline.get('scales', {}):
+            print(f"{scale}: no baseline to compare against")
+            continue
+        expected = baseline['scales'][scale]
+        if expected['number_of_runs'] != result['number_of_runs']:
+            print(f"{scale}: baseline used {expected['number_of_runs']} runs, so cannot be compared")
+            continue
+
+        for metric, higher_is_worse in [('total_wall_time', True),
+                                        ('model_events_per_sec', False),
+                                        ('peak_rss_mb', True)]:
+            if metric not in expected:
+                print(f"{scale}: the baseline has no {metric} - run with --update-baseline")
+                continue
+            change = result[metric] / expected[metric] - 1
+            print(f"{scale}: {metric} {result[metric]:.2f} (baseline {expected[metric]:.2f}, {change:+.0%})")
+            if (change > tolerance) if higher_is_worse else (change < -tolerance):
+                regressions.append(f"{scale}: {metric} changed by {change:+.0%} "
+                                   f"(tolerance {tolerance:.0%})")
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Neurosurgery RTT pathway simulation')
+    parser.add_argument('--scales', nargs='+', choices=list(BENCHMARK_SCALES),
+                        default=list(BENCHMARK_SCALES), help='scales to benchmark')
+    parser.add_argument('--runs', type=int, default=1,
+                        help='number of simulation runs in each trial (must match the baseline)')
+    parser.add_argument('--output', default=RESULTS_FILE, help='file to write the results to')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='baseline file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fractional slow-down allowed before reporting a regression')
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='save these results as the new baseline')
+    args = parser.parse_args()
+
+    results = {'python': platform.python_version(), 'machine': platform.machine(),
+               'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'scales': {}}
+
+    # Use a fresh process for each scale so peak memory use is not carried over
+    context = multiprocessing.get_context('spawn')
+    for scale in args.scales:
+        print(f"Benchmarking {scale} scale ({args.runs} runs)")
+        with context.Pool(1) as pool:
+            results['scales'][scale] = pool.apply(benchmark_scale, (scale, args.runs))
+        print(f"{scale}: {results['scales'][scale]['total_wall_time']:.2f}s, "
+              f"{results['scales'][scale]['model_events_per_sec']:.0f} model events/sec, "
+              f"peak RSS {results['scales'][scale]['peak_rss_mb']:.0f} MB")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print("Performance regressions found:")
+            for regression in regressions:
+                print(f"- {regression}")
+            sys.exit(1)
+        print("No performance regressions found")
+    else:
+        print(f"No baseline found at {args.baseline} - run with --update-baseline to create one")
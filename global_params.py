@@ -24,9 +24,6 @@ class g:
     fill_non_admitted_queue = 300 # 4163
     fill_admitted_queue = 110 # 1143
 
-    # proportion of patients requiring surgical admission
-    prob_needs_surgery = 0.80
-
     trauma_list_per_week = 2
     weekly_extra_patients = 0
 
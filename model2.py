@@ -10,14 +10,57 @@ import matplotlib.pyplot as plt
 import os
 import streamlit as st
 import plotly.express as px
+from concurrent.futures import ProcessPoolExecutor
 
 from SurgeryPatient import Patient
 from SurgeryPathway import Neurosurgery_Pathway
 from SurgeryResultsCalculator import Trial_Results_Calculator
+from SurgeryTrial import Trial_Job
+from SurgeryResultStore import Result_Store
+from SurgeryScenario import Scenario_Config
+from SurgeryAnalyticEstimator import Analytic_Pathway_Estimator
+from SurgeryEmulator import Pathway_Emulator, EMULATOR_FILE
+from SurgeryWaitIndex import MAX_WAIT_THRESHOLD
 from global_params import g
 from PIL import Image
 
 
+# Load the emulator once and share it between sessions. The file's modification time is
+# passed in so that the cached copy is replaced whenever the emulator is refitted.
+@st.cache_resource
+def load_emulator(modified_time):
+    return Pathway_Emulator.load(EMULATOR_FILE)
+
+
+# Worker processes to run the simulations in, shared by every session of the app
+@st.cache_resource
+def get_executor():
+    return ProcessPoolExecutor(max_workers=os.cpu_count())
+
+
+# Store of earlier simulation runs, shared with every session (and with run_batch.py and
+# SurgeryEmulator.py if they use the same folder), so a scenario that has already been run
+# with the same seed is shown straight away
+@st.cache_resource
+def get_result_store():
+    return Result_Store()
+
+
+# Progress of the trial running in the background. This part of the page refreshes itself
+# every second, and reruns the whole page once the trial has finished to show the results.
+@st.fragment(run_every=1)
+def show_trial_progress():
+    trial_job = st.session_state.trial_job
+    st.progress(trial_job.progress(),
+                text=f'Running simulation... {trial_job.completed_runs()} of '
+                     f'{trial_job.number_of_runs} runs complete')
+    if st.button('Cancel Simulation'):
+        trial_job.cancel()
+        st.rerun()
+    if not trial_job.running():
+        st.rerun()
+
+
 ############ Page Config set to wide
 # page config
 # This must be the first Streamlit command used on an app page (after importing streamlit)!
@@ -80,6 +123,20 @@ with st.sidebar:
                                          step=1,
                                          value = g.referrals_per_week)
 
+  SEASONAL_VARIATION = st.slider('Seasonal Variation in Referrals (%)',
+                                 min_value = 0,
+                                 max_value = 50,
+                                 value = 0,
+                                 help="How much higher (and lower) than average the weekly referrals are "
+                                      "at the busiest (and quietest) time of year")
+
+  PEAK_WEEK = st.slider('Week of the Year with Most Referrals',
+                        min_value = 0,
+                        max_value = 51,
+                        value = 0,
+                        disabled = SEASONAL_VARIATION == 0,
+                        help="Weeks of the year are numbered from 0, the week the simulation starts")
+
 # TODO: SR Note: Have commented this out for now as I can't see how this is meant to
 # fit in - have asked for clarification
 #   ATTENDANCES_PER_WEEK = st.number_input('Clinics Per Week',
@@ -124,10 +181,6 @@ with st.sidebar:
 
   st.caption(f"*This gives you a total of {LISTS_PER_WEEK*LIST_CAPACITY:.0f} theatre slots per week*")
 
-  PROB_SURGERY = st.slider('Percentage of Patients requiring Surgery',
-                                            step = 0.01,
-                                            value = g.prob_needs_surgery)
-
   EXTRA_PATIENTS = st.number_input(':green[**Extra Patients Per List**]',
                                         step = 1,
                                         value = g.weekly_extra_patients)
@@ -153,11 +206,67 @@ with st.sidebar:
                                    value = g.sim_duration,
                                    help=sim_length_help_text)
 
+  sessions_help_text = """If ticked, each clinic and theatre list sees its patients together as a
+  session, rather than patients being seen one at a time spread evenly through the week. This is
+  closer to how the pathway works, and makes the simulation much quicker for large waiting lists.
+  """
+
+  SESSIONS = st.checkbox('Model Clinics and Lists as Sessions',
+                         value = False,
+                         help=sessions_help_text)
+
+  seed_help_text = """Running the same parameters with the same seed always gives the same
+  results, so these are reused from earlier runs rather than simulated again. Change the seed
+  to see a different set of runs.
+  """
+
+  SEED = st.number_input('Random Seed',
+                         step = 1,
+                         value = 42,
+                         help=seed_help_text)
+
+  st.divider()
+
+  st.subheader("Long Wait Results")
+
+  # These only change how the results are read out, so moving them doesn't rerun the simulation
+  WAIT_THRESHOLD = st.slider('Long Wait Threshold (weeks)',
+                             min_value = 1,
+                             max_value = MAX_WAIT_THRESHOLD,
+                             value = 52)
+
+  REFERRAL_WEEKS = st.slider('Weeks of Referral',
+                             min_value = 0,
+                             max_value = max(LENGTH_OF_SIM - 1, 1),
+                             value = (LENGTH_OF_SIM - 1, LENGTH_OF_SIM - 1),
+                             help="The weeks (numbered from 0) the patients were referred in")
+
 ############ The model itself
 
 #calculate total in queues at start of simulation
 TOTAL_QUEUE_START = CLINIC_QUEUE + THEATRE_QUEUE
 
+# parameters passed to the simulation (and to the estimates of its results)
+PATHWAY_PARAMS = dict(referrals_per_week=REFS_PER_WEEK,
+                      surg_clinic_per_week=CLINICS_PER_WEEK,
+                      surg_clinic_capacity=CLINIC_APPOINTMENTS_PER_CLINIC,
+                      theatre_list_per_week=LISTS_PER_WEEK,
+                      theatre_list_capacity=LIST_CAPACITY,
+                      fill_non_admitted_queue=CLINIC_QUEUE,
+                      fill_admitted_queue=THEATRE_QUEUE,
+                      sim_duration=LENGTH_OF_SIM,
+                      weekly_extra_patients=EXTRA_PATIENTS)
+
+# referrals that rise and fall over each year around the average, peaking in PEAK_WEEK (see
+# SurgeryDemandProfile.py)
+if SEASONAL_VARIATION > 0:
+    PATHWAY_PARAMS['demand_profile'] = (REFS_PER_WEEK * (1 + SEASONAL_VARIATION / 100
+                                                         * np.cos(2 * np.pi * (np.arange(52) - PEAK_WEEK) / 52))).tolist()
+
+# the scenario the simulation runs (see SurgeryScenario.py)
+SCENARIO_CONFIG = Scenario_Config(service_mode='session' if SESSIONS else 'continuous',
+                                  **PATHWAY_PARAMS)
+
 
 #### This adds two tabs.
 # The model is in tab 1
@@ -166,49 +275,107 @@ tab1, tab2 = st.tabs(["Simulation", "Pathway"])
 
 with tab1:
 
+############ Instant estimate
+# This uses queueing theory rather than simulation, so it is recalculated straight away
+# whenever the sidebar changes. The full simulation below refines these figures.
+    analytic_estimate = Analytic_Pathway_Estimator(**PATHWAY_PARAMS)
+    ESTIMATED_KPIS = analytic_estimate.estimate_kpis()
+
+    st.subheader('Instant Estimate')
+    est_col1, est_col2, est_col3, est_col4 = st.columns(4)
+    with est_col1:
+        st.metric(label=f"Waiting list after {LENGTH_OF_SIM} weeks",
+                  value=f"{ESTIMATED_KPIS['total_queue_end']:.0f}",
+                  delta=f"{ESTIMATED_KPIS['total_queue_end'] - TOTAL_QUEUE_START:.0f}",
+                  delta_color="inverse")
+    with est_col2:
+        st.metric(label=f"Average wait for week {LENGTH_OF_SIM-1} referrals (weeks)",
+                  value=f"{ESTIMATED_KPIS['mean_wait_end']:.1f}")
+    with est_col3:
+        st.metric(label="Final week referrals waiting 52+ weeks",
+                  value=ESTIMATED_KPIS['total_52_plus'])
+    with est_col4:
+        st.metric(label="Final week referrals waiting 65+ weeks",
+                  value=ESTIMATED_KPIS['total_65_plus'])
+
+    st.line_chart(analytic_estimate.queue_trajectory(),
+                  x_label='Week', y_label='Estimated patients waiting')
+    st.caption("*These figures are a queueing-theory approximation that updates as soon as the "
+               "parameters change. Run the simulation for more reliable results.*")
+
+############ Emulator
+# The emulator is fitted offline to many simulation trials (see SurgeryEmulator.py), so it
+# can predict the simulation results, with their uncertainty, without running a trial.
+    # (the emulator isn't trained on seasonal referrals, so it is only shown without them)
+    if os.path.exists(EMULATOR_FILE) and 'demand_profile' not in PATHWAY_PARAMS:
+        emulator = load_emulator(os.path.getmtime(EMULATOR_FILE))
+        EMULATED = emulator.predict(PATHWAY_PARAMS)
+
+        st.subheader('Emulated Simulation Results')
+        if emulator.is_out_of_date():
+            st.warning("The model has changed since the emulator was fitted, so these "
+                       "predictions may not match the simulation. To refit the emulator, run "
+                       "`python SurgeryEmulator.py`.", icon=":material/warning:")
+        if EMULATED['outside_training_range']:
+            st.warning(f"These parameters are outside the range the emulator was trained on "
+                       f"({', '.join(EMULATED['outside_training_range'])}), so these predictions "
+                       "are an extrapolation and may be unreliable.", icon=":material/warning:")
+
+        emu_col1, emu_col2, emu_col3, emu_col4 = st.columns(4)
+        for column, kpi, label in [(emu_col1, 'total_queue_end', f"Waiting list after {LENGTH_OF_SIM} weeks"),
+                                   (emu_col2, 'mean_wait_end', f"Average wait for week {LENGTH_OF_SIM-1} referrals (weeks)"),
+                                   (emu_col3, 'total_52_plus', "Final week referrals waiting 52+ weeks"),
+                                   (emu_col4, 'total_65_plus', "Final week referrals waiting 65+ weeks")]:
+            prediction, sd = EMULATED['kpis'][kpi]
+            with column:
+                st.metric(label=label, value=f"{prediction:.1f} ± {1.96 * sd:.1f}")
+        st.caption("*Predicted from previous simulation runs, with a 95% uncertainty interval. "
+                   "To refit the emulator, run `python SurgeryEmulator.py`.*")
+
+    st.divider()
+
 # button to run simulation
+# The simulation runs in the background (in worker processes shared by everyone using the app)
+# so the page stays responsive while it runs. The job is kept in the session, so changing a
+# widget - which reruns this script - doesn't throw away the simulation's work.
     button_run_pressed = st.button("Start Simulation")
 
     if button_run_pressed:
-    #if st.button('Start Simulation'):
-
-    # spinner while loading
-        with st.spinner('Running simulation...'):
-
-        # create a file to store the numbers in queues
-            with open('queue_numbers.csv', 'w') as csvfile:
-                writer = csv.writer(csvfile, delimiter=',')
-                writer.writerow(['run','clinic_queue', 'theatres_queue'])
-
-        # For the number of runs specified in the g class, create an instance of the
-        # ED_Model class, and call its run method
-            for run in range(NUM_OF_RUNS):
-                print (f"Run {run+1} of {NUM_OF_RUNS}")
-                demo_pathway_model = Neurosurgery_Pathway(run,
-                                                      referrals_per_week=REFS_PER_WEEK,
-                                                      surg_clinic_per_week= CLINIC_APPOINTMENTS_PER_CLINIC,
-                                                      surg_clinic_capacity=CLINICS_PER_WEEK,
-                                                      theatre_list_per_week=LISTS_PER_WEEK,
-                                                      theatre_list_capacity=LIST_CAPACITY,
-                                                      prob_needs_surgery = PROB_SURGERY,
-                                                      fill_non_admitted_queue=CLINIC_QUEUE,
-                                                      fill_admitted_queue = THEATRE_QUEUE,
-                                                      sim_duration=LENGTH_OF_SIM,
-                                                      weekly_extra_patients=EXTRA_PATIENTS
-                                                      )
-                demo_pathway_model.run()
-
-        # Once the trial is complete, we'll create an instance of the
-        # Trial_Result_Calculator class and run the print_trial_results method
-            demo_trial_results_calculator = Trial_Results_Calculator(
-                                                                 number_of_runs=NUM_OF_RUNS,
-                                                                 sim_duration=LENGTH_OF_SIM,
-                                                                 fill_non_admitted_queue=CLINIC_QUEUE,
-                                                                 fill_admitted_queue=THEATRE_QUEUE
-                                                                )
-
-            demo_trial_results_calculator.concatenate_wait_times()
-            demo_trial_results_calculator.calculate_mean_queue_numbers()
+        # a new trial replaces any earlier one (cancelling it if it is still running)
+        if 'trial_job' in st.session_state:
+            st.session_state.trial_job.cleanup()
+        st.session_state.trial_job = Trial_Job(get_executor(),
+                                               number_of_runs=NUM_OF_RUNS,
+                                               seed=SEED,
+                                               result_store=get_result_store(),
+                                               scenario_config=SCENARIO_CONFIG)
+
+    trial_job = st.session_state.get('trial_job')
+
+    if trial_job is not None and trial_job.running():
+        show_trial_progress()
+    elif trial_job is not None and trial_job.cancelled:
+        st.info('The simulation was cancelled.')
+    elif trial_job is not None and trial_job.error() is not None:
+        st.error(f'The simulation failed: {trial_job.error()}')
+
+    trial_complete = (trial_job is not None and not trial_job.cancelled
+                      and trial_job.done() and trial_job.error() is None)
+
+    if trial_complete:
+
+    # The results are for the parameters the trial was run with, which may not match the
+    # sidebar if it has been changed since
+        LENGTH_OF_SIM = trial_job.scenario_config.sim_duration
+        NUM_OF_RUNS = trial_job.number_of_runs
+        TOTAL_QUEUE_START = (trial_job.scenario_config.fill_non_admitted_queue
+                             + trial_job.scenario_config.fill_admitted_queue)
+
+        with st.container():
+
+        # Collate the results of the trial. This returns an instance of the
+        # Trial_Result_Calculator class, ready to read out the results of the trial
+            demo_trial_results_calculator = trial_job.results()
 
         # calculate number of patients in queues at end of simulation
             TOTAL_QUEUE_END = demo_trial_results_calculator.readout_total_queue_numbers()
@@ -257,8 +424,8 @@ with tab1:
                 st.write(f'After {LENGTH_OF_SIM} weeks, the total number of patients on the waiting list is predicted to be {round(TOTAL_QUEUE_END)}. This is unchanged from the starting figure of ({round(TOTAL_QUEUE_START)}).')
 
             st.write(f'After {LENGTH_OF_SIM} weeks, of the patients who entered the pathway in week {LENGTH_OF_SIM-1}, on average')
-            st.write(f'- **:red[{TOTAL_52_plus}]** of them went on to wait >52 weeks in the simulation.')
-            st.write(f'- **:red[{TOTAL_65_plus}]** of them when on to wait >65 weeks in the simulation.')
+            st.write(f'- **:red[{TOTAL_52_plus}]** of them went on to wait 52 weeks or more in the simulation.')
+            st.write(f'- **:red[{TOTAL_65_plus}]** of them went on to wait 65 weeks or more in the simulation.')
 
             # st.write(f'After {LENGTH_OF_SIM} weeks, of the patients who entered the pathway in week {LENGTH_OF_SIM-1}, **:red[{TOTAL_65_plus}]** of them were predicted to wait >65 weeks.')
 
@@ -278,27 +445,42 @@ with tab1:
                 st.plotly_chart(demo_trial_results_calculator.plot_queue_numbers())
                 st.caption(f"The 'after' values are the **average** number of waiters at the end of {LENGTH_OF_SIM} weeks across {NUM_OF_RUNS} simulations runs")
 
-    # Creating the dataframe
-        wait_times_df = pd.read_csv('all_wait_times.csv')
-
-    # Add new columns for the long waiters
-
-        wait_times_df['Long Waiters 52+'] = [True if x > 52 else False for x in wait_times_df['overall_queue_time']]
-        wait_times_df['Long Waiters 65+'] = [True if x > 65 else False for x in wait_times_df['overall_queue_time']]
-
-        # long_waiters_df = {'52+': wait_times_df[wait_times_df["Long Waiters 52+"] == 1]["Long Waiters 52+", "run"].value_counts() ,
-        #        '65+' : wait_times_df[wait_times_df["Long Waiters 65+"] == 1]["Long Waiters 65+"].value_counts()
-        #        }
-
-        long_waiters_df_52 = pd.DataFrame(wait_times_df[wait_times_df["Long Waiters 52+"] == True].value_counts(['run', 'Long Waiters 52+'])).reset_index()
-        long_waiters_df_52 = long_waiters_df_52.drop(columns='Long Waiters 52+').rename(columns={'count': 'Long Waiters 52+'})
-        long_waiters_df_65 = pd.DataFrame(wait_times_df[wait_times_df["Long Waiters 65+"] == True].value_counts(['run', 'Long Waiters 65+'])).reset_index()
-        long_waiters_df_65 = long_waiters_df_65.drop(columns='Long Waiters 65+').rename(columns={'count': 'Long Waiters 65+'})
-        long_waiters_df = pd.merge(
-            left=long_waiters_df_52,
-            right=long_waiters_df_65
-        )
-        long_waiters_average_df = long_waiters_df.mean()
+    # The long waiters still on the waiting list at the end of each week
+        st.plotly_chart(demo_trial_results_calculator.plot_long_waiters_over_time())
+        st.caption("The number of patients still waiting at the end of each week, **averaged** across "
+                   f"{NUM_OF_RUNS} simulation runs. Patients already waiting at the start count as "
+                   "referred at the start of the simulation.")
+
+    # Percentiles of the waits (from the sketches of the waits of every run)
+        st.subheader('Percentiles of Waiting Times')
+        wait_percentiles_df = demo_trial_results_calculator.readout_wait_percentiles().rename(
+            columns={'p50': 'Median wait (weeks)', 'p92': '92nd percentile wait (weeks)'})
+        st.dataframe(wait_percentiles_df.round(1))
+        st.caption("The waits for each stage, and the overall RTT wait, of all patients referred "
+                   f"during the {LENGTH_OF_SIM} weeks across {NUM_OF_RUNS} simulation runs")
+
+    # Long waiters for the threshold and weeks of referral chosen in the sidebar. These are
+    # looked up in counts of the waits that are only built once per trial, so are instant
+    # when the sliders are moved.
+        wait_index = demo_trial_results_calculator.wait_time_index()
+        FIRST_WEEK, LAST_WEEK = REFERRAL_WEEKS
+        st.subheader(f'Patients Referred in Weeks {FIRST_WEEK} to {LAST_WEEK}')
+        index_col1, index_col2, index_col3 = st.columns(3)
+        with index_col1:
+            st.metric(label="Patients referred",
+                      value=f"{wait_index.referrals(FIRST_WEEK, LAST_WEEK):.1f}")
+        with index_col2:
+            st.metric(label="Average wait (weeks)",
+                      value=f"{wait_index.mean_wait(FIRST_WEEK, LAST_WEEK):.1f}")
+        with index_col3:
+            st.metric(label=f"Waiting {WAIT_THRESHOLD}+ weeks",
+                      value=f"{wait_index.long_waiters(WAIT_THRESHOLD, FIRST_WEEK, LAST_WEEK):.1f}")
+        st.caption(f"**Averages** across {NUM_OF_RUNS} simulation runs. Change the threshold and "
+                   "weeks of referral in the sidebar.")
+
+    # Count the long waiters in each run
+    # (runs without any long waiters count as zero)
+        long_waiters_df = demo_trial_results_calculator.readout_long_waiters().reset_index()
 
         # This creates a chart showing the total 52+ and 65+ waits
         # This is referenced in the columns below.
@@ -322,8 +504,8 @@ with tab1:
         )
         )
 
-        long_waiters_52 = int(long_waiters_df['Long Waiters 52+'].mean().round(0))
-        long_waiters_65 = int(long_waiters_df['Long Waiters 65+'].mean().round(0))
+        long_waiters_52 = int(round(long_waiters_df['Long Waiters 52+'].mean()))
+        long_waiters_65 = int(round(long_waiters_df['Long Waiters 65+'].mean()))
 
         st.caption(f"The following values relate to *all* patients generated before {LENGTH_OF_SIM} weeks")
 
@@ -334,13 +516,13 @@ with tab1:
         with col2:
             st.metric(
             label="Number of 52+ waiters",
-            help="Number of patients across simulation waiting more than 52+ weeks",
+            help="Number of patients across simulation waiting 52 weeks or more",
             value= long_waiters_52
             )
         with col3:
             st.metric(
             label="Number of 65+ waiters",
-            help="Number of patients across simulation waiting more than 65+ weeks",
+            help="Number of patients across simulation waiting 65 weeks or more",
             value= long_waiters_65
             )
 
@@ -0,0 +1,207 @@
+# Tools to profile the CPU time and memory use of the Neurosurgery RTT pathway model
+
+import ast
+import contextlib
+import cProfile
+import os
+import pstats
+import time
+import tracemalloc
+from collections import defaultdict
+
+# Folder containing the model's own source files. Anything defined in here is reported against
+# the method it belongs to, while everything else is grouped by library.
+MODEL_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Libraries we want to see separately in the report, rather than lumped in with 'other'
+LIBRARY_GROUPS = {
+    'simpy': 'SimPy scheduling',
+    'pandas': 'pandas',
+    'numpy': 'numpy',
+    'csv': 'csv writing',
+    'logging': 'logging',
+}
+
+# Number of frames to record for each allocation, so that allocations made inside pandas can be
+# traced back to the model method that called it
+TRACEMALLOC_FRAMES = 25
+
+
+class Function_Locator:
+    """
+    Maps a line in one of the model's source files to the function or method it belongs to
+    (e.g. 'Neurosurgery_Pathway.serve_stage')
+    """
+    def __init__(self):
+        self.function_lines = {}
+
+    def read_functions(self, filename):
+        """
+        Method to find the first and last line of every function defined in a source file
+        """
+        functions = []
+        try:
+            with open(filename) as source:
+                tree = ast.parse(source.read())
+        except (OSError, SyntaxError):
+            return functions
+
+        def visit(node, prefix):
+            for child in ast.iter_child_nodes(node):
+                if isinstance(child, ast.ClassDef):
+                    visit(child, f'{prefix}{child.name}.')
+                elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    functions.append((child.lineno, child.end_lineno, f'{prefix}{child.name}'))
+                    visit(child, f'{prefix}{child.name}.')
+        visit(tree, '')
+
+        # innermost (shortest) definitions first, so nested functions take precedence
+        return sorted(functions, key=lambda f: f[1] - f[0])
+
+    def locate(self, filename, lineno):
+        """
+        Method to return the name of the function containing the given line
+
+        Returns
+        ---
+        A string, or None if the file is not part of the model
+        """
+        if not filename.startswith(MODEL_DIRECTORY) or 'site-packages' in filename:
+            return None
+        if filename not in self.function_lines:
+            self.function_lines[filename] = self.read_functions(filename)
+
+        module = os.path.splitext(os.path.basename(filename))[0]
+        for first_line, last_line, name in self.function_lines[filename]:
+            if first_line <= lineno <= last_line:
+                return f'{module}: {name}'
+        return f'{module}: <module>'
+
+
+def library_group(filename):
+    """
+    Function to work out which library group a (non-model) source file belongs to
+    """
+    path_parts = filename.replace('\\', '/').split('/')
+    for library, group in LIBRARY_GROUPS.items():
+        if library in path_parts or os.path.basename(filename) == f'{library}.py':
+            return group
+    return 'other'
+
+
+def cpu_report_lines(profile, locator, top = 15):
+    """
+    Function to summarise a cProfile profile
+
+    Time spent in the model's own functions is listed per method, both as 'own' time (excluding
+    any functions they call) and 'cumulative' time (including them). Own time in libraries is
+    grouped by library, so e.g. the cost of SimPy's scheduling is shown as a single figure.
+    """
+    stats = pstats.Stats(profile)
+    total_time = stats.total_tt
+
+    model_functions = {}
+    library_time = defaultdict(float)
+    for (filename, lineno, function_name), (_, calls, own_time, cumulative_time, _) in stats.stats.items():
+        model_function = locator.locate(filename, lineno)
+        if model_function is not None:
+            model_functions[model_function] = (calls, own_time, cumulative_time)
+        else:
+            library_time[library_group(filename)] += own_time
+
+    lines = [f'CPU time: {total_time:.3f}s in total', '',
+             'Model functions (sorted by cumulative time)',
+             f'{"function":<72}{"calls":>10}{"own (s)":>12}{"cumulative (s)":>16}']
+    for name, (calls, own_time, cumulative_time) in sorted(
+            model_functions.items(), key=lambda item: -item[1][2])[:top]:
+        lines.append(f'{name:<72}{calls:>10}{own_time:>12.3f}{cumulative_time:>16.3f}')
+
+    lines += ['', 'Own time outside the model (by library)']
+    for group, own_time in sorted(library_time.items(), key=lambda item: -item[1]):
+        lines.append(f'{group:<72}{own_time:>12.3f}s ({own_time / total_time:.0%})')
+
+    return lines
+
+
+def memory_report_lines(snapshot, peak, locator, top = 15):
+    """
+    Function to summarise a tracemalloc snapshot
+
+    Each allocation that is still in use is attributed to the innermost model function in its
+    traceback, so memory allocated by pandas on behalf of e.g. store_queue_times is counted
+    against store_queue_times.
+    """
+    by_function = defaultdict(lambda: [0, 0])
+    for statistic in snapshot.statistics('traceback'):
+        owner = None
+        # tracemalloc lists the most recent frame last
+        for frame in reversed(statistic.traceback):
+            owner = locator.locate(frame.filename, frame.lineno)
+            if owner is not None:
+                break
+        if owner is None:
+            owner = library_group(statistic.traceback[-1].filename)
+        by_function[owner][0] += statistic.size
+        by_function[owner][1] += statistic.count
+
+    total_size = sum(size for size, _ in by_function.values())
+    lines = [f'Memory: peak traced {peak / 1024 ** 2:.1f} MB, '
+             f'{total_size / 1024 ** 2:.1f} MB still allocated at the end', '',
+             'Allocations still in use at the end, by the model function that made them',
+             f'{"function":<72}{"blocks":>10}{"size (MB)":>12}']
+    for name, (size, count) in sorted(by_function.items(), key=lambda item: -item[1][0])[:top]:
+        lines.append(f'{name:<72}{count:>10}{size / 1024 ** 2:>12.2f}')
+
+    return lines
+
+
+@contextlib.contextmanager
+def profile_section(name, profile_dir = 'profiles'):
+    """
+    Context manager to profile the CPU time and memory use of the code it wraps
+
+    Writes three files to profile_dir:
+    - {name}.prof: the raw cProfile output (open with e.g. `python -m pstats` or snakeviz)
+    - {name}.tracemalloc: the raw tracemalloc snapshot (load with tracemalloc.Snapshot.load)
+    - {name}_report.txt: a short report attributing time and memory to the model's methods
+
+    Example
+    ---
+    with profile_section('my_run'):
+        model.run()
+    """
+    os.makedirs(profile_dir, exist_ok=True)
+    base_filename = os.path.join(profile_dir, name)
+
+    # Only start tracemalloc if something else (e.g. an outer profile) has not already
+    already_tracing = tracemalloc.is_tracing()
+    if not already_tracing:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    tracemalloc.reset_peak()
+
+    profile = cProfile.Profile()
+    start = time.perf_counter()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        wall_time = time.perf_counter() - start
+
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if not already_tracing:
+            tracemalloc.stop()
+
+        profile.dump_stats(f'{base_filename}.prof')
+        snapshot.dump(f'{base_filename}.tracemalloc')
+
+        locator = Function_Locator()
+        lines = [f'Profile: {name}', f'Wall time: {wall_time:.3f}s '
+                 '(profiling itself slows the code down, so compare relative figures)', '']
+        lines += cpu_report_lines(profile, locator)
+        lines += ['']
+        lines += memory_report_lines(snapshot, peak, locator)
+
+        with open(f'{base_filename}_report.txt', 'w') as report:
+            report.write('\n'.join(lines) + '\n')
@@ -0,0 +1,178 @@
+# Command line runner for trials of the Neurosurgery RTT pathway simulation
+#
+# This runs a trial without the Streamlit app (and without importing Streamlit or plotly), so
+# trials can be run overnight or scheduled on a compute server. For example:
+#   python run_batch.py example_scenario.json --output-dir results/example --workers 4
+#
+# The scenario file is a json file of parameters for Neurosurgery_Pathway, optionally with
+# 'number_of_runs' and 'seed' - see example_scenario.json.
+#
+# For steady state results, a single long run can be analysed by batch means instead, e.g.
+#   python run_batch.py example_scenario.json --batch-means 2000
+
+import argparse
+import inspect
+import json
+import logging
+import os
+import time
+
+from SurgeryCohortModel import Cohort_Flow_Model, run_cohort_trial
+from SurgeryResultStore import Result_Store, RESULT_STORE_DIR
+from SurgeryScenario import build_scenario_config
+from SurgeryTrial import run_trial
+
+# Keys in a scenario file that control the trial rather than the pathway itself
+TRIAL_SETTINGS = ['name', 'number_of_runs', 'seed']
+
+
+def load_scenario(filename):
+    """
+    Function to read a scenario config file
+
+    Returns
+    ---
+    A tuple of the trial settings (dict) and the keyword arguments for Neurosurgery_Pathway (dict)
+
+    The scenario's pathway_graph can be the name of a json file (see example_pathway.json),
+    relative to the scenario file.
+    """
+    with open(filename) as f:
+        scenario = json.load(f)
+
+    if isinstance(scenario.get('pathway_graph'), str):
+        with open(os.path.join(os.path.dirname(filename), scenario['pathway_graph'])) as f:
+            scenario['pathway_graph'] = json.load(f)
+
+    trial_settings = {key: scenario[key] for key in TRIAL_SETTINGS if key in scenario}
+    pathway_params = {key: value for key, value in scenario.items() if key not in TRIAL_SETTINGS}
+
+    return trial_settings, pathway_params
+
+
+def print_batch_means_summary(name, batch_means_df, weeks, wall_time):
+    """
+    Function to print the steady state results of a single long run to the console
+    """
+    print()
+    print(f"Steady state results for {name} (one run of {weeks} weeks, {wall_time:.1f}s)")
+    for (run, kpi), row in batch_means_df.iterrows():
+        print(f"  {kpi:<15} {row['estimate']:8.3f}  95% CI {row['ci_lower']:8.3f} to "
+              f"{row['ci_upper']:8.3f}  ({row['number_of_batches']} batches of "
+              f"{row['batch_size']}, lag 1 autocorrelation {row['lag1_autocorrelation']:.2f})")
+
+    warnings = []
+    if not batch_means_df['warm_up_reliable'].all():
+        warnings.append("no steady state was found after the warm-up")
+    if not batch_means_df['autocorrelation_ok'].all():
+        warnings.append("the batch means are still correlated")
+    if warnings:
+        print(f"  WARNING: {' and '.join(warnings)} - try a longer run")
+
+
+def print_kpi_summary(name, kpis, number_of_runs, wall_time):
+    """
+    Function to print the headline results of a trial to the console
+    """
+    print()
+    print(f"Results for {name} ({number_of_runs} runs, {wall_time:.1f}s)")
+    print(f"  Patients waiting for clinic at end:      {kpis['clinic_queue_end']:.0f}")
+    print(f"  Patients waiting for theatre at end:     {kpis['theatre_queue_end']:.0f}")
+    print(f"  Total patients waiting at end:           {kpis['total_queue_end']:.0f}")
+    print(f"  Mean wait, referred in first week:       {kpis['mean_wait_start']:.1f} weeks")
+    print(f"  Mean wait, referred in final week:       {kpis['mean_wait_end']:.1f} weeks")
+    print(f"  Final week referrals waiting 52+ weeks:  {kpis['total_52_plus']}")
+    print(f"  Final week referrals waiting 65+ weeks:  {kpis['total_65_plus']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a trial of the Neurosurgery RTT pathway simulation')
+    parser.add_argument('scenario', help='json file of scenario parameters')
+    parser.add_argument('--output-dir', default='results',
+                        help='folder to write the results to')
+    parser.add_argument('--runs', type=int, default=None,
+                        help='number of runs (overrides number_of_runs in the scenario file)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of runs to do in parallel')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed (overrides seed in the scenario file)')
+    parser.add_argument('--antithetic', action='store_true',
+                        help='do the runs in antithetic pairs, for more precise averages')
+    parser.add_argument('--store', default=RESULT_STORE_DIR,
+                        help='folder of stored runs to reuse (and add to) when a seed is given')
+    parser.add_argument('--no-store', action='store_true',
+                        help='always run the simulation, without using the store')
+    parser.add_argument('--batch-means', type=int, default=None, metavar='WEEKS',
+                        help='instead of a trial, do a single run of this many weeks and '
+                             'estimate steady state results from it by batch means')
+    parser.add_argument('--cohort', action='store_true',
+                        help='use the week-by-week cohort model instead of the simulation '
+                             '(much quicker, for very large volumes)')
+    parser.add_argument('--quiet', action='store_true',
+                        help='only log warnings, leaving out the messages when each run ends '
+                             'or reaches a steady state')
+    args = parser.parse_args()
+
+    trial_settings, pathway_params = load_scenario(args.scenario)
+    name = trial_settings.get('name', os.path.splitext(os.path.basename(args.scenario))[0])
+    number_of_runs = args.runs or trial_settings.get('number_of_runs', 1)
+    seed = args.seed if args.seed is not None else trial_settings.get('seed')
+
+    if args.quiet:
+        logging.getLogger("dual_logger").setLevel(logging.WARNING)
+
+    result_store = None if args.no_store else Result_Store(args.store)
+
+    if args.batch_means is not None:
+        scenario_config = build_scenario_config(**{**pathway_params, 'sim_duration': args.batch_means})
+        start = time.perf_counter()
+        trial_results_calculator = run_trial(number_of_runs=1, seed=seed,
+                                             output_dir=args.output_dir,
+                                             result_store=result_store,
+                                             scenario_config=scenario_config)
+        batch_means_df = trial_results_calculator.readout_batch_means()
+        wall_time = time.perf_counter() - start
+
+        batch_means_df.to_csv(os.path.join(args.output_dir, 'batch_means.csv'))
+        print_batch_means_summary(name, batch_means_df, args.batch_means, wall_time)
+        raise SystemExit
+
+    if args.cohort:
+        # the simulation's own settings (e.g. service_mode) don't apply to the cohort model
+        cohort_params = {key: value for key, value in pathway_params.items()
+                         if key in inspect.signature(Cohort_Flow_Model).parameters}
+        start = time.perf_counter()
+        run_kpis_df = run_cohort_trial(number_of_runs, seed, **cohort_params)
+        wall_time = time.perf_counter() - start
+
+        os.makedirs(args.output_dir, exist_ok=True)
+        run_kpis_df.to_csv(os.path.join(args.output_dir, 'cohort_run_kpis.csv'))
+        kpis = run_kpis_df.mean().to_dict()
+        for kpi in ['total_52_plus', 'total_65_plus']:
+            kpis[kpi] = int(round(kpis[kpi]))
+        print_kpi_summary(f'{name} (cohort model)', kpis, number_of_runs, wall_time)
+        raise SystemExit
+
+    # (checks the scenario's parameters before any runs are started)
+    scenario_config = build_scenario_config(**pathway_params)
+    start = time.perf_counter()
+    trial_results_calculator = run_trial(number_of_runs=number_of_runs, seed=seed,
+                                         workers=args.workers, output_dir=args.output_dir,
+                                         result_store=result_store, antithetic=args.antithetic,
+                                         scenario_config=scenario_config)
+    kpis = trial_results_calculator.readout_kpis()
+    wall_time = time.perf_counter() - start
+
+    # Save the headline results alongside the per-run results, with the scenario that gave them
+    with open(os.path.join(args.output_dir, 'kpis.json'), 'w') as f:
+        json.dump({'name': name, 'number_of_runs': number_of_runs, 'seed': seed,
+                   'parameters': scenario_config.pathway_params(),
+                   'scenario_key': scenario_config.key(), 'kpis': kpis}, f, indent=2)
+
+    print_kpi_summary(name, kpis, number_of_runs, wall_time)
+
+    wait_percentiles_df = trial_results_calculator.readout_wait_percentiles()
+    wait_percentiles_df.to_csv(os.path.join(args.output_dir, 'wait_percentiles.csv'))
+    print("  Median / 92nd percentile wait (weeks):")
+    for wait, row in wait_percentiles_df.iterrows():
+        print(f"    {wait:<20} {row['p50']:6.1f} / {row['p92']:6.1f}")